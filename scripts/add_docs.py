@@ -1,10 +1,43 @@
 """Simple script for adding documents to the elastic db"""
 import json
 import argparse
+import os
+import sys
+from typing import Iterator
 
+import requests
 from elasticsearch import Elasticsearch
 from tqdm.auto import tqdm
 
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "cruise_literature")
+)
+from utils.display_fields import display_fields  # noqa: E402
+
+
+def read_docs(data_path: str, first_n_docs: int) -> Iterator[dict]:
+    """Yields the documents of the jsonl file with their display fields."""
+    with open(data_path) as fp:
+        for index_i, json_str in enumerate(fp):
+            if 0 < first_n_docs <= index_i:
+                break
+            item = json.loads(json_str)
+            if "display" not in item:  # filtered before the display fields were added
+                item["display"] = display_fields(item)
+            yield item
+
+
+def ingest_via_api(api_url: str, index: str, docs: Iterator[dict]):
+    """Streams the documents to the ingest endpoint of search_app, which indexes them
+    in bulk chunks while they are read, and prints the documents which failed."""
+    body = (json.dumps(item).encode() + b"\n" for item in docs)
+    response = requests.post(f"{api_url}/ingest", params={"index_name": index}, data=body)
+    response.raise_for_status()
+    summary = response.json()
+    for failure in summary.pop("failures"):
+        print(f"line {failure['line']} (id {failure['id']}): {failure['status']} {failure['error']}")
+    print(json.dumps(summary, indent=2))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -21,6 +54,13 @@ if __name__ == "__main__":
         "--index", type=str, default="papers", help="Name of the ES index."
     )
 
+    parser.add_argument(
+        "--api_url",
+        type=str,
+        default=None,
+        help="URL of the search_app API, e.g. http://localhost:9880/api/v1. If set, the documents "
+        "are streamed to its ingest endpoint instead of being indexed in ES one by one.",
+    )
     parser.add_argument(
         "--first_n_docs",
         type=int,
@@ -34,14 +74,12 @@ if __name__ == "__main__":
     if not args.data_path.endswith(".jsonl"):
         raise ValueError("data_file should be in a jsonl format")
 
-    with open(args.data_path) as fp:
-        docs_list = list(fp)
+    total_docs = args.first_n_docs if args.first_n_docs > 0 else None
+    docs = tqdm(read_docs(args.data_path, args.first_n_docs), total=total_docs)
 
-    if isinstance(args.first_n_docs, int) and args.first_n_docs > 0:
-        docs_list = docs_list[: args.first_n_docs]
-        total_docs = args.first_n_docs
-    else:
-        total_docs = len(docs_list)
+    if args.api_url:
+        ingest_via_api(args.api_url.rstrip("/"), args.index, docs)
+        sys.exit(0)
 
     es = Elasticsearch([{"host": args.host, "port": args.port}])
 
@@ -51,6 +89,7 @@ if __name__ == "__main__":
                 "properties": {
                     "keywords": {"type": "object",  "enabled": "false"},
                     "CSO_keywords": {"type": "object", "enabled": "false"},
+                    "display": {"type": "object", "enabled": "false"},
                 }
             }
         }
@@ -58,7 +97,6 @@ if __name__ == "__main__":
             index=args.index, body=mapping
         )
 
-    for index_i, json_str in tqdm(enumerate(docs_list), total=total_docs):
-        item = json.loads(json_str)
+    for item in docs:
         res = es.index(index=args.index,
                        document=item)
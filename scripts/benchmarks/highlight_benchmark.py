@@ -0,0 +1,60 @@
+"""Benchmark of query term highlighting on long abstracts.
+
+Compares the compiled single-pass QueryHighlighter with a naive implementation
+running one re.sub per query term and growing the output string with +=.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.append(
+    os.path.join(os.path.dirname(__file__), "..", "..", "src", "cruise_literature")
+)
+
+from document_search.highlight import QueryHighlighter  # noqa: E402
+
+VOCABULARY = [
+    "learning", "search", "engine", "neural", "network", "retrieval", "ranking",
+    "model", "data", "systematic", "review", "screening", "citation", "query",
+    "evaluation", "biology", "genomics", "physics", "cancer", "language",
+]
+
+
+def naive_highlight(text: str, terms: list) -> str:
+    highlighted = ""
+    for word in text.split():
+        for term in terms:
+            word = re.sub(rf"^({re.escape(term)}\w*)$", r"<em>\1</em>", word, flags=re.I)
+        highlighted += word + " "
+    return highlighted[:-1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_words", type=int, default=10000, help="words per abstract")
+    parser.add_argument("--n_abstracts", type=int, default=20)
+    parser.add_argument(
+        "--query", type=str, default="machine learning for systematic review screening"
+    )
+    args = parser.parse_args()
+
+    random.seed(0)
+    abstracts = [
+        " ".join(random.choices(VOCABULARY, k=args.n_words))
+        for _ in range(args.n_abstracts)
+    ]
+
+    highlighter = QueryHighlighter(args.query)
+    compiled = timeit.timeit(
+        lambda: [highlighter.highlight(a) for a in abstracts], number=1
+    )
+    naive = timeit.timeit(
+        lambda: [naive_highlight(a, highlighter.terms) for a in abstracts], number=1
+    )
+
+    print(f"{args.n_abstracts} abstracts x {args.n_words} words, terms: {highlighter.terms}")
+    print(f"compiled highlighter: {compiled / args.n_abstracts * 1000:8.2f} ms per abstract")
+    print(f"naive highlighter:    {naive / args.n_abstracts * 1000:8.2f} ms per abstract")
@@ -0,0 +1,135 @@
+"""Benchmark of memory used to build a literature review from search results.
+
+Adds the results of many queries to a review with add_search_results, once with
+slotted Article instances serialized by Article.to_dict (shallow), and once with
+an equivalent regular dataclass serialized by dataclasses.asdict (deep copy),
+as articles were before. Reports the size of an article instance, and the peak
+traced memory and the time of building the review.
+
+The settings are loaded from .env, the database is not used.
+
+    $ python scripts/benchmarks/review_memory_benchmark.py --n_queries 500 --n_results 500
+"""
+import argparse
+import dataclasses
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+PROJECT_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "cruise_literature"
+)
+sys.path.insert(0, PROJECT_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cruise_literature.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from literature_review.forms import add_search_results  # noqa: E402
+from utils.article import Article  # noqa: E402
+
+VOCABULARY = [
+    "learning", "search", "engine", "neural", "network", "retrieval", "ranking",
+    "model", "data", "systematic", "review", "screening", "citation", "query",
+    "evaluation", "biology", "genomics", "physics", "cancer", "language",
+]
+
+# Article as a regular dataclass, serialized with dataclasses.asdict
+LegacyArticle = dataclasses.make_dataclass(
+    "LegacyArticle",
+    [
+        (f.name, f.type)
+        if f.default is dataclasses.MISSING
+        else (f.name, f.type, dataclasses.field(default=f.default))
+        for f in dataclasses.fields(Article)
+    ],
+    namespace={"to_dict": dataclasses.asdict},
+)
+
+
+def make_results(article_class, query_i: int, n_results: int, rng: random.Random):
+    """Returns search results of a query, half of them found by an earlier query as well."""
+    results = []
+    for rank in range(n_results):
+        paper_i = query_i * n_results // 2 + rank
+        words = rng.choices(VOCABULARY, k=8)
+        results.append(
+            article_class(
+                id=f"paper-{paper_i}",
+                title=f"{' '.join(words)} {paper_i}",
+                url=f"https://doi.org/10.5555/bench.{paper_i}",
+                pdf=None,
+                snippet=" ".join(rng.choices(VOCABULARY, k=40)),
+                abstract=" ".join(rng.choices(VOCABULARY, k=200)),
+                authors="A. Author, B. Author, C. Author",
+                publication_date="2021-01-01",
+                publication_year=2021,
+                urls=[
+                    f"https://doi.org/10.5555/bench.{paper_i}",
+                    f"https://example.org/papers/{paper_i}.pdf",
+                ],
+                venue="Benchmark Venue",
+                keywords_snippet={word: rng.random() for word in words[:6]},
+                keywords_rest={word: rng.random() for word in words[6:]},
+                n_references=rng.randrange(100),
+                n_citations=rng.randrange(1000),
+                doi=f"10.5555/bench.{paper_i}",
+            )
+        )
+    return results
+
+
+def build_review(article_class, n_queries: int, n_results: int):
+    rng = random.Random(0)
+    papers = {}
+    for query_i in range(n_queries):
+        add_search_results(
+            papers,
+            make_results(article_class, query_i, n_results, rng),
+            search_engine_name="CRUISE",
+            query=f"query {query_i}",
+            added_by="benchmark",
+            added_at="2023-01-01 00:00:00",
+        )
+    return papers
+
+
+def instance_size(article) -> int:
+    """Size of the instance itself (and of its __dict__), without the field values."""
+    if hasattr(article, "__dict__"):
+        return sys.getsizeof(article) + sys.getsizeof(article.__dict__)
+    return sys.getsizeof(article)
+
+
+def measure(article_class, n_queries: int, n_results: int):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    papers = build_review(article_class, n_queries, n_results)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(papers), peak, duration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_queries", type=int, default=500)
+    parser.add_argument("--n_results", type=int, default=500, help="results per query")
+    args = parser.parse_args()
+
+    print(f"{args.n_queries} queries x {args.n_results} results")
+    for name, article_class in (
+        ("slotted + to_dict", Article),
+        ("dataclass + asdict", LegacyArticle),
+    ):
+        size = instance_size(make_results(article_class, 0, 1, random.Random(0))[0])
+        n_papers, peak, duration = measure(article_class, args.n_queries, args.n_results)
+        print(
+            f"{name:20} instance {size:4} B, {n_papers} papers, "
+            f"peak {peak / 2 ** 20:8.1f} MiB, {duration:6.2f} s"
+        )
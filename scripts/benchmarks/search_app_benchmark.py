@@ -0,0 +1,147 @@
+"""Throughput of the search_app API in its WSGI (Flask on gunicorn) and ASGI
+(Starlette on uvicorn) serving modes at increasing numbers of concurrent clients.
+
+Elasticsearch is replaced by the stub server (see stub_servers.py), answering
+searches after the latency of its cruise profile. Both apps run with the same
+number of worker processes, each client sends searches one after another.
+Requires gunicorn, uvicorn and the packages of src/backend/search_app/requirements.txt.
+
+    $ python scripts/benchmarks/search_app_benchmark.py --workers 1 --concurrency 1 4 16 64
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+
+from search_load_test import percentile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SEARCH_APP_DIR = os.path.join(BENCHMARKS_DIR, "..", "..", "src", "backend", "search_app")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not start in {timeout} seconds")
+
+
+def server_command(mode: str, port: int, workers: int, threads: int) -> List[str]:
+    if mode == "wsgi":
+        return [
+            sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}",
+            "--workers", str(workers), "--threads", str(threads), "search_app:app",
+        ]
+    return [
+        sys.executable, "-m", "uvicorn", "search_app_asgi:app", "--port", str(port),
+        "--workers", str(workers), "--log-level", "warning", "--no-access-log",
+    ]
+
+
+def run_clients(url: str, concurrency: int, duration: float, top_k: int) -> Dict:
+    deadline = time.monotonic() + duration
+    sessions = [requests.Session() for _ in range(concurrency)]
+
+    def client(client_i: int) -> List[float]:
+        latencies = []
+        request_i = 0
+        while time.monotonic() < deadline:
+            query = f"benchmark query {client_i} {request_i}"
+            start = time.monotonic()
+            response = sessions[client_i].post(
+                f"{url}/api/v1/search",
+                json={"query": query, "es_index": "papers", "es_top_k": top_k},
+            )
+            response.raise_for_status()
+            latencies.append(time.monotonic() - start)
+            request_i += 1
+        return latencies
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = [
+            latency
+            for client_latencies in executor.map(client, range(concurrency))
+            for latency in client_latencies
+        ]
+    elapsed = time.monotonic() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50": round(percentile(latencies, 50), 4),
+        "p95": round(percentile(latencies, 95), 4),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", default=["wsgi", "asgi"], choices=["wsgi", "asgi"])
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of both apps")
+    parser.add_argument("--threads", type=int, default=4, help="threads per gunicorn worker")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per level")
+    parser.add_argument("--top_k", type=int, default=50)
+    parser.add_argument(
+        "--es_latency", default="0.05,0.3", help="MEDIAN[,SIGMA] of the stub elasticsearch"
+    )
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub = subprocess.Popen(
+        [
+            sys.executable, os.path.join(BENCHMARKS_DIR, "stub_servers.py"),
+            "--port", str(stub_port), "--profile", f"cruise={args.es_latency}",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    config = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump({"host": f"http://127.0.0.1:{stub_port}/elasticsearch"}, config)
+    config.close()
+
+    reports = []
+    try:
+        wait_for(f"http://127.0.0.1:{stub_port}/")
+        for mode in args.modes:
+            port = free_port()
+            server = subprocess.Popen(
+                server_command(mode, port, args.workers, args.threads),
+                cwd=SEARCH_APP_DIR,
+                env={**os.environ, "SEARCH_APP_CONFIG": config.name},
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                url = f"http://127.0.0.1:{port}"
+                wait_for(f"{url}/api/v1/status")
+                for concurrency in args.concurrency:
+                    report = {"mode": mode, **run_clients(url, concurrency, args.duration, args.top_k)}
+                    print(
+                        f"{mode}  clients {concurrency:4}  {report['throughput']:8.1f} req/s  "
+                        f"p50 {report['p50']:.3f} s  p95 {report['p95']:.3f} s"
+                    )
+                    reports.append(report)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        stub.terminate()
+        os.unlink(config.name)
+    print(json.dumps(reports, indent=2))
@@ -0,0 +1,240 @@
+"""Offline load test of the search page.
+
+Replays the queries of the user query log at a target rate against the search
+page, with all search engines replaced by the local stub servers (see
+stub_servers.py), and reports throughput and latency percentiles.
+
+By default the requests go through the Django test client in this process
+(the database configured in .env must be migrated and contain the search_engines
+fixture). With --url, the requests go to a live dev server, which has to be
+started with the environment variables printed by stub_servers.py.
+
+Requests are sent open-loop: every request is scheduled at its time regardless
+of earlier responses, and its latency is measured from the scheduled time, so
+queueing is included in the latency when the server cannot keep up.
+
+    $ python scripts/benchmarks/search_load_test.py --qps 5 --n_requests 200
+    $ python scripts/benchmarks/search_load_test.py --output bench.json
+    $ python scripts/benchmarks/search_load_test.py --baseline bench.json --max_regression 0.2
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import requests
+
+from stub_servers import StubServer, add_profile_arguments, parse_profiles
+
+REPOSITORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+PROJECT_DIR = os.path.join(REPOSITORY_DIR, "src", "cruise_literature")
+
+# used when the query log is missing or empty
+SAMPLE_QUERIES = [
+    "systematic review automation",
+    "citation screening active learning",
+    "neural ranking models",
+    "covid-19 vaccine efficacy",
+    "graph neural networks",
+    "machine translation evaluation",
+    "deep learning",
+    "information retrieval",
+]
+
+
+def read_queries(path: str) -> Iterator[str]:
+    """Yields the queries of the log in order. Requests for following pages
+    (served from search sessions) are skipped. Lines of the former tab-separated
+    format (time, query type, search time, query, ...) are supported as well."""
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as log_file:
+        for line in log_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) > 3 and fields[3].strip():
+                    yield fields[3]
+                continue
+            if isinstance(record, dict) and not record.get("from_session"):
+                yield record["query"]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def django_client_requester(environment: Dict[str, str], keep_rate_limits: bool):
+    """Sets up Django in this process with the search engines pointing to the stubs.
+    The searches are logged to a temporary query log, so the replayed log and the
+    query statistics (aggregate_query_log) do not get the synthetic traffic."""
+    os.environ.update(environment)
+    query_log_dir = tempfile.mkdtemp(prefix="search_load_test_")
+    os.environ["QUERY_LOG_PATH"] = os.path.join(query_log_dir, "user_queries.log")
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cruise_literature.settings")
+    sys.path.insert(0, PROJECT_DIR)
+    os.chdir(PROJECT_DIR)
+    import django
+
+    django.setup()
+    from django.conf import settings
+    from django.db import connection
+    from django.test import Client
+
+    settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, "testserver"]
+    if not keep_rate_limits:
+        settings.RATE_LIMITS = {}
+    local = threading.local()
+
+    def request(query: str) -> Tuple[int, int]:
+        if not hasattr(local, "client"):
+            local.client = Client(raise_request_exception=False)
+        try:
+            response = local.client.get("/search", {"search_query": query})
+            return response.status_code, len(response.content)
+        finally:
+            connection.close()
+
+    return request
+
+
+def live_server_requester(url: str):
+    session = requests.Session()
+
+    def request(query: str) -> Tuple[int, int]:
+        response = session.get(f"{url}/search?{urlencode({'search_query': query})}")
+        return response.status_code, len(response.content)
+
+    return request
+
+
+def replay(
+    request: Callable[[str], Tuple[int, int]],
+    queries: List[str],
+    qps: float,
+    concurrency: int,
+) -> Dict:
+    latencies, service_times = [], []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def run(scheduled_at: float, query: str):
+        time.sleep(max(0.0, scheduled_at - time.monotonic()))
+        started_at = time.monotonic()
+        try:
+            status, _ = request(query)
+        except requests.exceptions.RequestException:
+            status = "connection error"
+        finished_at = time.monotonic()
+        with lock:
+            statuses[status] += 1
+            latencies.append(finished_at - scheduled_at)
+            service_times.append(finished_at - started_at)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, query in enumerate(queries):
+            executor.submit(run, start + i / qps, query)
+    duration = time.monotonic() - start
+
+    return {
+        "requests": len(queries),
+        "target_qps": qps,
+        "throughput": round(len(queries) / duration, 3),
+        "errors": sum(count for status, count in statuses.items() if status != 200),
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "latency": {
+            f"p{p}": round(percentile(latencies, p), 4) for p in (50, 95, 99)
+        },
+        "service_time": {
+            f"p{p}": round(percentile(service_times, p), 4) for p in (50, 95, 99)
+        },
+        "max_latency": round(max(latencies), 4),
+    }
+
+
+def regressions(report: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    """Returns the metrics which are worse than the baseline by more than max_regression."""
+    failed = []
+    for p in ("p50", "p95", "p99"):
+        if report["latency"][p] > baseline["latency"][p] * (1 + max_regression):
+            failed.append(
+                f"latency {p}: {report['latency'][p]:.3f} s (baseline {baseline['latency'][p]:.3f} s)"
+            )
+    if report["throughput"] < baseline["throughput"] * (1 - max_regression):
+        failed.append(
+            f"throughput: {report['throughput']:.2f} req/s (baseline {baseline['throughput']:.2f} req/s)"
+        )
+    if report["errors"] > baseline["errors"]:
+        failed.append(f"errors: {report['errors']} (baseline {baseline['errors']})")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--log",
+        default=os.path.join(REPOSITORY_DIR, "data", "user_queries.log"),
+        help="query log to replay",
+    )
+    parser.add_argument("--qps", type=float, default=2.0, help="target requests per second")
+    parser.add_argument("--n_requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--url", help="URL of a live server, e.g. http://localhost:8000")
+    parser.add_argument(
+        "--direct_elasticsearch",
+        action="store_true",
+        help="search CRUISE directly in (stubbed) elasticsearch instead of through search_app",
+    )
+    parser.add_argument(
+        "--keep_rate_limits",
+        action="store_true",
+        help="keep RATE_LIMITS of the settings (test client only), by default the stubs are not rate limited",
+    )
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--baseline", help="report of an earlier run to compare with")
+    parser.add_argument("--max_regression", type=float, default=0.2)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    queries = list(read_queries(args.log)) or SAMPLE_QUERIES
+    queries = [queries[i % len(queries)] for i in range(args.n_requests)]
+
+    stub_server = None
+    if args.url:
+        request = live_server_requester(args.url.rstrip("/"))
+    else:
+        stub_server = StubServer(
+            profiles=parse_profiles(args.profile),
+            wikipedia_match_rate=args.wikipedia_match_rate,
+        ).start()
+        request = django_client_requester(
+            stub_server.environment(args.direct_elasticsearch), args.keep_rate_limits
+        )
+
+    report = replay(request, queries, qps=args.qps, concurrency=args.concurrency)
+    if stub_server:
+        report["stub_requests"] = stub_server.requests
+        stub_server.stop()
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            failed = regressions(report, json.load(baseline_file), args.max_regression)
+        for message in failed:
+            print(f"REGRESSION {message}")
+        sys.exit(1 if failed else 0)
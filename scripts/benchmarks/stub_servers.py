@@ -0,0 +1,393 @@
+"""Local stand-in HTTP servers of the search engine APIs, for offline benchmarks.
+
+One threaded server answers for CRUISE (the search_app ES proxy, or elasticsearch
+itself), CORE, Semantic Scholar, Entrez (PubMed) and Wikipedia, each under its own path prefix.
+Responses are built from the recorded responses in fixtures/: the recorded
+records are repeated up to the requested number of results, and their ids,
+DOIs and titles are rewritten per query and rank. The same query always gets
+the same results, and results of different engines partially overlap, so
+deduplication is exercised like with the real engines.
+
+Every engine has a latency distribution (log-normal with a median and sigma)
+and an error rate (503 responses), see DEFAULT_PROFILES. Requests through the
+search_app proxy take the latency of the search_app profile on top of the cruise one.
+
+Run standalone to benchmark a live dev server:
+
+    $ python scripts/benchmarks/stub_servers.py --port 9900
+
+and start the dev server with the printed environment variables.
+"""
+import argparse
+import copy
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# number of distinct documents, results of all engines are drawn from the same pool
+DOCUMENT_POOL = 100000
+
+# settings (environment variables) pointing the search engines to the stubs
+ENDPOINTS = {
+    "CRUISE_API_ENDPOINT": "/cruise/api/v1",
+    "CORE_API_ENDPOINT": "/core/v3/search/works",
+    "SEMANTIC_SCHOLAR_API_ENDPOINT": "/semantic_scholar/graph/v1",
+    "ENTREZ_API_ENDPOINT": "/entrez/eutils",
+    "WIKIPEDIA_API_ENDPOINT": "/wikipedia/w/api.php",
+}
+
+
+@dataclass
+class LatencyProfile:
+    """Log-normal latency with the given median (seconds) and sigma, and a share of 503 errors."""
+
+    median: float
+    sigma: float = 0.5
+    error_rate: float = 0.0
+
+    def sample(self, rng: random.Random) -> Tuple[float, bool]:
+        latency = self.median * math.exp(rng.gauss(0, self.sigma))
+        return latency, rng.random() < self.error_rate
+
+    @classmethod
+    def parse(cls, value: str) -> "LatencyProfile":
+        """Parses "median[,sigma[,error_rate]]"."""
+        return cls(*(float(part) for part in value.split(",")))
+
+
+DEFAULT_PROFILES = {
+    "cruise": LatencyProfile(median=0.05, sigma=0.3),
+    "search_app": LatencyProfile(median=0.01, sigma=0.3),
+    "core": LatencyProfile(median=0.8, sigma=0.6, error_rate=0.02),
+    "semantic_scholar": LatencyProfile(median=0.4, sigma=0.5, error_rate=0.01),
+    "entrez": LatencyProfile(median=0.3, sigma=0.4),
+    "wikipedia": LatencyProfile(median=0.1, sigma=0.3),
+}
+
+# shift of the document numbers of every engine, so the engines share most (not all) results
+ENGINE_OFFSETS = {"cruise": 0, "core": 7, "semantic_scholar": 3, "entrez": 11}
+
+
+def _load_fixture(name: str):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as fixture:
+        return json.load(fixture) if name.endswith(".json") else fixture.read()
+
+
+def _query_seed(query: str) -> int:
+    return int(hashlib.sha1(query.casefold().encode()).hexdigest()[:8], 16)
+
+
+def document_numbers(engine: str, query: str, offset: int, limit: int) -> List[int]:
+    seed = _query_seed(query) + ENGINE_OFFSETS[engine]
+    return [(seed + rank) % DOCUMENT_POOL for rank in range(offset, offset + limit)]
+
+
+class Fixtures:
+    """Recorded responses and the per-engine rewriting of their records."""
+
+    def __init__(self):
+        self.cruise = _load_fixture("cruise_search.json")
+        self.core = _load_fixture("core_search.json")
+        self.semantic_scholar = _load_fixture("semantic_scholar_search.json")
+        self.esearch = _load_fixture("entrez_esearch.xml")
+        self.medline = [
+            record
+            for record in _load_fixture("entrez_efetch.txt").split("\n\n")
+            if record.strip()
+        ]
+        self.wikipedia = _load_fixture("wikipedia_query.json")
+
+    @staticmethod
+    def _pick(records: List, number: int):
+        return copy.deepcopy(records[number % len(records)])
+
+    def cruise_response(self, query: str, top_k: int) -> Dict:
+        response = copy.deepcopy(self.cruise)
+        hits = []
+        for number in document_numbers("cruise", query, 0, top_k):
+            hit = self._pick(self.cruise["results"]["hits"]["hits"], number)
+            hit["_id"] = f"doc{number}"
+            hit["_source"]["doi"] = f"10.5555/bench.{number}"
+            hit["_source"]["title"] = f"Benchmark document {number}"
+            hits.append(hit)
+        response["results"]["hits"]["hits"] = hits
+        response["results"]["hits"]["total"]["value"] = len(hits)
+        return response
+
+    def core_response(self, query: str, limit: int) -> Dict:
+        results = []
+        for number in document_numbers("core", query, 0, limit):
+            result = self._pick(self.core["results"], number)
+            result["id"] = number
+            result["doi"] = f"10.5555/bench.{number}"
+            result["title"] = f"Benchmark document {number}"
+            results.append(result)
+        return {**self.core, "totalHits": len(results), "limit": limit, "results": results}
+
+    def semantic_scholar_paper(self, number: int) -> Dict:
+        paper = self._pick(self.semantic_scholar["data"], number)
+        paper["paperId"] = f"s2{number}"
+        paper["externalIds"] = {**paper["externalIds"], "DOI": f"10.5555/bench.{number}"}
+        paper["title"] = f"Benchmark document {number}"
+        return paper
+
+    def semantic_scholar_page(
+        self, query: str, offset: int, limit: int, fields: str, total: int
+    ) -> Dict:
+        numbers = document_numbers(
+            "semantic_scholar", query, offset, max(0, min(limit, total - offset))
+        )
+        if fields == "paperId":
+            data = [{"paperId": f"s2{number}"} for number in numbers]
+        else:
+            data = [self.semantic_scholar_paper(number) for number in numbers]
+        return {"total": total, "offset": offset, "data": data}
+
+    def esearch_response(self, query: str, retmax: int) -> str:
+        ids = "".join(
+            f"\n<Id>{number}</Id>" for number in document_numbers("entrez", query, 0, retmax)
+        )
+        response = re.sub(
+            r"<IdList>.*</IdList>", f"<IdList>{ids}\n</IdList>", self.esearch, flags=re.S
+        )
+        response = re.sub(r"<(Count|RetMax)>\d+<", rf"<\g<1>>{retmax}<", response)
+        # the query is kept in the history session, so efetch can rebuild the result list
+        web_env = query.encode().hex()
+        return re.sub(r"<WebEnv>[^<]*<", f"<WebEnv>{web_env}<", response)
+
+    def efetch_response(self, pmids: List[str]) -> str:
+        records = []
+        for pmid in pmids:
+            record = self._pick(self.medline, int(pmid))
+            record = re.sub(r"^PMID- \d+", f"PMID- {pmid}", record)
+            record = re.sub(
+                r"^LID - \S+ \[doi\]",
+                f"LID - 10.5555/bench.{pmid} [doi]",
+                record,
+                flags=re.M,
+            )
+            records.append(record)
+        return "\n\n".join(records) + "\n"
+
+    def wikipedia_response(self, titles: List[str], match_rate: float) -> Dict:
+        page = self.wikipedia["query"]["pages"][0]
+        pages = []
+        for title in titles:
+            if _query_seed(title) % 1000 < match_rate * 1000:
+                pages.append({**page, "title": title, "pageid": _query_seed(title)})
+            else:
+                pages.append({"ns": 0, "title": title, "missing": True})
+        return {"batchcomplete": True, "query": {"pages": pages}}
+
+
+class StubServer:
+    """Threaded HTTP server answering for all the stubbed engines.
+
+    :param profiles: latency profiles keyed by engine (cruise, core, semantic_scholar, entrez, wikipedia)
+    :param total_results: number of results available for every query (Semantic Scholar "total")
+    :param wikipedia_match_rate: share of queries with a matching Wikipedia page
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        profiles: Optional[Dict[str, LatencyProfile]] = None,
+        total_results: int = 1000,
+        wikipedia_match_rate: float = 0.3,
+        seed: int = 0,
+    ):
+        self.profiles = {**DEFAULT_PROFILES, **(profiles or {})}
+        self.total_results = total_results
+        self.wikipedia_match_rate = wikipedia_match_rate
+        self.fixtures = Fixtures()
+        self.requests: Dict[str, int] = {engine: 0 for engine in self.profiles}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environment(self, direct_elasticsearch: bool = False) -> Dict[str, str]:
+        """Environment variables which point the search engine settings to this server.
+        With direct_elasticsearch, CRUISE is searched without the search_app proxy."""
+        environment = {name: self.url + path for name, path in ENDPOINTS.items()}
+        if direct_elasticsearch:
+            environment["CRUISE_ELASTICSEARCH_URL"] = f"{self.url}/elasticsearch"
+        return environment
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def delay(self, engine: str) -> bool:
+        """Sleeps for a sampled latency, returns True if the request should fail."""
+        with self._lock:
+            self.requests[engine] += 1
+            latency, failed = self.profiles[engine].sample(self._rng)
+        time.sleep(latency)
+        return failed
+
+    def respond(self, path: str, params: Dict[str, str], body: bytes) -> Tuple[str, str, str]:
+        """Returns (engine, content type, response body) for a request."""
+        if path.startswith("/cruise/"):
+            request = json.loads(body)
+            response = self.fixtures.cruise_response(request["query"], int(request["es_top_k"]))
+            return "cruise", "application/json", json.dumps(response)
+        if path.startswith("/elasticsearch/") and path.endswith("/_search"):
+            request = json.loads(body)
+            query = request["query"]["bool"]["should"][0]["multi_match"]["query"]
+            response = self.fixtures.cruise_response(query, int(request["size"]))
+            return "cruise", "application/json", json.dumps(response["results"])
+        if path.startswith("/core/"):
+            request = json.loads(body)
+            response = self.fixtures.core_response(request["q"], int(request["limit"]))
+            return "core", "application/json", json.dumps(response)
+        if path.endswith("/paper/search"):
+            response = self.fixtures.semantic_scholar_page(
+                params["query"],
+                int(params.get("offset", 0)),
+                int(params.get("limit", 10)),
+                params.get("fields", ""),
+                self.total_results,
+            )
+            return "semantic_scholar", "application/json", json.dumps(response)
+        if path.endswith("/paper/batch"):
+            papers = [
+                self.fixtures.semantic_scholar_paper(int(paper_id[2:]))
+                for paper_id in json.loads(body)["ids"]
+            ]
+            return "semantic_scholar", "application/json", json.dumps(papers)
+        if path.endswith("/esearch.fcgi"):
+            response = self.fixtures.esearch_response(params["term"], int(params.get("retmax", 20)))
+            return "entrez", "text/xml", response
+        if path.endswith("/efetch.fcgi"):
+            if "id" in params:
+                pmids = params["id"].split(",")
+            else:
+                query = bytes.fromhex(params["webenv"]).decode()
+                start = int(params.get("retstart", 0))
+                pmids = [
+                    str(number)
+                    for number in document_numbers("entrez", query, start, int(params["retmax"]))
+                ]
+            return "entrez", "text/plain", self.fixtures.efetch_response(pmids)
+        if path.startswith("/wikipedia/"):
+            response = self.fixtures.wikipedia_response(
+                params.get("titles", "").split("|"), self.wikipedia_match_rate
+            )
+            return "wikipedia", "application/json", json.dumps(response)
+        raise KeyError(path)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if self.headers.get("Content-Type", "").startswith(
+                    "application/x-www-form-urlencoded"
+                ):
+                    params.update(
+                        (key, values[0]) for key, values in parse_qs(body.decode()).items()
+                    )
+                try:
+                    engine, content_type, response = server.respond(url.path, params, body)
+                except (KeyError, ValueError):
+                    self._send(404, "text/plain", "not found")
+                    return
+                failed = url.path.startswith("/cruise/") and server.delay("search_app")
+                if server.delay(engine) or failed:
+                    self._send(503, "text/plain", "stub error")
+                else:
+                    self._send(200, content_type, response)
+
+            def _send(self, status: int, content_type: str, body: str):
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--profile",
+        action="append",
+        default=[],
+        metavar="ENGINE=MEDIAN[,SIGMA[,ERROR_RATE]]",
+        help=f"latency profile of a stubbed engine ({', '.join(DEFAULT_PROFILES)}), "
+        "e.g. core=1.5,0.8,0.1",
+    )
+    parser.add_argument("--wikipedia_match_rate", type=float, default=0.3)
+
+
+def parse_profiles(values: List[str]) -> Dict[str, LatencyProfile]:
+    profiles = {}
+    for value in values:
+        engine, profile = value.split("=", 1)
+        if engine not in DEFAULT_PROFILES:
+            raise ValueError(f"Unknown engine {engine}, use one of {', '.join(DEFAULT_PROFILES)}")
+        profiles[engine] = LatencyProfile.parse(profile)
+    return profiles
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9900)
+    parser.add_argument(
+        "--direct_elasticsearch",
+        action="store_true",
+        help="print the environment for searching CRUISE without the search_app proxy",
+    )
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    stub_server = StubServer(
+        args.host,
+        args.port,
+        profiles=parse_profiles(args.profile),
+        wikipedia_match_rate=args.wikipedia_match_rate,
+    )
+    for name, value in stub_server.environment(args.direct_elasticsearch).items():
+        print(f"export {name}={value}")
+    print(f"Serving stub search engines on {stub_server.url}, press Ctrl+C to stop")
+    try:
+        stub_server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        stub_server.stop()
@@ -1,7 +1,8 @@
 import argparse
 import json
+import sys
 from datetime import datetime
-from os.path import join as join_path
+from os.path import abspath, dirname, join as join_path
 from time import mktime
 from concept_rate import ConceptRate
 from cso_classifier import CSOClassifier
@@ -10,6 +11,9 @@ from tqdm import tqdm
 
 import cld3
 
+sys.path.append(join_path(dirname(abspath(__file__)), "..", "..", "src", "cruise_literature"))
+from utils.display_fields import display_fields  # noqa: E402
+
 MANDATORY_FIELDS = ["abstract", "title", "year", "id"]
 OPTIONAL_FIELDS = [
     "keywords", "fos", "url", "pdf", "doi",
@@ -101,6 +105,10 @@ def extract_docs(in_path: str, out_path: str):
                 for field in OPTIONAL_FIELDS:
                     paper_dict[field] = paper[field]
 
+                # fields shown in the search results, so the search does not need to fetch
+                # the references and all keywords (recomputed by add_fields with keyword scores)
+                paper_dict["display"] = display_fields(paper_dict)
+
                 f_out.write(json.dumps(paper_dict))
                 f_out.write("\n")
 
@@ -144,6 +152,7 @@ def add_fields(in_path, out_path):
 
         for i, j in zip(papers.keys(), keywords_scored):
             papers[i]["keywords"] = j
+            papers[i]["display"] = display_fields(papers[i])
 
     open(out_path, "w").write("\n".join(json.dumps(papers[i]) for i in papers.keys()))
 
@@ -0,0 +1,192 @@
+"""Streaming bulk ingestion shared by the WSGI (search_app) and ASGI (search_app_asgi) apps.
+
+The request body is NDJSON with one document per line. Documents are grouped into
+chunks bounded in bytes and number of documents, each chunk is sent in one _bulk
+request. Documents are indexed with their `id` field as the elasticsearch _id,
+so retried documents are never indexed twice. Documents rejected with 429
+(elasticsearch queues full) are retried in a new chunk, other rejected documents
+are reported in the summary. It must not import anything outside the standard library.
+"""
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+MAX_CHUNK_BYTES = 5 * 1024 * 1024
+MAX_CHUNK_DOCS = 1000
+MAX_CONCURRENT_CHUNKS = 4
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5
+# failures listed in the summary, all of them are counted
+MAX_REPORTED_FAILURES = 100
+
+
+class BulkChunk:
+    """Documents of one _bulk request, with their line numbers in the request body."""
+
+    def __init__(self, index_name: str, attempt: int = 0):
+        self.index_name = index_name
+        self.attempt = attempt
+        self.lines: List[int] = []
+        self.ids: List[Optional[str]] = []
+        self.parts: List[bytes] = []
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def add(self, line_number: int, doc_id: Optional[str], action: bytes, source: bytes):
+        self.lines.append(line_number)
+        self.ids.append(doc_id)
+        self.parts.append(action)
+        self.parts.append(source)
+        self.size += len(action) + len(source) + 2
+
+    def body(self) -> bytes:
+        return b"\n".join(self.parts) + b"\n"
+
+    def retry_delay(self) -> float:
+        return RETRY_BACKOFF * 2 ** (self.attempt - 1) if self.attempt else 0.0
+
+
+class BulkSummary:
+    def __init__(self, index_name: str):
+        self.index_name = index_name
+        self.start = time.monotonic()
+        self.documents = 0
+        self.indexed = 0
+        self.retried = 0
+        self.chunks = 0
+        self.failed = 0
+        self.failures: List[Dict[str, Any]] = []
+
+    def fail(self, line: int, doc_id: Optional[str], status: int, error: Any):
+        self.failed += 1
+        if len(self.failures) < MAX_REPORTED_FAILURES:
+            self.failures.append(
+                {"line": line, "id": doc_id, "status": status, "error": error}
+            )
+
+    def fail_chunk(self, chunk: BulkChunk, status: int, error: Any):
+        """Records all documents of a chunk which could not be sent as failed."""
+        self.chunks += 1
+        for line, doc_id in zip(chunk.lines, chunk.ids):
+            self.fail(line, doc_id, status, error)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "status": "OK" if not self.failed else "PARTIAL",
+            "index_name": self.index_name,
+            "documents": self.documents,
+            "indexed": self.indexed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "chunks": self.chunks,
+            "took": round(time.monotonic() - self.start, 3),
+            "failures": self.failures,
+        }
+
+
+class LineSplitter:
+    """Splits a body read in blocks into lines, without the line breaks."""
+
+    def __init__(self):
+        self._rest = b""
+
+    def feed(self, block: bytes) -> List[bytes]:
+        lines = (self._rest + block).split(b"\n")
+        self._rest = lines.pop()
+        return lines
+
+    def close(self) -> List[bytes]:
+        """Returns the last line, if the body does not end with a line break."""
+        rest, self._rest = self._rest, b""
+        return [rest] if rest else []
+
+
+class BulkChunker:
+    """Groups the documents of a NDJSON body into chunks.
+    Lines which are not JSON objects are counted as failures, empty lines are skipped."""
+
+    def __init__(
+        self,
+        summary: BulkSummary,
+        max_bytes: int = MAX_CHUNK_BYTES,
+        max_docs: int = MAX_CHUNK_DOCS,
+        id_field: str = "id",
+    ):
+        self.summary = summary
+        self.max_bytes = max_bytes
+        self.max_docs = max_docs
+        self.id_field = id_field
+        self.line_number = 0
+        self._chunk = BulkChunk(summary.index_name)
+
+    def add_line(self, line: bytes) -> Optional[BulkChunk]:
+        """Adds a document, returns a chunk when it is full."""
+        self.line_number += 1
+        line = line.strip()
+        if not line:
+            return None
+        self.summary.documents += 1
+        try:
+            document = json.loads(line)
+            if not isinstance(document, dict):
+                raise ValueError("not an object")
+        except ValueError as e:
+            self.summary.fail(self.line_number, None, 400, f"invalid JSON: {e}")
+            return None
+        doc_id = document.get(self.id_field)
+        action = {"index": {} if doc_id is None else {"_id": str(doc_id)}}
+        full = None
+        if self._chunk and (
+            self._chunk.size + len(line) > self.max_bytes
+            or len(self._chunk) >= self.max_docs
+        ):
+            full = self.flush()
+        self._chunk.add(
+            self.line_number,
+            None if doc_id is None else str(doc_id),
+            json.dumps(action).encode(),
+            line,
+        )
+        return full
+
+    def flush(self) -> Optional[BulkChunk]:
+        """Returns the chunk being filled, if it has any documents."""
+        if not self._chunk:
+            return None
+        chunk, self._chunk = self._chunk, BulkChunk(self.summary.index_name)
+        return chunk
+
+
+def apply_bulk_response(
+    chunk: BulkChunk, status_code: int, content: bytes, summary: BulkSummary
+) -> Optional[BulkChunk]:
+    """Records the outcome of a _bulk request in the summary.
+    Returns the chunk of the documents to retry, or None."""
+    summary.chunks += 1
+    try:
+        response = json.loads(content)
+    except ValueError:
+        response = None
+    if status_code < 300 and isinstance(response, dict) and "items" in response:
+        statuses = [
+            (item[action]["status"], item[action].get("error"))
+            for item in response["items"]
+            for action in item
+        ]
+    else:
+        # the whole request was rejected
+        error = response if response is not None else content[:500].decode(errors="replace")
+        statuses = [(status_code, error)] * len(chunk)
+
+    retry = BulkChunk(chunk.index_name, attempt=chunk.attempt + 1)
+    for i, (status, error) in enumerate(statuses):
+        if status < 300:
+            summary.indexed += 1
+        elif status == 429 and chunk.attempt < MAX_RETRIES:
+            retry.add(chunk.lines[i], chunk.ids[i], chunk.parts[2 * i], chunk.parts[2 * i + 1])
+        else:
+            summary.fail(chunk.lines[i], chunk.ids[i], status, error)
+    summary.retried += len(retry)
+    return retry if retry else None
@@ -0,0 +1,71 @@
+"""Configuration and elasticsearch index definitions shared by the WSGI (search_app)
+and ASGI (search_app_asgi) apps. It must not import anything outside the standard library."""
+import json
+import os
+from typing import Any, Dict, List
+
+# the path can be changed with the SEARCH_APP_CONFIG environment variable, e.g. for benchmarks
+CONFIG_PATH = os.environ.get("SEARCH_APP_CONFIG", "/config/search_app_config.json")
+
+# mapping of the indices created by add_docs, the keyword scores and display fields
+# are only stored in the documents, not indexed
+DOCS_INDEX_MAPPING = {
+    "mappings": {
+        "properties": {
+            "keywords": {"type": "object", "enabled": "false"},
+            "CSO_keywords": {"type": "object", "enabled": "false"},
+            "display": {"type": "object", "enabled": "false"},
+        }
+    }
+}
+
+# index created by create_index
+RANKING_INDEX_CONFIG = {
+    "mappings": {
+        "properties": {
+            "id": {"type": "text"},
+            "contents": {
+                "type": "text",
+                "analyzer": "whitespace",
+                "similarity": "ranking_function",
+            },
+        }
+    },
+    "settings": {
+        "number_of_shards": 1,
+        "index": {
+            "similarity": {"ranking_function": {"type": "BM25", "b": 0.75, "k1": 1.2}}
+        },
+    },
+}
+
+CAT_INDICES_COLUMNS = [
+    "health",
+    "status",
+    "index",
+    "uuid",
+    "pri",
+    "rep",
+    "docs_count",
+    "docs_deleted",
+    "store_size",
+    "pri_store_size",
+]
+
+
+def load_config(path: str = CONFIG_PATH) -> Dict[str, Any]:
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
+def parse_cat_indices(response_content: str) -> List[Dict[str, str]]:
+    """Parses the response of _cat/indices?v into a dict per index."""
+    lines = response_content.split("\n")[1:]  # remove header row
+    return [
+        dict(zip(CAT_INDICES_COLUMNS, line.split())) for line in lines if line.strip()
+    ]
+
+
+def index_names(response_content: str) -> List[str]:
+    """Returns the names of the indices listed in the response of _cat/indices?v."""
+    return [index["index"] for index in parse_cat_indices(response_content)]
@@ -0,0 +1,161 @@
+"""Elasticsearch query of the CRUISE search.
+
+Used by search_app and by the CRUISE engine of the Django app when it queries
+elasticsearch directly (CRUISE_ELASTICSEARCH_URL setting), so both send the same query.
+It must not import anything outside the standard library.
+"""
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+# fields of the documents returned by the search, the results page needs only the display
+# fields precomputed at index time, not the references and keywords (see scripts/add_docs.py)
+SOURCE_INCLUDES = [
+    "title",
+    "abstract",
+    "authors.name",
+    "year",
+    "pdf",
+    "doi",
+    "CSO_keywords.union",
+    "display",
+]
+
+
+def build_filters(filters: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Returns the filter clauses of the filters, keyed by document field:
+    a dict is a range (e.g. {"year": {"gte": 2015}}), a list matches any of its values,
+    other values match exactly."""
+    clauses = []
+    for field, value in filters.items():
+        if isinstance(value, dict):
+            clauses.append({"range": {field: value}})
+        elif isinstance(value, list):
+            clauses.append({"terms": {field: value}})
+        else:
+            clauses.append({"term": {field: value}})
+    return clauses
+
+
+def build_query(
+    query_text: str,
+    top_k: int,
+    source_includes: Optional[List[str]] = SOURCE_INCLUDES,
+    filters: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Returns the search request of the query.
+    With source_includes None, the whole documents are returned (for indices without display fields).
+    Filters restrict the results without changing their scores, see build_filters.
+    Highlights are not requested, query terms are highlighted by the Django app (QueryHighlighter)."""
+    query = {
+        "size": top_k,
+        "query": {
+            "bool": {
+                "should": [
+                    {
+                        "multi_match": {
+                            "query": query_text,
+                            "fields": ["title", "abstract", "authors.name"],
+                        }
+                    }
+                ],
+                # required, with filter clauses a should clause alone is optional
+                "minimum_should_match": 1,
+                "boost": 1.0,
+            }
+        },
+    }
+    if filters:
+        query["query"]["bool"]["filter"] = build_filters(filters)
+    if source_includes is not None:
+        query["_source"] = {"includes": source_includes}
+    return query
+
+
+def build_msearch(
+    index_name: str,
+    searches: List[Dict[str, Any]],
+    source_includes: Optional[List[str]] = SOURCE_INCLUDES,
+) -> Tuple[str, List[Dict[str, Any]]]:
+    """Returns the NDJSON body of the _msearch request running all the searches in one
+    round trip, and the query of each search. Searches are dicts with the "query",
+    "es_top_k" and optional "filters" keys, like the requests of the search endpoint."""
+    header = json.dumps({"index": index_name})
+    queries = [
+        build_query(
+            query_text=search["query"],
+            top_k=int(search["es_top_k"]),
+            source_includes=source_includes,
+            filters=search.get("filters"),
+        )
+        for search in searches
+    ]
+    lines = []
+    for query in queries:
+        lines.append(header)
+        lines.append(json.dumps(query))
+    return "\n".join(lines) + "\n", queries
+
+
+# pages of a deep search are sorted by score, ties are broken by the position of the document
+# in its shard, which is unique and stable within a point in time
+DEEP_SEARCH_SORT = [{"_score": "desc"}, {"_shard_doc": "asc"}]
+PIT_KEEP_ALIVE = "1m"
+DEEP_SEARCH_PAGE_SIZE = 500
+# index.max_result_window of elasticsearch
+MAX_PAGE_SIZE = 10000
+
+
+class DeepSearchCursor:
+    """Retrieves the top_k hits of a query in pages, with a point in time of the index and
+    search_after, so top_k is not limited by the result window and each page is small.
+
+    Open a point in time of the index (POST /<index>/_pit?keep_alive=PIT_KEEP_ALIVE),
+    send next_query() to /_search (without the index) and pass each response to advance()
+    until next_query() returns None, then delete the point in time (DELETE /_pit).
+    """
+
+    def __init__(
+        self,
+        query_text: str,
+        top_k: int,
+        pit_id: str,
+        page_size: int = DEEP_SEARCH_PAGE_SIZE,
+        source_includes: Optional[List[str]] = SOURCE_INCLUDES,
+        filters: Optional[Dict[str, Any]] = None,
+    ):
+        self.query_text = query_text
+        self.remaining = top_k
+        self.pit_id = pit_id
+        self.page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        self.source_includes = source_includes
+        self.filters = filters
+        self.search_after: Optional[List[Any]] = None
+        self.done = top_k <= 0
+        self._size = 0
+
+    def next_query(self) -> Optional[Dict[str, Any]]:
+        """Returns the search request of the next page, or None when all hits are retrieved."""
+        if self.done:
+            return None
+        self._size = min(self.page_size, self.remaining)
+        query = build_query(
+            self.query_text, self._size, source_includes=self.source_includes, filters=self.filters
+        )
+        query["pit"] = {"id": self.pit_id, "keep_alive": PIT_KEEP_ALIVE}
+        query["sort"] = DEEP_SEARCH_SORT
+        query["track_total_hits"] = False
+        if self.search_after is not None:
+            query["search_after"] = self.search_after
+        return query
+
+    def advance(self, response: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Moves the cursor after the page of the response, returns the hits of the page."""
+        hits = response["hits"]["hits"]
+        # the id of the point in time can change between the pages
+        self.pit_id = response.get("pit_id", self.pit_id)
+        self.remaining -= len(hits)
+        if len(hits) < self._size or self.remaining <= 0:
+            self.done = True
+        else:
+            self.search_after = hits[-1]["sort"]
+        return hits
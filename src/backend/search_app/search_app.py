@@ -1,9 +1,40 @@
 import json
 import logging
-from typing import Dict
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, Optional, Set
 
 import requests
-from flask import Flask, request, render_template
+from flask import Flask, Response, request, render_template
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bulk import (
+    MAX_CHUNK_BYTES,
+    MAX_CHUNK_DOCS,
+    MAX_CONCURRENT_CHUNKS,
+    BulkChunk,
+    BulkChunker,
+    BulkSummary,
+    LineSplitter,
+    apply_bulk_response,
+)
+from common import (
+    DOCS_INDEX_MAPPING,
+    RANKING_INDEX_CONFIG,
+    index_names,
+    load_config,
+    parse_cat_indices,
+)
+from query_builder import (
+    DEEP_SEARCH_PAGE_SIZE,
+    PIT_KEEP_ALIVE,
+    SOURCE_INCLUDES as DEFAULT_SOURCE_INCLUDES,
+    DeepSearchCursor,
+    build_msearch,
+    build_query,
+)
 
 app = Flask(__name__)
 
@@ -11,10 +42,7 @@ app = Flask(__name__)
 ### CONFIG
 ##########################################################
 
-CONFIG_PATH = "/config/search_app_config.json"
-
-with open(CONFIG_PATH, "r") as fp:
-    config = json.load(fp)
+config = load_config()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,38 +50,40 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()],
 )
 
+# keep-alive connections to elasticsearch shared by all requests of the worker,
+# only idempotent requests are retried
+es_session = requests.Session()
+es_session.headers["Accept-Encoding"] = "gzip, deflate"
+_es_adapter = HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=config.get("es_pool_maxsize", 16),
+    max_retries=Retry(
+        total=config.get("es_max_retries", 2),
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    ),
+)
+es_session.mount("http://", _es_adapter)
+es_session.mount("https://", _es_adapter)
 
-def build_query(query_text: str, top_k: int):
-    """"""
-    return {
-        "size": top_k,
-        "query": {
-            "bool": {
-                "should": [
-                    {
-                        "multi_match": {
-                            "query": query_text,
-                            "fields": ["title", "abstract", "authors.name"],
-                        }
-                    }
-                ],
-                "minimum_should_match": 0,
-                "boost": 1.0,
-            }
-        },
-        "highlight": {"fields": {"abstract": {}, "title": {}, "authors.name": {}}},
-    }
+
+# with es_source_includes set to null in the config, the whole documents are returned
+# (for indices without the display fields)
+SOURCE_INCLUDES = config.get("es_source_includes", DEFAULT_SOURCE_INCLUDES)
 
 
-def search_es(query: str, index_name: str, top_k: int):
+def search_es(query: str, index_name: str, top_k: int, filters: Optional[Dict] = None):
     host = config["host"]
     # use the query builder to create the elastic search json query object
-    query_data = build_query(query_text=query, top_k=top_k)
+    query_data = build_query(
+        query_text=query, top_k=top_k, source_includes=SOURCE_INCLUDES, filters=filters
+    )
     data_json = json.dumps(query_data)
     headers = {
         "Content-type": "application/json",
     }
-    r = requests.post(
+    r = es_session.post(
         f"{host}/" + ",".join([index_name]) + "/_search",
         data=data_json,
         headers=headers,
@@ -69,19 +99,82 @@ def search() -> Dict[str, str]:
         query = in_data["query"]
         es_index = in_data["es_index"]
         es_top_k = int(in_data["es_top_k"])
-        results, query_data = search_es(query, index_name=es_index, top_k=es_top_k)
+        results, query_data = search_es(
+            query, index_name=es_index, top_k=es_top_k, filters=in_data.get("filters")
+        )
     else:
         results = "Only POST allowed"
         query_data = {}
     return {"results": results, "query": query_data}
 
 
+@app.route("/api/v1/msearch", methods=["POST"])
+def msearch() -> Dict[str, str]:
+    """Runs several searches in one _msearch request to elasticsearch.
+    The results contain the responses of the searches, in the order of the searches.
+    A failed search has an "error" instead of hits, the other searches are not affected."""
+    in_data = request.get_json()
+    body, queries = build_msearch(
+        in_data["es_index"], in_data["searches"], source_includes=SOURCE_INCLUDES
+    )
+    r = es_session.post(
+        f"{config['host']}/_msearch",
+        data=body,
+        headers={"Content-type": "application/x-ndjson"},
+    )
+    return {"results": r.json(), "queries": queries}
+
+
+@app.route("/api/v1/search_stream", methods=["POST"])
+def search_stream():
+    """Retrieves the top_k hits of a query page by page, with a point in time and search_after,
+    and streams the pages as NDJSON while they are retrieved: a {"hits": [...]} line per page,
+    then {"done": true, "total": <hits>}, or {"error": ..., "status": ...} if a page failed.
+    Input: like /search, with an optional page_size."""
+    in_data = request.get_json()
+    host = config["host"]
+    r = es_session.post(
+        f"{host}/{in_data['es_index']}/_pit", params={"keep_alive": PIT_KEEP_ALIVE}
+    )
+    if r.status_code != 200:
+        return {"status": "ERROR", "message": r.text}, r.status_code
+    cursor = DeepSearchCursor(
+        query_text=in_data["query"],
+        top_k=int(in_data["es_top_k"]),
+        pit_id=r.json()["id"],
+        page_size=int(in_data.get("page_size", DEEP_SEARCH_PAGE_SIZE)),
+        source_includes=SOURCE_INCLUDES,
+        filters=in_data.get("filters"),
+    )
+
+    def pages():
+        total = 0
+        try:
+            while (query_data := cursor.next_query()) is not None:
+                r = es_session.post(
+                    f"{host}/_search",
+                    data=json.dumps(query_data),
+                    headers={"Content-type": "application/json"},
+                )
+                if r.status_code != 200:
+                    yield json.dumps({"error": r.text, "status": r.status_code}) + "\n"
+                    return
+                hits = cursor.advance(r.json())
+                total += len(hits)
+                yield json.dumps({"hits": hits}) + "\n"
+            yield json.dumps({"done": True, "total": total}) + "\n"
+        finally:
+            es_session.delete(f"{host}/_pit", json={"id": cursor.pit_id})
+
+    return Response(pages(), mimetype="application/x-ndjson")
+
+
 @app.route("/api/v1/status", methods=["GET"])
 def status() -> Dict[str, str]:
     """Return the status of the API and underlying elasticsearch."""
     host = config["host"]
     try:
-        r = requests.get(f"{host}/_cat/health")
+        r = es_session.get(f"{host}/_cat/health")
     except requests.exceptions.ConnectionError:
         return {"status": "ERROR", "message": "Connection error to ElasticSearch"}
     return {"status": "OK", "message": r.text}
@@ -89,34 +182,12 @@ def status() -> Dict[str, str]:
 
 @app.route("/api/v1/indices", methods=["GET"])
 def indices() -> Dict[str, str]:
-    def _convert_response_to_json(response_content: str):
-        lines = response_content.split("\n")
-        lines = lines[1:]  # remove header row
-        lines = [line for line in lines if line]  # remove empty lines
-        _indices_status = []
-        for line in lines:
-            fields = line.split()
-            index = {
-                "health": fields[0],
-                "status": fields[1],
-                "index": fields[2],
-                "uuid": fields[3],
-                "pri": fields[4],
-                "rep": fields[5],
-                "docs_count": fields[6],
-                "docs_deleted": fields[7],
-                "store_size": fields[8],
-                "pri_store_size": fields[9],
-            }
-            _indices_status.append(index)
-        return _indices_status
-
     if request.method == "GET":
         host = config["host"]
-        r = requests.get(f"{host}/_cat/indices?v")
+        r = es_session.get(f"{host}/_cat/indices?v")
         return {
             "status": "OK",
-            "indices": _convert_response_to_json(r.content.decode()),
+            "indices": parse_cat_indices(r.content.decode()),
         }
     else:
         return {"status": "ERROR", "message": "Only GET allowed"}
@@ -132,22 +203,12 @@ def add_docs() -> Dict[str, str]:
         index_name = in_data["index_name"]
 
         # check if index exists
-        r = requests.get(f"{host}/_cat/indices?v")
-        indices = r.content.decode().split("\n")
-        indices = [i.split()[2] for i in indices[1:-1]]
-        if index_name not in indices:
-            mapping = {
-                "mappings": {
-                    "properties": {
-                        "keywords": {"type": "object", "enabled": "false"},
-                        "CSO_keywords": {"type": "object", "enabled": "false"},
-                    }
-                }
-            }
-            r = requests.put(f"{host}/{index_name}", json=mapping)
-            logging.info(f"Created index {index_name} with mapping {mapping}")
-
-        r = requests.post(
+        r = es_session.get(f"{host}/_cat/indices?v")
+        if index_name not in index_names(r.content.decode()):
+            r = es_session.put(f"{host}/{index_name}", json=DOCS_INDEX_MAPPING)
+            logging.info(f"Created index {index_name} with mapping {DOCS_INDEX_MAPPING}")
+
+        r = es_session.post(
             f"{host}/{index_name}/_bulk",
             data=docs,
             headers={"Content-Type": "application/json"},
@@ -157,6 +218,93 @@ def add_docs() -> Dict[str, str]:
         return {"status": "ERROR", "message": "Only POST allowed"}
 
 
+BULK_MAX_CHUNK_BYTES = config.get("bulk_max_chunk_bytes", MAX_CHUNK_BYTES)
+BULK_MAX_CHUNK_DOCS = config.get("bulk_max_chunk_docs", MAX_CHUNK_DOCS)
+BULK_MAX_CONCURRENT_CHUNKS = config.get("bulk_max_concurrent_chunks", MAX_CONCURRENT_CHUNKS)
+# indices created or found by ingest, they are not checked again
+known_indices: Set[str] = set()
+
+
+def _ensure_index(index_name: str) -> Optional[requests.Response]:
+    """Creates the index, unless it exists. Returns the response of a failed index creation."""
+    if index_name in known_indices:
+        return None
+    host = config["host"]
+    if es_session.head(f"{host}/{index_name}").status_code != 200:
+        r = es_session.put(f"{host}/{index_name}", json=DOCS_INDEX_MAPPING)
+        if r.status_code >= 300:
+            logging.error(f"Creating index {index_name} failed: {r.text}")
+            return r
+        logging.info(f"Created index {index_name} with mapping {DOCS_INDEX_MAPPING}")
+    known_indices.add(index_name)
+    return None
+
+
+@app.route("/api/v1/ingest", methods=["POST"])
+def ingest() -> Dict[str, str]:
+    """Indexes the documents of a NDJSON body (one document per line) streamed in the request.
+    Chunks of documents are sent to elasticsearch by BULK_MAX_CONCURRENT_CHUNKS threads,
+    while the body is read, so the body is never buffered in memory (see bulk.py).
+
+    Query params: index_name, id_field (the document field used as _id, "id" by default).
+    Returns a summary of the ingestion with the failed documents, or an error when
+    the index does not exist and cannot be created.
+    """
+    index_name = request.args["index_name"]
+    failed = _ensure_index(index_name)
+    if failed is not None:
+        return {"status": "ERROR", "message": failed.text}, failed.status_code
+    host = config["host"]
+    summary = BulkSummary(index_name)
+    summary_lock = threading.Lock()
+    chunker = BulkChunker(
+        summary,
+        max_bytes=BULK_MAX_CHUNK_BYTES,
+        max_docs=BULK_MAX_CHUNK_DOCS,
+        id_field=request.args.get("id_field", "id"),
+    )
+
+    def send(chunk: Optional[BulkChunk]):
+        while chunk is not None:
+            time.sleep(chunk.retry_delay())
+            try:
+                r = es_session.post(
+                    f"{host}/{index_name}/_bulk",
+                    data=chunk.body(),
+                    headers={"Content-Type": "application/x-ndjson"},
+                )
+            except requests.exceptions.RequestException as e:
+                with summary_lock:
+                    summary.fail_chunk(chunk, 503, repr(e))
+                return
+            with summary_lock:
+                chunk = apply_bulk_response(chunk, r.status_code, r.content, summary)
+
+    in_flight: Set[Future] = set()
+
+    def submit(chunk: Optional[BulkChunk]):
+        if chunk is None:
+            return
+        if len(in_flight) >= BULK_MAX_CONCURRENT_CHUNKS:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            in_flight.difference_update(done)
+        in_flight.add(executor.submit(send, chunk))
+
+    splitter = LineSplitter()
+    with ThreadPoolExecutor(max_workers=BULK_MAX_CONCURRENT_CHUNKS) as executor:
+        while block := request.stream.read(64 * 1024):
+            with summary_lock:
+                chunks = [chunker.add_line(line) for line in splitter.feed(block)]
+            for chunk in chunks:
+                submit(chunk)
+        with summary_lock:
+            chunks = [chunker.add_line(line) for line in splitter.close()]
+            chunks.append(chunker.flush())
+        for chunk in chunks:
+            submit(chunk)
+    return summary.as_dict()
+
+
 @app.route("/api/v1/create_index", methods=["POST"])
 def create_index() -> Dict[str, str]:
     """Check if index exist with a provided index_name.
@@ -166,35 +314,12 @@ def create_index() -> Dict[str, str]:
     in_data = request.get_json()
     index_name = in_data["index_name"]
 
-    index_config = {
-        "mappings": {
-            "properties": {
-                "id": {"type": "text"},
-                "contents": {
-                    "type": "text",
-                    "analyzer": "whitespace",
-                    "similarity": "ranking_function",
-                },
-            }
-        },
-        "settings": {
-            "number_of_shards": 1,
-            "index": {
-                "similarity": {
-                    "ranking_function": {"type": "BM25", "b": 0.75, "k1": 1.2}
-                }
-            },
-        },
-    }
     host = config["host"]
 
-    r = requests.get(f"{host}/_cat/indices?v")
-    indices = r.content.decode().split("\n")
-    indices = [i.split()[2] for i in indices[1:-1]]
-
-    if index_name not in indices:
-        r = requests.put(f"{host}/{index_name}", json=index_config)
-        logging.info(f"Created index {index_name} with mapping {index_config}")
+    r = es_session.get(f"{host}/_cat/indices?v")
+    if index_name not in index_names(r.content.decode()):
+        r = es_session.put(f"{host}/{index_name}", json=RANKING_INDEX_CONFIG)
+        logging.info(f"Created index {index_name} with mapping {RANKING_INDEX_CONFIG}")
         return {"status": "OK", "message": r.text}
 
     logging.warning(f"Index {index_name} already exists")
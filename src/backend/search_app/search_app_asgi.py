@@ -0,0 +1,347 @@
+"""ASGI serving mode of the search API, with the same routes and responses as search_app.
+
+Requests to elasticsearch are sent with a pooled async HTTP client, so a single
+worker serves many searches at a time. At most `es_max_concurrency` requests
+are sent to elasticsearch at once, further requests wait for a free slot for at
+most `es_queue_timeout` seconds and are answered with 503 otherwise.
+Search responses of elasticsearch are passed through without decoding them.
+Documents can be streamed to /api/v1/ingest, see bulk.py.
+
+    $ uvicorn search_app_asgi:app --host 0.0.0.0 --port 8880 --workers 4
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+from typing import Any, Dict, Optional, Set
+
+import httpx
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from bulk import (
+    MAX_CHUNK_BYTES,
+    MAX_CHUNK_DOCS,
+    MAX_CONCURRENT_CHUNKS,
+    BulkChunk,
+    BulkChunker,
+    BulkSummary,
+    LineSplitter,
+    apply_bulk_response,
+)
+from common import (
+    DOCS_INDEX_MAPPING,
+    RANKING_INDEX_CONFIG,
+    load_config,
+    parse_cat_indices,
+)
+from query_builder import (
+    DEEP_SEARCH_PAGE_SIZE,
+    PIT_KEEP_ALIVE,
+    SOURCE_INCLUDES as DEFAULT_SOURCE_INCLUDES,
+    DeepSearchCursor,
+    build_msearch,
+    build_query,
+)
+
+config = load_config()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+# httpx logs every request at INFO level
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+SOURCE_INCLUDES = config.get("es_source_includes", DEFAULT_SOURCE_INCLUDES)
+POOL_MAXSIZE = config.get("es_pool_maxsize", 16)
+MAX_CONCURRENCY = config.get("es_max_concurrency", 64)
+QUEUE_TIMEOUT = config.get("es_queue_timeout", 10.0)
+# no timeout by default, as the gunicorn timeout of the WSGI app is 600 seconds
+ES_TIMEOUT = config.get("es_timeout")
+
+BULK_MAX_CHUNK_BYTES = config.get("bulk_max_chunk_bytes", MAX_CHUNK_BYTES)
+BULK_MAX_CHUNK_DOCS = config.get("bulk_max_chunk_docs", MAX_CHUNK_DOCS)
+BULK_MAX_CONCURRENT_CHUNKS = config.get("bulk_max_concurrent_chunks", MAX_CONCURRENT_CHUNKS)
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+
+class Overloaded(Exception):
+    """No elasticsearch slot became free in time."""
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    app.state.es = httpx.AsyncClient(
+        base_url=config["host"],
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENCY, max_keepalive_connections=POOL_MAXSIZE
+        ),
+        # connection errors are retried, like in the WSGI app
+        transport=httpx.AsyncHTTPTransport(retries=config.get("es_max_retries", 2)),
+        timeout=ES_TIMEOUT,
+    )
+    app.state.es_slots = asyncio.Semaphore(MAX_CONCURRENCY)
+    app.state.known_indices = set()
+    logging.info("API running...")
+    try:
+        yield
+    finally:
+        await app.state.es.aclose()
+
+
+async def es_request(request: Request, method: str, url: str, **kwargs) -> httpx.Response:
+    """Sends a request to elasticsearch once a concurrency slot is free."""
+    slots: asyncio.Semaphore = request.app.state.es_slots
+    try:
+        await asyncio.wait_for(slots.acquire(), timeout=QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise Overloaded
+    try:
+        return await request.app.state.es.request(method, url, **kwargs)
+    finally:
+        slots.release()
+
+
+async def overloaded(request: Request, exc: Overloaded) -> JSONResponse:
+    return JSONResponse(
+        {"status": "ERROR", "message": "Too many concurrent requests"},
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
+
+
+async def search(request: Request) -> Response:
+    in_data = await request.json()
+    query_data = build_query(
+        query_text=in_data["query"],
+        top_k=int(in_data["es_top_k"]),
+        source_includes=SOURCE_INCLUDES,
+        filters=in_data.get("filters"),
+    )
+    r = await es_request(
+        request,
+        "POST",
+        f"/{in_data['es_index']}/_search",
+        content=json.dumps(query_data),
+        headers={"Content-type": "application/json"},
+    )
+    # same body as {"results": r.json(), "query": query_data}, without decoding the results
+    body = b"".join(
+        [b'{"results": ', r.content, b', "query": ', json.dumps(query_data).encode(), b"}"]
+    )
+    return Response(body, media_type="application/json")
+
+
+async def msearch(request: Request) -> Response:
+    """Runs several searches in one _msearch request to elasticsearch, see search_app.msearch."""
+    in_data = await request.json()
+    msearch_body, queries = build_msearch(
+        in_data["es_index"], in_data["searches"], source_includes=SOURCE_INCLUDES
+    )
+    r = await es_request(
+        request,
+        "POST",
+        "/_msearch",
+        content=msearch_body,
+        headers={"Content-type": "application/x-ndjson"},
+    )
+    body = b"".join(
+        [b'{"results": ', r.content, b', "queries": ', json.dumps(queries).encode(), b"}"]
+    )
+    return Response(body, media_type="application/json")
+
+
+async def search_stream(request: Request) -> Response:
+    """Streams the pages of a deep search as NDJSON, see search_app.search_stream.
+    Each page takes an elasticsearch slot only while it is retrieved."""
+    in_data = await request.json()
+    r = await es_request(
+        request, "POST", f"/{in_data['es_index']}/_pit", params={"keep_alive": PIT_KEEP_ALIVE}
+    )
+    if r.status_code != 200:
+        return JSONResponse({"status": "ERROR", "message": r.text}, status_code=r.status_code)
+    cursor = DeepSearchCursor(
+        query_text=in_data["query"],
+        top_k=int(in_data["es_top_k"]),
+        pit_id=r.json()["id"],
+        page_size=int(in_data.get("page_size", DEEP_SEARCH_PAGE_SIZE)),
+        source_includes=SOURCE_INCLUDES,
+        filters=in_data.get("filters"),
+    )
+
+    async def pages():
+        total = 0
+        try:
+            while (query_data := cursor.next_query()) is not None:
+                try:
+                    r = await es_request(
+                        request,
+                        "POST",
+                        "/_search",
+                        content=json.dumps(query_data),
+                        headers={"Content-type": "application/json"},
+                    )
+                except (httpx.HTTPError, Overloaded) as e:
+                    yield json.dumps({"error": repr(e), "status": 503}) + "\n"
+                    return
+                if r.status_code != 200:
+                    yield json.dumps({"error": r.text, "status": r.status_code}) + "\n"
+                    return
+                hits = cursor.advance(r.json())
+                total += len(hits)
+                yield json.dumps({"hits": hits}) + "\n"
+            yield json.dumps({"done": True, "total": total}) + "\n"
+        finally:
+            # sent without waiting for a slot, so the point in time is released when overloaded
+            await request.app.state.es.request("DELETE", "/_pit", json={"id": cursor.pit_id})
+
+    return StreamingResponse(pages(), media_type="application/x-ndjson")
+
+
+async def status(request: Request) -> JSONResponse:
+    """Return the status of the API and underlying elasticsearch."""
+    try:
+        r = await es_request(request, "GET", "/_cat/health")
+    except httpx.ConnectError:
+        return JSONResponse(
+            {"status": "ERROR", "message": "Connection error to ElasticSearch"}
+        )
+    return JSONResponse({"status": "OK", "message": r.text})
+
+
+async def indices(request: Request) -> JSONResponse:
+    r = await es_request(request, "GET", "/_cat/indices?v")
+    return JSONResponse({"status": "OK", "indices": parse_cat_indices(r.text)})
+
+
+async def _create_index_if_missing(
+    request: Request, index_name: str, index_config: Dict[str, Any]
+) -> Optional[httpx.Response]:
+    """Creates the index, unless it exists. Returns the response of the index creation.
+    Indices known to exist are not checked again."""
+    known_indices: Set[str] = request.app.state.known_indices
+    if index_name in known_indices:
+        return None
+    r = await es_request(request, "HEAD", f"/{index_name}")
+    if r.status_code == 200:
+        known_indices.add(index_name)
+        return None
+    r = await es_request(request, "PUT", f"/{index_name}", json=index_config)
+    if r.status_code >= 300:
+        logging.error(f"Creating index {index_name} failed: {r.text}")
+        return r
+    logging.info(f"Created index {index_name} with mapping {index_config}")
+    known_indices.add(index_name)
+    return r
+
+
+async def add_docs(request: Request) -> JSONResponse:
+    in_data = await request.json()
+    index_name = in_data["index_name"]
+    await _create_index_if_missing(request, index_name, DOCS_INDEX_MAPPING)
+    r = await es_request(
+        request,
+        "POST",
+        f"/{index_name}/_bulk",
+        content=in_data["docs"],
+        headers={"Content-Type": "application/json"},
+    )
+    return JSONResponse({"status": "OK", "message": r.text})
+
+
+async def ingest(request: Request) -> JSONResponse:
+    """Indexes the documents of a NDJSON body (one document per line) streamed in the request.
+    Chunks of documents are sent to elasticsearch concurrently, while the body is read.
+    When BULK_MAX_CONCURRENT_CHUNKS chunks are in flight, reading the body waits for
+    one of them, so the body is never buffered in memory.
+
+    Query params: index_name, id_field (the document field used as _id, "id" by default).
+    Returns a summary of the ingestion with the failed documents, or an error when
+    the index does not exist and cannot be created.
+    """
+    index_name = request.query_params["index_name"]
+    r = await _create_index_if_missing(request, index_name, DOCS_INDEX_MAPPING)
+    if r is not None and r.status_code >= 300:
+        return JSONResponse({"status": "ERROR", "message": r.text}, status_code=r.status_code)
+    summary = BulkSummary(index_name)
+    chunker = BulkChunker(
+        summary,
+        max_bytes=BULK_MAX_CHUNK_BYTES,
+        max_docs=BULK_MAX_CHUNK_DOCS,
+        id_field=request.query_params.get("id_field", "id"),
+    )
+    in_flight: Set[asyncio.Task] = set()
+
+    async def send(chunk: Optional[BulkChunk]):
+        while chunk is not None:
+            await asyncio.sleep(chunk.retry_delay())
+            try:
+                r = await es_request(
+                    request,
+                    "POST",
+                    f"/{index_name}/_bulk",
+                    content=chunk.body(),
+                    headers={"Content-Type": "application/x-ndjson"},
+                )
+            except (httpx.HTTPError, Overloaded) as e:
+                summary.fail_chunk(chunk, 503, repr(e))
+                return
+            chunk = apply_bulk_response(chunk, r.status_code, r.content, summary)
+
+    async def submit(chunk: Optional[BulkChunk]):
+        if chunk is None:
+            return
+        if len(in_flight) >= BULK_MAX_CONCURRENT_CHUNKS:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            in_flight.difference_update(done)
+        in_flight.add(asyncio.create_task(send(chunk)))
+
+    splitter = LineSplitter()
+    async for block in request.stream():
+        for line in splitter.feed(block):
+            await submit(chunker.add_line(line))
+    for line in splitter.close():
+        await submit(chunker.add_line(line))
+    await submit(chunker.flush())
+    if in_flight:
+        await asyncio.wait(in_flight)
+    return JSONResponse(summary.as_dict())
+
+
+async def create_index(request: Request) -> JSONResponse:
+    """Check if index exist with a provided index_name.
+    If not, then create the index with the provided index_name."""
+    in_data = await request.json()
+    index_name = in_data["index_name"]
+    r = await _create_index_if_missing(request, index_name, RANKING_INDEX_CONFIG)
+    if r is not None:
+        return JSONResponse({"status": "OK", "message": r.text})
+    logging.warning(f"Index {index_name} already exists")
+    return JSONResponse({"status": "OK", "message": "index already exists"})
+
+
+async def home(request: Request) -> FileResponse:
+    return FileResponse(os.path.join(TEMPLATES_DIR, "index.html"))
+
+
+app = Starlette(
+    routes=[
+        Route("/api/v1/search", search, methods=["POST"]),
+        Route("/api/v1/msearch", msearch, methods=["POST"]),
+        Route("/api/v1/search_stream", search_stream, methods=["POST"]),
+        Route("/api/v1/status", status, methods=["GET"]),
+        Route("/api/v1/indices", indices, methods=["GET"]),
+        Route("/api/v1/add_docs", add_docs, methods=["POST"]),
+        Route("/api/v1/ingest", ingest, methods=["POST"]),
+        Route("/api/v1/create_index", create_index, methods=["POST"]),
+        Route("/", home),
+    ],
+    exception_handlers={Overloaded: overloaded},
+    lifespan=lifespan,
+)
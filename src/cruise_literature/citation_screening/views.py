@@ -20,6 +20,7 @@ from document_classification.views import (
     predict_relevance,
 )
 from literature_review.models import LiteratureReview
+from utils.http import get_session
 from .models import CitationScreening
 
 
@@ -371,7 +372,7 @@ def use_classify_api(xy_train: Dict, x_pred: Dict, review_id: int) -> Optional[D
     try:
         print("xy_train", xy_train)
         print("x_pred", x_pred)
-        res = requests.post(
+        res = get_session("ml_api").post(
             "http://localhost:5000" + "/classify",
             data=json.dumps({"xy_train": xy_train, "x_pred": x_pred, "review_id": review_id}),
             headers=headers,
@@ -175,3 +175,157 @@ SEARCH_WITH_CORE = True
 ML_API = False
 
 ENTREZ_EMAIL = "YOUR_EMAIL@SERVER.COM"
+
+# base URLs of the search engine APIs, they can point to the stub servers of scripts/benchmarks
+CRUISE_API_ENDPOINT = env("CRUISE_API_ENDPOINT", default="http://localhost:9880/api/v1")
+# with CRUISE_ELASTICSEARCH_URL set, CRUISE is searched directly in elasticsearch instead of
+# through the search_app API, with the query builder of search_app found in SEARCH_APP_DIR
+CRUISE_ELASTICSEARCH_URL = env("CRUISE_ELASTICSEARCH_URL", default=None)
+# fields of the documents returned by elasticsearch, the SOURCE_INCLUDES of the query builder
+# by default (like es_source_includes of search_app), "*" for indices without display fields
+CRUISE_SOURCE_INCLUDES = env.list("CRUISE_SOURCE_INCLUDES", default=None)
+SEARCH_APP_DIR = os.path.join(BASE_DIR, "../backend/search_app")
+# CRUISE searches of reviews with top_k >= CRUISE_STREAM_MIN_TOP_K are retrieved in pages of
+# CRUISE_STREAM_PAGE_SIZE hits (point in time and search_after), while their results are added
+CRUISE_STREAM_MIN_TOP_K = 1000
+CRUISE_STREAM_PAGE_SIZE = 500
+CORE_API_ENDPOINT = env(
+    "CORE_API_ENDPOINT", default="https://api.core.ac.uk/v3/search/works"
+)
+SEMANTIC_SCHOLAR_API_ENDPOINT = env(
+    "SEMANTIC_SCHOLAR_API_ENDPOINT", default="https://api.semanticscholar.org/graph/v1"
+)
+ENTREZ_API_ENDPOINT = env(
+    "ENTREZ_API_ENDPOINT", default="https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+)
+WIKIPEDIA_API_ENDPOINT = env(
+    "WIKIPEDIA_API_ENDPOINT", default="https://en.wikipedia.org/w/api.php"
+)
+
+# parsed PubMed records are cached by PMID, missing records are fetched in batches of
+# PUBMED_EFETCH_BATCH_SIZE, via the Entrez history server when top_k > PUBMED_HISTORY_THRESHOLD
+PUBMED_RECORD_CACHE_TTL = 60 * 60 * 24 * 7
+PUBMED_RECORD_CACHE_LOCAL_MAX_ENTRIES = 10000
+PUBMED_EFETCH_BATCH_SIZE = 200
+PUBMED_HISTORY_THRESHOLD = 200
+
+# Semantic Scholar result pages (100 results each) are requested concurrently.
+# From SEMANTIC_SCHOLAR_TWO_PHASE_MIN_TOP_K results, only paper ids are searched and
+# details of papers missing in the paper cache are requested in bulk
+SEMANTIC_SCHOLAR_MAX_CONCURRENT_REQUESTS = 4
+SEMANTIC_SCHOLAR_TWO_PHASE_MIN_TOP_K = 100
+SEMANTIC_SCHOLAR_PAPER_CACHE_TTL = 60 * 60 * 24 * 7
+SEMANTIC_SCHOLAR_PAPER_CACHE_LOCAL_MAX_ENTRIES = 10000
+
+# Google Scholar is scraped by the run_scholar_worker command, results are stored for
+# GOOGLE_SCHOLAR_RESULT_TTL seconds. Failed searches are retried after GOOGLE_SCHOLAR_RETRY_AFTER
+# seconds, jobs running longer than GOOGLE_SCHOLAR_JOB_TIMEOUT are taken over by another worker
+GOOGLE_SCHOLAR_RESULT_TTL = 60 * 60 * 24 * 7
+GOOGLE_SCHOLAR_RETRY_AFTER = 60 * 10
+GOOGLE_SCHOLAR_JOB_TIMEOUT = 60 * 30
+
+# all search engines are queried in parallel on a shared thread pool.
+# Engines which do not answer within their deadline (in seconds) are skipped.
+# SEARCH_ENGINE_TIMEOUT(S) is the upper bound, the actual request timeout of each engine
+# is derived from its recent p95 latency by the circuit breaker
+SEARCH_EXECUTOR_MAX_WORKERS = 32
+SEARCH_ENGINE_TIMEOUT = 8.0
+SEARCH_ENGINE_TIMEOUTS = {"Wikipedia": 3.0}
+SEARCH_ENGINE_MIN_TIMEOUT = 1.0
+SEARCH_ENGINE_GRACE_PERIOD = 0.5
+SEARCH_TOTAL_TIMEOUT = 10.0
+
+# a circuit breaker stops calling an engine for CIRCUIT_BREAKER_COOL_DOWN seconds after
+# CIRCUIT_BREAKER_FAILURE_THRESHOLD consecutive failures or when more than
+# CIRCUIT_BREAKER_ERROR_RATE of the last CIRCUIT_BREAKER_WINDOW calls failed
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_ERROR_RATE = 0.5
+CIRCUIT_BREAKER_WINDOW = 50
+CIRCUIT_BREAKER_MIN_CALLS = 10
+CIRCUIT_BREAKER_COOL_DOWN = 30.0
+CIRCUIT_BREAKER_TIMEOUT_MULTIPLIER = 2.0
+
+# requests to search engines are rate limited across all workers sharing the cache,
+# RATE_LIMITS maps engine names to (requests per second, burst size).
+# Searches from the search page wait at most RATE_LIMIT_MAX_WAIT seconds for their turn,
+# searches of literature reviews wait as long as needed
+RATE_LIMITS = {
+    "Semantic Scholar": (1.0, 1),
+    "CORE": (10 / 60, 5),
+    "PubMed": (3.0, 3),
+    "Google Scholar": (0.2, 1),
+}
+RATE_LIMIT_MAX_WAIT = 2.0
+
+CACHES = {
+    "default": env.cache("CACHE_URL", default="locmemcache://"),
+    # metric counters are kept apart from the default cache and must never be evicted,
+    # an evicted counter loses its value (with memcached or redis, use an instance without eviction)
+    "metrics": env.cache(
+        "METRICS_CACHE_URL", default="locmemcache://metrics?MAX_ENTRIES=1000000"
+    ),
+    # per-record caches of the search engines (PubMed records, Semantic Scholar papers), a single
+    # large search fills them, so they are kept apart from the circuit breaker and rate limiter state
+    "records": env.cache(
+        "RECORD_CACHE_URL", default="locmemcache://records?MAX_ENTRIES=50000"
+    ),
+}
+RECORD_CACHE_ALIAS = "records"
+
+# search engine responses are cached for SEARCH_CACHE_TTL seconds and afterwards
+# served stale (and refreshed in the background) for another SEARCH_CACHE_STALE_TTL seconds
+SEARCH_CACHE_ALIAS = "default"
+SEARCH_CACHE_TTL = 60 * 60
+SEARCH_CACHE_STALE_TTL = 60 * 60 * 24
+SEARCH_CACHE_LOCAL_MAX_ENTRIES = 512
+
+# merged search results are kept in a search session for SEARCH_SESSION_TTL seconds,
+# at most SEARCH_SESSION_MAX_ENTRIES sessions are held in the memory of each worker
+SEARCH_SESSION_TTL = 60 * 30
+SEARCH_SESSION_MAX_ENTRIES = 128
+
+# if True, the first page of search results is streamed as search engines answer
+SEARCH_STREAM_RESULTS = False
+
+# query terms are highlighted in abstracts and snippets of all search results
+SEARCH_HIGHLIGHT_CASE_SENSITIVE = False
+SEARCH_HIGHLIGHT_STEMMING = True
+
+# Wikipedia matches (and misses) are cached per query for WIKIPEDIA_CACHE_TTL seconds,
+# disambiguation pages are followed WIKIPEDIA_MAX_DISAMBIGUATION_DEPTH levels deep
+WIKIPEDIA_CACHE_TTL = 60 * 60 * 24 * 7
+WIKIPEDIA_MAX_DISAMBIGUATION_DEPTH = 1
+WIKIPEDIA_MAX_DISAMBIGUATION_OPTIONS = 20
+# when the offline title index (built by the build_wikipedia_index command) exists,
+# queries are matched against it instead of the Wikipedia API
+WIKIPEDIA_INDEX_PATH = env(
+    "WIKIPEDIA_INDEX_PATH",
+    default=os.path.join(BASE_DIR, "../../data/wikipedia_index.sqlite3"),
+)
+
+# outgoing HTTP requests share keep-alive sessions (see utils.http), one per upstream service;
+# HTTP_POOL_MAXSIZE is the number of connections kept alive per host of each service
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = {
+    "default": 10,
+    "cruise": SEARCH_EXECUTOR_MAX_WORKERS,
+    "elasticsearch": SEARCH_EXECUTOR_MAX_WORKERS,
+}
+HTTP_MAX_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.2
+HTTP_BACKOFF_JITTER = 0.2
+
+# user queries are logged as JSON lines (see document_search.engine_logger), the log is
+# rotated when it reaches QUERY_LOG_MAX_BYTES and QUERY_LOG_BACKUP_COUNT old logs are kept
+QUERY_LOG_PATH = env(
+    "QUERY_LOG_PATH",
+    default=os.path.join(BASE_DIR, "../../data/user_queries.log"),
+)
+QUERY_LOG_MAX_BYTES = 50 * 1024 * 1024
+QUERY_LOG_BACKUP_COUNT = 10
+
+# per-engine latency, status and cache metrics are buffered in each worker and added to the
+# shared cache every METRICS_FLUSH_INTERVAL seconds, /metrics exposes them to METRICS_ALLOWED_IPS
+METRICS_FLUSH_INTERVAL = 5.0
+METRICS_CACHE_ALIAS = "metrics"
+METRICS_ALLOWED_IPS = env.list("METRICS_ALLOWED_IPS", default=["127.0.0.1"])
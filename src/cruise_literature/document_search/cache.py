@@ -0,0 +1,225 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .fan_out import get_executor
+from .utils import SearchResultWithStatus
+
+BOOLEAN_OPERATORS = {"AND", "OR", "NOT"}
+
+FRESH = "fresh"
+STALE = "stale"
+MISS = "miss"
+
+
+def normalize_query(query: str) -> str:
+    """Collapses whitespaces and lowercases the query.
+    Boolean operators are kept uppercase, as some engines (e.g. PubMed) treat
+    them differently than lowercase words."""
+    return " ".join(
+        token if token in BOOLEAN_OPERATORS else token.casefold()
+        for token in query.split()
+    )
+
+
+class TieredCache:
+    """Two-tier cache: a size-bounded in-process LRU dictionary in front of
+    a shared Django cache backend.
+
+    Every entry is fresh for `ttl` seconds and afterwards stale for another
+    `stale_ttl` seconds. Stale entries are still returned, so the caller can
+    serve them and refresh the value in the background.
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        ttl: int,
+        stale_ttl: int = 0,
+        max_local_entries: int = 256,
+        cache_alias: str = "default",
+    ):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_local_entries = max_local_entries
+        self.cache_alias = cache_alias
+        self._local: "OrderedDict[str, Tuple[Any, float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def make_key(self, *parts: Any) -> str:
+        """Builds a backend safe key (no whitespaces, bounded length)."""
+        digest = hashlib.sha1("\x1f".join(str(p) for p in parts).encode()).hexdigest()
+        return f"{self.prefix}:{digest}"
+
+    def get(self, key: str) -> Tuple[Any, str]:
+        """Returns a tuple of (value, FRESH | STALE | MISS)."""
+        now = time.time()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry and entry[2] > now:
+                self._local.move_to_end(key)
+            elif entry:
+                del self._local[key]
+                entry = None
+
+        if entry is None:
+            entry = self.shared.get(key)
+            if entry is None or entry[2] <= now:
+                return None, MISS
+            self._set_local(key, entry)
+
+        value, fresh_until, _ = entry
+        return value, FRESH if fresh_until > now else STALE
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        entry = (value, now + self.ttl, now + self.ttl + self.stale_ttl)
+        self._set_local(key, entry)
+        self.shared.set(key, entry, timeout=self.ttl + self.stale_ttl)
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """Returns values (fresh or stale) of the keys found in the cache.
+        Keys missing in the local tier are fetched from the shared backend in one call."""
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._local.get(key)
+                if entry and entry[2] > now:
+                    self._local.move_to_end(key)
+                    found[key] = entry[0]
+
+        missing = [key for key in keys if key not in found]
+        if missing:
+            for key, entry in self.shared.get_many(missing).items():
+                if entry[2] > now:
+                    self._set_local(key, entry)
+                    found[key] = entry[0]
+        return found
+
+    def set_many(self, values: Dict[str, Any]):
+        now = time.time()
+        entries = {
+            key: (value, now + self.ttl, now + self.ttl + self.stale_ttl)
+            for key, value in values.items()
+        }
+        for key, entry in entries.items():
+            self._set_local(key, entry)
+        self.shared.set_many(entries, timeout=self.ttl + self.stale_ttl)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._local.pop(key, None)
+        self.shared.delete(key)
+
+    def _set_local(self, key: str, entry: Tuple[Any, float, float]):
+        with self._lock:
+            self._local[key] = entry
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_local_entries:
+                self._local.popitem(last=False)
+
+
+class SearchResultCache:
+    """Caches search engine responses keyed on (engine, normalized query, top_k).
+
+    Fresh results are returned directly. Stale results are returned as well,
+    but a refresh is scheduled on the shared search executor. Only successful
+    responses are cached.
+    """
+
+    def __init__(self, cache: TieredCache):
+        self.cache = cache
+        self.counters: Counter = Counter()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def search(
+        self,
+        engine_name: str,
+        search_method: Callable[[str, int], SearchResultWithStatus],
+        query: str,
+        top_k: int,
+    ) -> SearchResultWithStatus:
+        key = self.cache.make_key(engine_name, normalize_query(query), top_k)
+        result, state = self.cache.get(key)
+        self._count(engine_name, state)
+
+        if state == MISS:
+            result = self._fetch(key, search_method, query, top_k)
+        elif state == STALE:
+            self._schedule_refresh(key, search_method, query, top_k)
+
+        return {**result, "cache": state}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters)
+
+    def _fetch(
+        self,
+        key: str,
+        search_method: Callable[[str, int], SearchResultWithStatus],
+        query: str,
+        top_k: int,
+    ) -> SearchResultWithStatus:
+        result = search_method(query, top_k)
+        if result["status"] == "OK":
+            self.cache.set(key, result)
+        return result
+
+    def _schedule_refresh(
+        self,
+        key: str,
+        search_method: Callable[[str, int], SearchResultWithStatus],
+        query: str,
+        top_k: int,
+    ):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def _refresh():
+            try:
+                self._fetch(key, search_method, query, top_k)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        get_executor().submit(_refresh)
+
+    def _count(self, engine_name: str, state: str):
+        hit = "miss" if state == MISS else "hit"
+        with self._lock:
+            self.counters[hit] += 1
+            self.counters[f"{engine_name}:{state}"] += 1
+
+
+_search_result_cache: Optional[SearchResultCache] = None
+
+
+def get_search_result_cache() -> SearchResultCache:
+    """Returns the process-wide search result cache."""
+    global _search_result_cache
+    if _search_result_cache is None:
+        _search_result_cache = SearchResultCache(
+            TieredCache(
+                prefix="search_result",
+                ttl=settings.SEARCH_CACHE_TTL,
+                stale_ttl=settings.SEARCH_CACHE_STALE_TTL,
+                max_local_entries=settings.SEARCH_CACHE_LOCAL_MAX_ENTRIES,
+                cache_alias=settings.SEARCH_CACHE_ALIAS,
+            )
+        )
+    return _search_result_cache
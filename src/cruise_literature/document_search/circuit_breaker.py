@@ -0,0 +1,156 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .fan_out import get_engine_timeout
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Returns the q-th percentile (0 <= q <= 100) using the nearest-rank method."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class CircuitBreaker:
+    """Circuit breaker for a single search engine.
+
+    The state (recent calls, consecutive failures, and the time until which the
+    circuit stays open) is kept in the Django cache, so all workers sharing the
+    cache backend see the same state. Updates are not atomic, concurrent workers
+    may occasionally overwrite each other's last call, which is acceptable for
+    the purpose of detecting a degraded upstream.
+
+    The circuit opens after `failure_threshold` consecutive failures, or when the
+    error rate of the rolling window exceeds `error_rate_threshold`. After
+    `cool_down` seconds it becomes half-open and lets calls through; the first
+    failure opens it again, the first success closes it.
+
+    The request timeout is derived from the p95 latency of recent successful calls.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_timeout: float,
+        min_timeout: float = 1.0,
+        timeout_multiplier: float = 2.0,
+        window: int = 50,
+        min_calls: int = 10,
+        failure_threshold: int = 5,
+        error_rate_threshold: float = 0.5,
+        cool_down: float = 30.0,
+        cache_alias: str = "default",
+    ):
+        self.name = name
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.cool_down = cool_down
+        self.cache_alias = cache_alias
+        # engine names contain spaces, which are not valid in memcached keys
+        self.key = f"circuit_breaker:{name.replace(' ', '_')}"
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _get_state(self) -> Dict:
+        return self.cache.get(self.key) or {
+            "calls": [],
+            "consecutive_failures": 0,
+            "opened_until": 0.0,
+        }
+
+    def _set_state(self, state: Dict):
+        self.cache.set(self.key, state, timeout=None)
+
+    def state(self) -> str:
+        opened_until = self._get_state()["opened_until"]
+        if not opened_until:
+            return CLOSED
+        return OPEN if opened_until > time.time() else HALF_OPEN
+
+    def is_open(self) -> bool:
+        return self.state() == OPEN
+
+    def timeout(self, expected_latency: Optional[float] = None) -> float:
+        """Request timeout in seconds: p95 latency of successful calls times the multiplier,
+        clamped to [min_timeout, max_timeout]. Until enough calls are recorded, the expected
+        latency of the engine is used instead of the p95 latency, without it max_timeout."""
+        latencies = [latency for latency, ok in self._get_state()["calls"] if ok]
+        if len(latencies) >= self.min_calls:
+            latency = percentile(latencies, 95)
+        elif expected_latency is not None:
+            latency = expected_latency
+        else:
+            return self.max_timeout
+        return max(self.min_timeout, min(self.max_timeout, latency * self.timeout_multiplier))
+
+    def record(self, latency: float, ok: bool):
+        state = self._get_state()
+        calls: List[Tuple[float, bool]] = state["calls"]
+        calls.append((latency, ok))
+        del calls[: -self.window]
+
+        if ok:
+            state["consecutive_failures"] = 0
+            state["opened_until"] = 0.0
+        else:
+            state["consecutive_failures"] += 1
+            n_failures = sum(1 for _, call_ok in calls if not call_ok)
+            half_open = state["opened_until"] and state["opened_until"] <= time.time()
+            if (
+                half_open
+                or state["consecutive_failures"] >= self.failure_threshold
+                or (
+                    len(calls) >= self.min_calls
+                    and n_failures / len(calls) > self.error_rate_threshold
+                )
+            ):
+                state["opened_until"] = time.time() + self.cool_down
+        self._set_state(state)
+
+    def stats(self) -> Dict:
+        calls = self._get_state()["calls"]
+        latencies = [latency for latency, ok in calls if ok]
+        return {
+            "state": self.state(),
+            "calls": len(calls),
+            "error_rate": sum(1 for _, ok in calls if not ok) / len(calls) if calls else 0.0,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "timeout": self.timeout(),
+        }
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(engine_name: str) -> CircuitBreaker:
+    """Returns the circuit breaker of a search engine configured from the settings."""
+    if engine_name not in _circuit_breakers:
+        _circuit_breakers[engine_name] = CircuitBreaker(
+            name=engine_name,
+            max_timeout=get_engine_timeout(engine_name),
+            min_timeout=settings.SEARCH_ENGINE_MIN_TIMEOUT,
+            timeout_multiplier=settings.CIRCUIT_BREAKER_TIMEOUT_MULTIPLIER,
+            window=settings.CIRCUIT_BREAKER_WINDOW,
+            min_calls=settings.CIRCUIT_BREAKER_MIN_CALLS,
+            failure_threshold=settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+            error_rate_threshold=settings.CIRCUIT_BREAKER_ERROR_RATE,
+            cool_down=settings.CIRCUIT_BREAKER_COOL_DOWN,
+            cache_alias=settings.SEARCH_CACHE_ALIAS,
+        )
+    return _circuit_breakers[engine_name]
@@ -1,8 +1,15 @@
+import atexit
+import json
 import logging
-import os
-from typing import Optional
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Optional
 
-import wikipedia
+from django.conf import settings
+
+from utils.article import WikipediaArticle
+from .utils import SearchResultWithStatus
 
 
 def get_query_type(source: Optional[str]) -> str:
@@ -20,46 +27,134 @@ def get_query_type(source: Optional[str]) -> str:
         return source
 
 
-def get_wiki_logger(matched_wiki_page: Optional[wikipedia.WikipediaPage]) -> str:
+def get_wiki_logger(matched_wiki_page: Optional[WikipediaArticle]) -> Optional[str]:
     """
     Parses values of matched wiki page url, in case it was found to the query.
-    Otherwise, returns string None
+    Otherwise, returns None
     """
     if matched_wiki_page:
         return matched_wiki_page.url
     else:
-        return "None"
+        return None
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats records whose message is a dict as a single JSON line with a UTC timestamp."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(
+            {
+                "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                **record.msg,
+            },
+            ensure_ascii=False,
+        )
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Puts records in the queue as they are, so that they are formatted
+    (serialized to JSON) by the listener thread, not by the request thread.
+    Records must not be modified after they are logged."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
 
 
 class EngineLogger:
-    """Simple wrapper for python logger to get a custom user query logger."""
+    """Logger of user queries writing JSON lines to a size-rotated file.
+
+    Logging only puts the record in a queue. The file is written by a listener
+    thread, so requests never wait for disk I/O. The queued records are flushed
+    when the process exits. See document_search.query_log for reading the log.
+    """
 
-    def __init__(self):
-        self._logger = logging.getLogger("user_queries")
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        hdlr = logging.FileHandler(f"{dir_path}../../../../data/user_queries.log")
-        formatter = logging.Formatter("%(asctime)s %(message)s")
-        hdlr.setFormatter(formatter)
-        self._logger.addHandler(hdlr)
-        self._logger.setLevel(logging.INFO)
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_bytes: Optional[int] = None,
+        backup_count: Optional[int] = None,
+    ):
+        file_handler = RotatingFileHandler(
+            path or settings.QUERY_LOG_PATH,
+            maxBytes=settings.QUERY_LOG_MAX_BYTES if max_bytes is None else max_bytes,
+            backupCount=settings.QUERY_LOG_BACKUP_COUNT
+            if backup_count is None
+            else backup_count,
+            encoding="utf-8",
+            delay=True,
+        )
+        file_handler.setFormatter(JsonLinesFormatter())
+        log_queue = queue.SimpleQueue()
+        self._listener = QueueListener(log_queue, file_handler)
+        self._listener.start()
+        self._closed = False
+        atexit.register(self.close)
+
+        # not registered in the logging manager, so records do not reach other handlers
+        self._logger = logging.Logger("user_queries", level=logging.INFO)
+        self._logger.addHandler(_DeferredQueueHandler(log_queue))
+
+    def close(self):
+        """Writes the queued records and stops the listener thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
 
     def log_query(
         self,
         search_query: str,
         query_type: str,
         search_time: float,
-        matched_wiki_page: str,
-        tax_results: dict = {},
+        matched_wiki_page: Optional[str],
+        engine_statuses: Optional[List[SearchResultWithStatus]] = None,
+        n_results: Optional[int] = None,
+        page: int = 1,
+        tax_results: Optional[dict] = None,
     ):
-        """Method responsible for logging user queries along with some metadata."""
-        concepts = "|".join(
-            f"{k}: {v['concept']['text']}" for k, v in tax_results.items()
-        )
-        self._logger.info(
-            "\t%s\t%.4f\t%s\t%s\t%s",
-            query_type,
-            search_time,
-            search_query,
-            concepts,
-            matched_wiki_page,
-        )
+        """Method responsible for logging user queries along with some metadata.
+
+        :param engine_statuses: search results with statuses of the engines queried by
+            this request, None when the results were served from a search session
+        :param n_results: number of unique results after merging
+        :param page: requested page of the results
+        """
+        record = {
+            "query": search_query,
+            "query_type": query_type,
+            "page": page,
+            "search_time": round(search_time, 4),
+            "wiki_page": matched_wiki_page,
+            "from_session": engine_statuses is None,
+            "n_results": n_results,
+        }
+        if engine_statuses is not None:
+            engines = {
+                status["search_engine"]: _engine_record(status)
+                for status in engine_statuses
+            }
+            n_engine_results = sum(engine["n_results"] for engine in engines.values())
+            record["engines"] = engines
+            record["dedup_ratio"] = (
+                round(1 - n_results / n_engine_results, 4)
+                if n_results is not None and n_engine_results
+                else 0.0
+            )
+        if tax_results:
+            record["concepts"] = [
+                value["concept"]["text"] for value in tax_results.values()
+            ]
+        self._logger.info(record)
+
+
+def _engine_record(status: SearchResultWithStatus) -> Dict:
+    latency = status.get("latency")
+    return {
+        "status": status["status"],
+        "status_code": status["status_code"],
+        "n_results": len(status.get("results", [])),
+        "latency": None if latency is None else round(latency, 4),
+        "cache": status.get("cache"),
+    }
@@ -0,0 +1,81 @@
+import concurrent.futures
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from django.conf import settings
+
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Returns the process-wide thread pool used for fanning out search queries.
+    The pool is created lazily on the first call and reused by all requests,
+    so no threads are created or torn down per search."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=settings.SEARCH_EXECUTOR_MAX_WORKERS,
+                    thread_name_prefix="search_fan_out",
+                )
+    return _executor
+
+
+def get_engine_timeout(engine_name: str) -> float:
+    """Returns the deadline (in seconds) configured for a given search engine."""
+    return settings.SEARCH_ENGINE_TIMEOUTS.get(
+        engine_name, settings.SEARCH_ENGINE_TIMEOUT
+    )
+
+
+def fan_out(
+    tasks: Dict[str, Callable[[], Any]],
+    timeouts: Dict[str, float],
+    total_budget: float,
+) -> Iterator[Tuple[str, Any, Optional[BaseException]]]:
+    """Submits all tasks to the shared executor and yields them as they complete.
+
+    Every task gets its own deadline, additionally capped by the overall budget.
+    Tasks that did not finish before their deadline are yielded with a
+    TimeoutError, so the caller can use the partial results which already
+    arrived. Timed out tasks which are still queued are cancelled, those already
+    running finish in the background (a running thread cannot be stopped) and
+    their results are simply discarded.
+
+    :param tasks: mapping from a task name (e.g. search engine name) to a callable
+    :param timeouts: mapping from a task name to its deadline in seconds
+    :param total_budget: maximal time in seconds to wait for all the tasks
+    :return: iterator of (name, result, exception) tuples
+    """
+    start = time.monotonic()
+    executor = get_executor()
+    futures = {executor.submit(task): name for name, task in tasks.items()}
+    deadlines = {
+        name: start + min(timeouts.get(name, total_budget), total_budget)
+        for name in tasks
+    }
+
+    pending = set(futures)
+    while pending:
+        next_deadline = min(deadlines[futures[future]] for future in pending)
+        done, pending = concurrent.futures.wait(
+            pending,
+            timeout=max(next_deadline - time.monotonic(), 0),
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        for future in done:
+            exception = future.exception()
+            result = None if exception else future.result()
+            yield futures[future], result, exception
+
+        now = time.monotonic()
+        expired = {future for future in pending if deadlines[futures[future]] <= now}
+        for future in expired:
+            future.cancel()
+            yield futures[future], None, TimeoutError(
+                f"{futures[future]} did not finish in time"
+            )
+        pending -= expired
@@ -0,0 +1,92 @@
+import copy
+import html
+import re
+from typing import List, Optional, Union
+
+from utils.article import Article, LazyArticle
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in",
+    "is", "it", "not", "of", "on", "or", "the", "to", "what", "with",
+}
+SUFFIXES = ("ations", "ation", "ings", "ing", "ies", "es", "ed", "ly", "s")
+_TOKEN = re.compile(r"\w+")
+
+
+def stem(term: str) -> str:
+    """Light suffix stripping, good enough to match simple inflections of a query term."""
+    for suffix in SUFFIXES:
+        if term.endswith(suffix) and len(term) - len(suffix) >= 3:
+            return term[: -len(suffix)]
+    return term
+
+
+class QueryHighlighter:
+    """Highlights query terms in texts of search results.
+
+    All terms of a query are compiled once into a single regular expression,
+    so highlighting a text is a single linear pass over it regardless of the
+    number of terms. The output is HTML escaped, apart from the highlight tags.
+
+    :param query: search query
+    :param case_sensitive: if False, terms are matched ignoring the case
+    :param stemming: if True, terms match all words starting with the term's stem,
+        e.g. 'learning' matches 'learn', 'learned' and 'learners'
+    :param tag: HTML tag wrapping the matches
+    """
+
+    def __init__(
+        self,
+        query: str,
+        case_sensitive: bool = False,
+        stemming: bool = True,
+        tag: str = "em",
+    ):
+        self.tag = tag
+        self.terms = self._get_terms(query, case_sensitive, stemming)
+        self.pattern: Optional[re.Pattern] = None
+        if self.terms:
+            alternatives = "|".join(re.escape(term) for term in self.terms)
+            suffix = r"\w*" if stemming else ""
+            self.pattern = re.compile(
+                rf"\b(?:{alternatives}){suffix}\b",
+                0 if case_sensitive else re.IGNORECASE,
+            )
+
+    @staticmethod
+    def _get_terms(query: str, case_sensitive: bool, stemming: bool) -> List[str]:
+        terms = set()
+        for term in _TOKEN.findall(query):
+            if term.lower() in STOPWORDS:
+                continue
+            if not case_sensitive:
+                term = term.lower()
+            terms.add(stem(term) if stemming else term)
+        # longer terms first, so that the longest alternative wins
+        return sorted(terms, key=lambda t: (-len(t), t))
+
+    def highlight(self, text: Optional[str]) -> Optional[str]:
+        """Returns HTML escaped text with all matched terms wrapped in the highlight tag."""
+        if not text:
+            return text
+        if self.pattern is None:
+            return html.escape(text)
+
+        parts = []
+        position = 0
+        for match in self.pattern.finditer(text):
+            start, end = match.span()
+            parts.append(html.escape(text[position:start]))
+            parts.append(f"<{self.tag}>{html.escape(match.group())}</{self.tag}>")
+            position = end
+        parts.append(html.escape(text[position:]))
+        return "".join(parts)
+
+    def highlight_article(self, article: Union[Article, LazyArticle]) -> Article:
+        """Returns a copy of the article with highlighted abstract and snippet.
+        Articles may be shared with the search caches, so they are not modified.
+        Lazy articles are materialized."""
+        highlighted = copy.copy(article.materialize())
+        highlighted.abstract = self.highlight(article.abstract)
+        highlighted.snippet = self.highlight(article.snippet)
+        return highlighted
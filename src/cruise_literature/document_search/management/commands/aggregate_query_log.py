@@ -0,0 +1,30 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from document_search.query_log import aggregate_query_log, iter_query_log, log_files
+
+
+class Command(BaseCommand):
+    help = (
+        "Aggregates the user query log (including its rotated backups) into daily "
+        "query and latency statistics, printed as one JSON object per day."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--log",
+            default=settings.QUERY_LOG_PATH,
+            help="path of the query log (default: QUERY_LOG_PATH setting)",
+        )
+        parser.add_argument("--since", help="first day to include, YYYY-MM-DD")
+
+    def handle(self, *args, **options):
+        records = iter_query_log(log_files(options["log"]))
+        if options["since"]:
+            records = (
+                record for record in records if record["time"][:10] >= options["since"]
+            )
+        for day, stats in aggregate_query_log(records).items():
+            self.stdout.write(json.dumps({"day": day, **stats}))
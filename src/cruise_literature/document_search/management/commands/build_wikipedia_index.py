@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from document_search.wikipedia_index import build_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds (or refreshes) the offline Wikipedia title index used for matching "
+        "search queries to Wikipedia pages, from a pages-articles XML dump "
+        "(e.g. enwiki-latest-pages-articles.xml.bz2)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("dump", help="path to the XML dump, optionally bz2 compressed")
+        parser.add_argument(
+            "--output",
+            default=settings.WIKIPEDIA_INDEX_PATH,
+            help="path of the index file (default: WIKIPEDIA_INDEX_PATH setting)",
+        )
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        s_time = time.time()
+        n_titles = build_index(
+            options["dump"], options["output"], batch_size=options["batch_size"]
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Indexed {n_titles} titles into {options['output']} "
+                f"({time.time() - s_time:.0f} seconds)"
+            )
+        )
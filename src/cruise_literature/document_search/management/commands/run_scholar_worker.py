@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from document_search.search_google_scholar import (
+    claim_scholar_search_job,
+    run_scholar_search_job,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs queued Google Scholar searches. Any number of workers can run "
+        "in parallel, each job is claimed by a single worker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="seconds to wait before checking the queue again when it is empty",
+        )
+        parser.add_argument(
+            "--once", action="store_true", help="exit when the queue is empty"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_scholar_search_job()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+                continue
+
+            s_time = time.time()
+            job = run_scholar_search_job(job)
+            self.stdout.write(
+                f"{job.status} '{job.query}': {len(job.results)} results "
+                f"({time.time() - s_time:.1f} seconds)"
+            )
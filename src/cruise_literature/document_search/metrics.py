@@ -0,0 +1,307 @@
+import bisect
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .query_log import LATENCY_BUCKETS
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# sums of observed seconds are kept as integer microseconds, so they can be incremented in the cache
+SUM_SCALE = 1_000_000
+
+# series are keyed by the metric name and its labels joined by the separator
+SEPARATOR = "\x1f"
+SERIES_KEY = "metrics:series"
+LOCK_TIMEOUT = 1
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metric:
+    """A counter (or, with buckets, a histogram) with labels.
+
+    Observations are counted in process and flushed to the shared Django cache
+    with `incr` (see MetricsRegistry), so the exposed values are aggregated across workers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Optional[Iterable[float]] = None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets) if buckets is not None else None
+        self.registry: Optional["MetricsRegistry"] = None
+
+    @property
+    def type(self) -> str:
+        return "counter" if self.buckets is None else "histogram"
+
+    def inc(self, amount: int = 1, **labels: str):
+        self.registry.add(self._key(labels), amount)
+
+    def observe(self, value: float, **labels: str):
+        """Counts the value in its bucket, increments the sum and the count of the histogram."""
+        key = self._key(labels)
+        self.registry.add(f"{key}{SEPARATOR}{bisect.bisect_left(self.buckets, value)}", 1)
+        self.registry.add(f"{key}{SEPARATOR}sum", round(value * SUM_SCALE))
+        self.registry.add(f"{key}{SEPARATOR}count", 1)
+
+    def _key(self, labels: Dict[str, str]) -> str:
+        return SEPARATOR.join(
+            [self.name] + [f"{name}={value}" for name, value in sorted(labels.items())]
+        )
+
+
+class MetricsRegistry:
+    """Buffers metric increments in process and flushes them to the shared cache
+    at most every `flush_interval` seconds, so requests do not wait for a cache
+    round trip per observation. Series seen for the first time are added to
+    a list of all series kept in the cache, which is read when the metrics are exposed.
+    The list is registered again if it is missing from the cache (e.g. after a restart).
+    Failures of the cache are logged, they never break the request which flushes.
+    """
+
+    def __init__(self, cache_alias: str = "default", flush_interval: float = 5.0):
+        self.cache_alias = cache_alias
+        self.flush_interval = flush_interval
+        self.metrics: Dict[str, Metric] = {}
+        self._pending: Counter = Counter()
+        self._known_series = set()
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def register(self, metric: Metric) -> Metric:
+        metric.registry = self
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add(self, key: str, amount: int):
+        with self._lock:
+            self._pending[key] += amount
+            flush = time.monotonic() - self._last_flush >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Adds the buffered increments to the values in the cache."""
+        if not self._flush_lock.acquire(blocking=False):
+            return  # another thread is flushing
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, Counter()
+                self._last_flush = time.monotonic()
+            try:
+                self._write(pending)
+            except Exception:
+                logging.exception("Flushing the metrics failed")
+        finally:
+            self._flush_lock.release()
+
+    def _write(self, pending: Counter):
+        if self._known_series and not self.cache.has_key(SERIES_KEY):
+            # the list of series was lost, the series of this worker are registered again
+            new_series = sorted(self._known_series.union(pending))
+        else:
+            new_series = [key for key in pending if key not in self._known_series]
+        if new_series:
+            self._add_series(new_series)
+        for key, amount in pending.items():
+            cache_key = self._cache_key(key)
+            self.cache.add(cache_key, 0, timeout=None)
+            try:
+                self.cache.incr(cache_key, amount)
+            except ValueError:
+                # the counter was evicted after add(), it starts again from this increment
+                self.cache.set(cache_key, amount, timeout=None)
+
+    def values(self) -> Dict[str, int]:
+        """Flushes this process and returns the values of all series of all workers."""
+        self.flush()
+        series = self.cache.get(SERIES_KEY, [])
+        cached = self.cache.get_many([self._cache_key(key) for key in series])
+        return {key: cached.get(self._cache_key(key), 0) for key in series}
+
+    def _add_series(self, keys: List[str]):
+        lock_key = f"{SERIES_KEY}:lock"
+        token = uuid.uuid4().hex
+        # the lock expires after LOCK_TIMEOUT, a holder which died does not block the others
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while not self.cache.add(lock_key, token, timeout=LOCK_TIMEOUT):
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.002)
+        try:
+            series = self.cache.get(SERIES_KEY, [])
+            series.extend(key for key in keys if key not in series)
+            self.cache.set(SERIES_KEY, series, timeout=None)
+        finally:
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+        self._known_series.update(keys)
+
+    @staticmethod
+    def _cache_key(key: str) -> str:
+        # series keys contain arbitrary label values, which are not valid memcached keys
+        return f"metrics:{hashlib.sha1(key.encode()).hexdigest()}"
+
+
+metrics_registry = MetricsRegistry(
+    cache_alias=settings.METRICS_CACHE_ALIAS,
+    flush_interval=settings.METRICS_FLUSH_INTERVAL,
+)
+
+engine_latency = metrics_registry.register(
+    Metric(
+        "search_engine_latency_seconds",
+        "Time until a search engine answered (or the search stopped waiting for it).",
+        buckets=LATENCY_BUCKETS,
+    )
+)
+engine_requests = metrics_registry.register(
+    Metric(
+        "search_engine_requests_total",
+        "Search engine calls by status and HTTP status code.",
+    )
+)
+engine_cache = metrics_registry.register(
+    Metric(
+        "search_engine_cache_total",
+        "Search engine calls by state of the search result cache.",
+    )
+)
+pagination_latency = metrics_registry.register(
+    Metric(
+        "search_pagination_seconds",
+        "Time to sort, paginate and highlight search results.",
+        buckets=LATENCY_BUCKETS,
+    )
+)
+
+
+def record_engine_call(
+    engine_name: str,
+    latency: float,
+    status: str,
+    status_code: int,
+    cache_state: Optional[str] = None,
+):
+    engine_latency.observe(latency, engine=engine_name)
+    engine_requests.inc(engine=engine_name, status=status, code=str(status_code))
+    if cache_state is not None:
+        engine_cache.inc(engine=engine_name, state=cache_state)
+
+
+def histogram_quantile(
+    q: float, buckets: Tuple[float, ...], counts: List[int]
+) -> Optional[float]:
+    """Estimates the quantile by linear interpolation within its bucket (as Prometheus does).
+    Quantiles in the unbounded bucket are reported as the largest bucket bound."""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    lower = 0.0
+    for upper, count in zip(buckets, counts):
+        if seen + count >= rank and count:
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+        lower = upper
+    return buckets[-1]
+
+
+def render_metrics(registry: MetricsRegistry = metrics_registry) -> str:
+    """Returns all metrics in the Prometheus text exposition format.
+
+    Besides histogram buckets, p50/p95/p99 estimates are exposed as `<name>_quantile`
+    gauges, and the cache hit ratio (fresh and stale cache states) as
+    `search_engine_cache_hit_ratio`.
+    """
+    values = registry.values()
+    series: Dict[str, Dict[Labels, Dict[str, int]]] = defaultdict(
+        lambda: defaultdict(dict)
+    )
+    for key, value in values.items():
+        name, *rest = key.split(SEPARATOR)
+        labels = tuple(tuple(label.split("=", 1)) for label in rest)
+        metric = registry.metrics.get(name)
+        if metric is None:
+            continue
+        if metric.buckets is None:
+            series[name][labels]["value"] = value
+        else:
+            # the last label of a histogram key is the bucket index, "sum" or "count"
+            *labels, (field,) = labels
+            series[name][tuple(labels)][field] = value
+
+    lines = []
+    for name, metric in registry.metrics.items():
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.type}")
+        for labels, fields in sorted(series[name].items()):
+            if metric.buckets is None:
+                lines.append(f"{name}{_labels(labels)} {fields['value']}")
+                continue
+            counts = [fields.get(str(i), 0) for i in range(len(metric.buckets) + 1)]
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}"
+                )
+            lines.append(f"{name}_sum{_labels(labels)} {fields.get('sum', 0) / SUM_SCALE}")
+            lines.append(f"{name}_count{_labels(labels)} {fields.get('count', 0)}")
+        if metric.buckets is not None:
+            lines.append(f"# HELP {name}_quantile Quantiles estimated from {name} buckets.")
+            lines.append(f"# TYPE {name}_quantile gauge")
+            for labels, fields in sorted(series[name].items()):
+                counts = [fields.get(str(i), 0) for i in range(len(metric.buckets) + 1)]
+                for q in QUANTILES:
+                    estimate = histogram_quantile(q, metric.buckets, counts)
+                    if estimate is not None:
+                        lines.append(
+                            f"{name}_quantile{_labels(labels + (('quantile', str(q)),))} {estimate:.4f}"
+                        )
+
+    lines.append(
+        "# HELP search_engine_cache_hit_ratio Share of search engine calls served from the search result cache."
+    )
+    lines.append("# TYPE search_engine_cache_hit_ratio gauge")
+    cache_states: Dict[str, Counter] = defaultdict(Counter)
+    for labels, fields in series[engine_cache.name].items():
+        labels = dict(labels)
+        cache_states[labels["engine"]][labels["state"]] += fields["value"]
+    for engine_name, states in sorted(cache_states.items()):
+        hits = states["fresh"] + states["stale"]
+        lines.append(
+            f"search_engine_cache_hit_ratio{_labels((('engine', engine_name),))} "
+            f"{hits / sum(states.values()):.4f}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
@@ -24,3 +24,32 @@ class SearchEngine(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class ScholarSearchJob(models.Model):
+    """Google Scholar search queued for the run_scholar_worker command.
+    Finished jobs keep their results, so repeated queries are served from the database."""
+
+    class Status(models.TextChoices):
+        PENDING = "PENDING", _("Pending")
+        RUNNING = "RUNNING", _("Running")
+        DONE = "DONE", _("Done")
+        FAILED = "FAILED", _("Failed")
+
+    query = models.CharField(max_length=1000, unique=True)
+    top_k = models.IntegerField()
+    status = models.CharField(
+        max_length=10, choices=Status.choices, default=Status.PENDING, db_index=True
+    )
+    results = models.JSONField(default=list, blank=True)
+    error = models.TextField(blank=True, default="")
+
+    queued_at = models.DateTimeField(_("queued at"))
+    started_at = models.DateTimeField(_("started at"), null=True, blank=True)
+    finished_at = models.DateTimeField(_("finished at"), null=True, blank=True)
+
+    created_at = models.DateTimeField(_("created at"), auto_now_add=True)
+    updated_at = models.DateTimeField(_("updated at"), auto_now=True)
+
+    def __str__(self):
+        return f"{self.query} ({self.status})"
@@ -0,0 +1,144 @@
+import bisect
+import glob
+import json
+import os
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional
+
+# upper bounds (in seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def log_files(path: str) -> List[str]:
+    """Returns the log file and its rotated backups, oldest first."""
+    backups = [
+        backup
+        for backup in glob.glob(f"{glob.escape(path)}.*")
+        if backup.rsplit(".", 1)[1].isdigit()
+    ]
+    backups.sort(key=lambda backup: int(backup.rsplit(".", 1)[1]), reverse=True)
+    return backups + ([path] if os.path.exists(path) else [])
+
+
+def iter_query_log(paths: Iterable[str]) -> Iterator[Dict]:
+    """Yields the records of the given log files line by line.
+    Lines which are not JSON records (e.g. of the former tab-separated format) are skipped."""
+    for path in paths:
+        with open(path, encoding="utf-8") as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and "time" in record:
+                    yield record
+
+
+class LatencyHistogram:
+    """Counts of latencies in LATENCY_BUCKETS, with constant memory regardless of the number of values."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Returns the upper bound of the bucket containing the p-th percentile,
+        None for the unbounded bucket or when there are no values."""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def summary(self) -> Dict:
+        return {
+            "mean": round(self.sum / self.count, 4) if self.count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+        }
+
+
+class _EngineStats:
+    def __init__(self):
+        self.statuses = Counter()
+        self.cache = Counter()
+        self.latency = LatencyHistogram()
+        self.n_results = 0
+
+    def add(self, engine: Dict):
+        self.statuses[engine["status"]] += 1
+        if engine.get("cache"):
+            self.cache[engine["cache"]] += 1
+        if engine.get("latency") is not None:
+            self.latency.add(engine["latency"])
+        self.n_results += engine.get("n_results", 0)
+
+    def summary(self) -> Dict:
+        n_requests = sum(self.statuses.values())
+        return {
+            "requests": n_requests,
+            "statuses": dict(self.statuses),
+            "cache": dict(self.cache),
+            "latency": self.latency.summary(),
+            "mean_results": round(self.n_results / n_requests, 2),
+        }
+
+
+class _DayStats:
+    def __init__(self):
+        self.requests = 0
+        self.searches = 0
+        self.query_types = Counter()
+        self.search_time = LatencyHistogram()
+        self.dedup_ratio = 0.0
+        self.engines: Dict[str, _EngineStats] = defaultdict(_EngineStats)
+
+    def add(self, record: Dict):
+        self.requests += 1
+        self.query_types[record.get("query_type", "other")] += 1
+        self.search_time.add(record.get("search_time", 0.0))
+        if "engines" not in record:
+            return
+        self.searches += 1
+        self.dedup_ratio += record.get("dedup_ratio", 0.0)
+        for name, engine in record["engines"].items():
+            self.engines[name].add(engine)
+
+    def summary(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "searches": self.searches,
+            "query_types": dict(self.query_types),
+            "search_time": self.search_time.summary(),
+            "mean_dedup_ratio": round(self.dedup_ratio / self.searches, 4)
+            if self.searches
+            else None,
+            "engines": {
+                name: stats.summary() for name, stats in sorted(self.engines.items())
+            },
+        }
+
+
+def aggregate_query_log(records: Iterable[Dict]) -> Dict[str, Dict]:
+    """Aggregates query log records into daily statistics: numbers of requests
+    and searches (requests not served from a search session), query types,
+    search time, deduplication ratio and per-engine statuses, cache states,
+    latency and result counts. Latency percentiles are upper bounds of LATENCY_BUCKETS.
+
+    :param records: records as yielded by iter_query_log
+    :return: mapping from a day (YYYY-MM-DD, UTC) to its statistics
+    """
+    days: Dict[str, _DayStats] = defaultdict(_DayStats)
+    for record in records:
+        days[record["time"][:10]].add(record)
+    return {day: stats.summary() for day, stats in sorted(days.items())}
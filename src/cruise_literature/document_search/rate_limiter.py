@@ -0,0 +1,191 @@
+import math
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .circuit_breaker import percentile
+
+LOCK_TIMEOUT = 1
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a token would not be available within the allowed wait time."""
+
+    def __init__(self, name: str, wait: float):
+        super().__init__(f"Rate limit of {name} exceeded, next request in {wait:.2f} seconds")
+        self.name = name
+        self.wait = wait
+
+
+class TokenBucket:
+    """Token bucket rate limiter shared by all workers through the Django cache.
+
+    The bucket holds at most `capacity` tokens and is refilled with `rate` tokens
+    per second. Acquiring a token reserves it, possibly making the balance negative,
+    and the caller sleeps until its reservation is covered by the refill. So callers
+    are served in the order of their requests, and the bucket state is locked only
+    for a single read and write (with `cache.add`, which is atomic in the shared backends).
+
+    Wait times are recorded in process-local metrics.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        capacity: float = 1,
+        cache_alias: str = "default",
+        metrics_window: int = 1000,
+    ):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.cache_alias = cache_alias
+        # engine names contain spaces, which are not valid in memcached keys
+        self.key = f"rate_limiter:{name.replace(' ', '_')}"
+        self.acquired = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.waits: Deque[float] = deque(maxlen=metrics_window)
+        self._metrics_lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @contextmanager
+    def _locked(self):
+        lock_key = f"{self.key}:lock"
+        token = uuid.uuid4().hex
+        while not self.cache.add(lock_key, token, timeout=LOCK_TIMEOUT):
+            time.sleep(0.002)
+        try:
+            yield
+        finally:
+            # the lock expired while held when another worker owns it now
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+    def acquire(self, max_wait: Optional[float] = None) -> float:
+        """Takes a token, sleeping until it is available.
+
+        :param max_wait: maximal time in seconds to wait for the token. None queues
+            as long as needed, 0 fails fast when no token is available right now
+        :return: time in seconds spent waiting
+        :raises RateLimitExceeded: when the token would not be available within max_wait
+        """
+        with self._locked():
+            now = time.time()
+            tokens, updated_at = self.cache.get(self.key) or (self.capacity, now)
+            tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+            wait = max(0.0, (1 - tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                with self._metrics_lock:
+                    self.rejected += 1
+                raise RateLimitExceeded(self.name, wait)
+            self.cache.set(
+                self.key,
+                (tokens - 1, now),
+                timeout=math.ceil((self.capacity + 1) / self.rate) + 60,
+            )
+
+        with self._metrics_lock:
+            self.acquired += 1
+            self.total_wait += wait
+            self.waits.append(wait)
+        _record_measured_wait(wait)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def stats(self) -> Dict:
+        with self._metrics_lock:
+            waits = list(self.waits)
+            return {
+                "rate": self.rate,
+                "capacity": self.capacity,
+                "acquired": self.acquired,
+                "rejected": self.rejected,
+                "total_wait": self.total_wait,
+                "p50_wait": percentile(waits, 50),
+                "p95_wait": percentile(waits, 95),
+                "max_wait": max(waits) if waits else None,
+            }
+
+
+_rate_limiters: Dict[str, TokenBucket] = {}
+_lock = threading.Lock()
+_measured_waits = threading.local()
+
+
+def _record_measured_wait(wait: float):
+    measured = getattr(_measured_waits, "waits", None)
+    if measured is not None:
+        measured.append(wait)
+
+
+@contextmanager
+def measure_waits() -> Iterator[List[float]]:
+    """Collects the waits for tokens acquired by the current thread within the block,
+    e.g. to leave them out of engine latencies. Tokens acquired by tasks of a thread
+    pool are included when the tasks are run with map_measuring_waits."""
+    outer = getattr(_measured_waits, "waits", None)
+    _measured_waits.waits = waits = []
+    try:
+        yield waits
+    finally:
+        _measured_waits.waits = outer
+        if outer is not None:
+            outer.extend(waits)
+
+
+def get_rate_limiter(engine_name: str) -> Optional[TokenBucket]:
+    """Returns the rate limiter of an engine configured in RATE_LIMITS, None if the engine is not limited."""
+    if engine_name not in settings.RATE_LIMITS:
+        return None
+    with _lock:
+        if engine_name not in _rate_limiters:
+            rate, capacity = settings.RATE_LIMITS[engine_name]
+            _rate_limiters[engine_name] = TokenBucket(
+                name=engine_name,
+                rate=rate,
+                capacity=capacity,
+                cache_alias=settings.SEARCH_CACHE_ALIAS,
+            )
+    return _rate_limiters[engine_name]
+
+
+def acquire(engine_name: str, max_wait: Optional[float] = None) -> float:
+    """Takes a token of the engine's rate limiter, see TokenBucket.acquire."""
+    rate_limiter = get_rate_limiter(engine_name)
+    return rate_limiter.acquire(max_wait) if rate_limiter else 0.0
+
+
+def rate_limiter_stats() -> Dict[str, Dict]:
+    """Returns wait time metrics of the rate limiters used in this process."""
+    with _lock:
+        return {name: limiter.stats() for name, limiter in _rate_limiters.items()}
+
+
+def map_measuring_waits(
+    executor: Executor, fn: Callable[[Any], Any], items: Iterable[Any]
+) -> List[Any]:
+    """Like executor.map, with the waits for tokens acquired by the tasks added to the
+    waits measured by the calling thread (see measure_waits). The tasks wait concurrently,
+    so only the longest of their waits delays the caller and is added."""
+
+    def _measured(item: Any) -> Tuple[Any, float]:
+        with measure_waits() as waits:
+            result = fn(item)
+        return result, sum(waits)
+
+    results = list(executor.map(_measured, items))
+    _record_measured_wait(max((wait for _, wait in results), default=0.0))
+    return [result for result, _ in results]
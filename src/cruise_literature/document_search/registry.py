@@ -0,0 +1,362 @@
+import functools
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from .cache import get_search_result_cache
+from .circuit_breaker import get_circuit_breaker
+from .fan_out import fan_out
+from .metrics import record_engine_call
+from .models import SearchEngine
+from .rate_limiter import measure_waits
+from .search_core import search_core
+from .search_cruise import search_cruise, search_cruise_batch
+from .search_google_scholar import search_google_scholar
+from .search_pubmed import search_pubmed
+from .search_semantic_scholar import search_semantic_scholar
+from .utils import Articles, SearchResultWithStatus, merge_results
+
+
+@dataclass(frozen=True)
+class SearchEngineAdapter:
+    """Wraps a search method together with the capabilities of the search engine.
+
+    :param name: name of the engine used in the search result status dicts
+    :param search_method: function accepting (query, top_k, timeout, rate_limit_wait)
+        and returning SearchResultWithStatus
+    :param max_top_k: maximal number of results which can be requested in a single search
+    :param supports_boolean_queries: True if AND/OR/NOT operators are interpreted by the engine,
+        other engines get the queries without the operators (see strip_boolean_operators)
+    :param expected_latency: typical response time in seconds, the request timeout is derived
+        from it until the circuit breaker has recorded enough calls
+    :param merge_priority: engines with lower priority come first when merging results
+    :param batch_search_method: function accepting (searches, timeout, rate_limit_wait) and
+        running several searches in one request, see search_batch()
+    """
+
+    name: str
+    search_method: Callable[..., SearchResultWithStatus]
+    max_top_k: int
+    supports_boolean_queries: bool = False
+    expected_latency: float = 1.0
+    merge_priority: int = 100
+    batch_search_method: Optional[Callable[..., List[SearchResultWithStatus]]] = None
+
+    def search(
+        self, query: str, top_k: int, rate_limit_wait: Optional[float] = None
+    ) -> SearchResultWithStatus:
+        """Runs the search method behind the engine's circuit breaker.
+        When the circuit is open the engine is not called at all.
+
+        :param rate_limit_wait: maximal time in seconds to wait for the engine's rate
+            limiter, None queues as long as needed (e.g. for reviews), 0 fails fast
+        """
+        circuit_breaker = get_circuit_breaker(self.name)
+        if circuit_breaker.is_open():
+            return failed_search(self.name, query, "CIRCUIT_OPEN", 503)
+
+        start = time.monotonic()
+        with measure_waits() as waits:
+            try:
+                result = self.search_method(
+                    self.engine_query(query),
+                    min(top_k, self.max_top_k),
+                    timeout=circuit_breaker.timeout(self.expected_latency),
+                    rate_limit_wait=rate_limit_wait,
+                )
+            except Exception:
+                circuit_breaker.record(_engine_latency(start, waits), ok=False)
+                raise
+        if result["status"] != "RATE_LIMITED":
+            # when throttled by our own rate limiter the engine was not called
+            circuit_breaker.record(
+                _engine_latency(start, waits), ok=is_successful_status(result["status_code"])
+            )
+        # statuses are matched by the query the user typed
+        return {**result, "search_query": query}
+
+    def engine_query(self, query: str) -> str:
+        """Returns the query as it is sent to the engine."""
+        return query if self.supports_boolean_queries else strip_boolean_operators(query)
+
+    def search_batch(
+        self, searches: List[Dict[str, Any]], rate_limit_wait: Optional[float] = None
+    ) -> List[SearchResultWithStatus]:
+        """Runs several searches, dicts with the "query" and "top_k" keys, and returns their
+        results in the same order. Engines with a batch search method answer all of them
+        in one request, the others are searched one query after another."""
+        if self.batch_search_method is None:
+            return [
+                self.search(search["query"], search["top_k"], rate_limit_wait=rate_limit_wait)
+                for search in searches
+            ]
+        if not searches:
+            return []
+        circuit_breaker = get_circuit_breaker(self.name)
+        if circuit_breaker.is_open():
+            return [
+                failed_search(self.name, search["query"], "CIRCUIT_OPEN", 503)
+                for search in searches
+            ]
+
+        original_searches = searches
+        searches = [
+            {
+                **search,
+                "query": self.engine_query(search["query"]),
+                "top_k": min(search["top_k"], self.max_top_k),
+            }
+            for search in searches
+        ]
+        start = time.monotonic()
+        with measure_waits() as waits:
+            try:
+                # the timeout derived from single searches is too short for a batch
+                results = self.batch_search_method(
+                    searches, timeout=circuit_breaker.max_timeout, rate_limit_wait=rate_limit_wait
+                )
+            except Exception:
+                circuit_breaker.record(_engine_latency(start, waits), ok=False)
+                raise
+        if not all(result["status"] == "RATE_LIMITED" for result in results):
+            # recorded as a single search, with the latency per search of the batch
+            circuit_breaker.record(
+                _engine_latency(start, waits) / len(searches),
+                ok=all(is_successful_status(result["status_code"]) for result in results),
+            )
+        for result, search in zip(results, original_searches):
+            result["search_query"] = search["query"]
+        return results
+
+    def request_deadline(self) -> float:
+        """Time in seconds the fan-out waits for this engine: the request timeout
+        derived by the circuit breaker plus a grace period for parsing the response."""
+        return (
+            get_circuit_breaker(self.name).timeout(self.expected_latency)
+            + settings.SEARCH_ENGINE_GRACE_PERIOD
+        )
+
+
+# adapters are keyed by the dotted path stored in SearchEngine.search_method
+ADAPTERS: Dict[str, SearchEngineAdapter] = {
+    "document_search.search_semantic_scholar.search_semantic_scholar": SearchEngineAdapter(
+        name="Semantic Scholar",
+        search_method=search_semantic_scholar,
+        max_top_k=1000,
+        expected_latency=1.5,
+        merge_priority=0,
+    ),
+    "document_search.search_core.search_core": SearchEngineAdapter(
+        name="CORE",
+        search_method=search_core,
+        max_top_k=100,
+        expected_latency=3.0,
+        merge_priority=1,
+    ),
+    "document_search.search_cruise.search_cruise": SearchEngineAdapter(
+        name="CRUISE",
+        search_method=search_cruise,
+        batch_search_method=search_cruise_batch,
+        max_top_k=10000,
+        expected_latency=0.3,
+        merge_priority=2,
+    ),
+    "document_search.search_pubmed.search_pubmed": SearchEngineAdapter(
+        name="PubMed",
+        search_method=search_pubmed,
+        max_top_k=10000,
+        supports_boolean_queries=True,
+        expected_latency=2.0,
+        merge_priority=3,
+    ),
+    "document_search.search_google_scholar.search_google_scholar": SearchEngineAdapter(
+        name="Google Scholar",
+        search_method=search_google_scholar,
+        max_top_k=100,
+        expected_latency=0.1,
+        merge_priority=4,
+    ),
+}
+
+
+class SearchEngineRegistry:
+    """In-process registry of search engines and their adapters.
+
+    SearchEngine rows are loaded from the database once and kept in memory.
+    The cached rows are dropped whenever a SearchEngine is saved or deleted
+    (see document_search.signals).
+    """
+
+    def __init__(self, adapters: Dict[str, SearchEngineAdapter]):
+        self.adapters = adapters
+        self._engines: Optional[List[SearchEngine]] = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._engines = None
+
+    def get_engines(
+        self, for_search: bool = False, for_review: bool = False
+    ) -> List[SearchEngine]:
+        """Returns configured search engines which have an adapter."""
+        engines = self._engines
+        if engines is None:
+            engines = [
+                engine
+                for engine in SearchEngine.objects.order_by("id")
+                if engine.search_method in self.adapters
+            ]
+            with self._lock:
+                self._engines = engines
+        return [
+            engine
+            for engine in engines
+            if (not for_search or engine.is_available_for_search)
+            and (not for_review or engine.is_available_for_review)
+        ]
+
+    def get_engine(self, engine_id: int) -> Optional[SearchEngine]:
+        return next((e for e in self.get_engines() if e.id == engine_id), None)
+
+    def get_adapter(self, search_engine: SearchEngine) -> SearchEngineAdapter:
+        return self.adapters[search_engine.search_method]
+
+    def get_adapter_by_name(self, name: str) -> Optional[SearchEngineAdapter]:
+        """Returns the adapter with the given name as used in the search result statuses."""
+        return next((a for a in self.adapters.values() if a.name == name), None)
+
+    def iter_search(
+        self,
+        search_engines: Iterable[SearchEngine],
+        query: str,
+        top_k: int,
+        use_cache: bool = True,
+    ) -> Iterator[Tuple[SearchEngineAdapter, SearchResultWithStatus]]:
+        """Queries all the given search engines in parallel and yields their
+        results as soon as each engine answers. Engines which do not answer
+        before their deadline are yielded with the TIMEOUT status.
+        Every result carries the time in seconds the engine took to answer ("latency"),
+        for timed out engines it is the time waited.
+
+        :param search_engines: any subset of configured search engines
+        :param query: a search query
+        :param top_k: number of results to return from each search engine
+        :param use_cache: if True, responses are served from the search result cache when available
+        :return: iterator of (adapter, search result with status) tuples
+        """
+        search_result_cache = get_search_result_cache()
+        adapters = {
+            engine.name: self.get_adapter(engine) for engine in search_engines
+        }
+        tasks = {}
+        for engine_name, adapter in adapters.items():
+            search_method = functools.partial(
+                adapter.search, rate_limit_wait=settings.RATE_LIMIT_MAX_WAIT
+            )
+            if use_cache:
+                tasks[engine_name] = functools.partial(
+                    search_result_cache.search, engine_name, search_method, query, top_k
+                )
+            else:
+                tasks[engine_name] = functools.partial(search_method, query, top_k)
+        timeouts = {
+            engine_name: adapter.request_deadline()
+            for engine_name, adapter in adapters.items()
+        }
+
+        start = time.monotonic()
+        for engine_name, result, exception in fan_out(
+            {engine_name: _timed(task) for engine_name, task in tasks.items()},
+            timeouts=timeouts,
+            total_budget=settings.SEARCH_TOTAL_TIMEOUT,
+        ):
+            adapter = adapters[engine_name]
+            if isinstance(exception, TimeoutError):
+                result = failed_search(adapter.name, query, "TIMEOUT", 504)
+            elif exception:
+                result = failed_search(adapter.name, query, "ERROR", 500)
+            if "latency" not in result:
+                result["latency"] = time.monotonic() - start
+            record_engine_call(
+                adapter.name,
+                result["latency"],
+                result["status"],
+                result["status_code"],
+                cache_state=result.get("cache"),
+            )
+            yield adapter, result
+
+    def search(
+        self,
+        search_engines: Iterable[SearchEngine],
+        query: str,
+        top_k: int,
+        use_cache: bool = True,
+    ) -> Tuple[Articles, List[SearchResultWithStatus]]:
+        """Queries all the given search engines in parallel and merges their results.
+        Only the results which arrived before the engines' deadlines are merged.
+
+        :return: a list of merged articles and a list of per-engine statuses
+        """
+        results = sorted(
+            self.iter_search(search_engines, query, top_k, use_cache=use_cache),
+            key=lambda item: item[0].merge_priority,
+        )
+        merged_results = merge_results([result["results"] for _, result in results])
+        return merged_results, [result for _, result in results]
+
+
+def _engine_latency(start: float, rate_limit_waits: List[float]) -> float:
+    """Time since start without the time spent waiting for the rate limiter,
+    which says nothing about the engine's latency."""
+    return max(0.0, time.monotonic() - start - sum(rate_limit_waits))
+
+
+# a term excluded with NOT is a word, a quoted phrase or a group in parentheses
+_NOT_CLAUSE = re.compile(r'\bNOT\s+(\([^()]*\)|"[^"]*"|\S+)')
+_OPERATORS = re.compile(r"\b(?:AND|OR)\b|[()]")
+
+
+def strip_boolean_operators(query: str) -> str:
+    """Removes the AND/OR/NOT operators (upper case only) of a query, for engines which
+    would search them as words. Terms excluded with NOT are removed with the operator."""
+    query = _OPERATORS.sub(" ", _NOT_CLAUSE.sub(" ", query))
+    return " ".join(query.split())
+
+
+def _timed(task: Callable[[], SearchResultWithStatus]) -> Callable[[], SearchResultWithStatus]:
+    """Wraps a search task to add the time it took to its result. The result can be
+    shared with the search result cache, so a copy is returned."""
+
+    def timed_task() -> SearchResultWithStatus:
+        start = time.monotonic()
+        result = task()
+        return {**result, "latency": time.monotonic() - start}
+
+    return timed_task
+
+
+def is_successful_status(status_code: int) -> bool:
+    """Server errors, timeouts and rate limiting count as failures of the engine.
+    501 is returned by engines which are switched off in the settings."""
+    return status_code == 501 or (status_code < 500 and status_code != 429)
+
+
+def failed_search(
+    engine_name: str, search_query: str, status: str, status_code: int
+) -> SearchResultWithStatus:
+    return {
+        "results": [],
+        "status": status,
+        "status_code": status_code,
+        "search_engine": engine_name,
+        "search_query": search_query,
+    }
+
+
+search_engine_registry = SearchEngineRegistry(ADAPTERS)
@@ -1,13 +1,16 @@
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 import requests
 import os
+from django.conf import settings
 from cruise_literature.settings import SEARCH_WITH_CORE
+from document_search.rate_limiter import RateLimitExceeded, acquire
 from document_search.utils import SearchResultWithStatus
 
 from utils.article import Article
 
 from utils.article import Author
+from utils.http import get_session
 
 if SEARCH_WITH_CORE:
     CURRENT_FILE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
@@ -20,9 +23,6 @@ if SEARCH_WITH_CORE:
                 f"You need to update CORE API key in {api_key_file} in order to use CORE search"
             )
 
-api_endpoint = "https://api.core.ac.uk/v3/search/works"
-
-
 def _get_authors(authors_list: List[Dict[str, str]]) -> List[Author]:
     return [
         Author(
@@ -32,7 +32,17 @@ def _get_authors(authors_list: List[Dict[str, str]]) -> List[Author]:
     ]
 
 
-def search_core(query: str, top_k: int) -> SearchResultWithStatus:
+def search_core(
+    query: str,
+    top_k: int,
+    timeout: Optional[float] = None,
+    rate_limit_wait: Optional[float] = None,
+) -> SearchResultWithStatus:
+    """Search CORE publications aggregator.
+    :param timeout: request timeout in seconds, None waits indefinitely
+    :param rate_limit_wait: maximal time in seconds to wait for the rate limiter,
+        None waits as long as needed, 0 fails fast
+    """
     if not SEARCH_WITH_CORE:
         return {
             "results": [],
@@ -46,7 +56,27 @@ def search_core(query: str, top_k: int) -> SearchResultWithStatus:
         "limit": str(top_k),
     }
     headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
-    response = requests.post(url=api_endpoint, headers=headers, json=data)
+    try:
+        acquire("CORE", max_wait=rate_limit_wait)
+        response = get_session("core").post(
+            url=settings.CORE_API_ENDPOINT, headers=headers, json=data, timeout=timeout
+        )
+    except RateLimitExceeded:
+        return {
+            "results": [],
+            "status": "RATE_LIMITED",
+            "status_code": 429,
+            "search_engine": "CORE",
+            "search_query": query,
+        }
+    except requests.exceptions.RequestException as e:
+        return {
+            "results": [],
+            "status": "ERROR",
+            "status_code": 504 if isinstance(e, requests.exceptions.Timeout) else 503,
+            "search_engine": "CORE",
+            "search_query": query,
+        }
     candidate_list = []
     if response.status_code == 200:
         for index_i, candidate in enumerate(response.json()["results"]):
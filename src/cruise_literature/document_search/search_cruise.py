@@ -1,135 +1,167 @@
+import contextlib
+import importlib.util
 import json
-import re
-from typing import List
+import logging
+import os
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import requests
+from django.conf import settings
 
+from document_search.circuit_breaker import get_circuit_breaker
+from document_search.rate_limiter import RateLimitExceeded, acquire
 from document_search.utils import SearchResultWithStatus
-from utils.article import Article
+from utils.http import get_session
+from utils.article import Article, LazyArticle
+from utils.display_fields import display_fields
 
 
-def highlighter(doc: str, es_highlighted_texts: List[str]):
-    pattern = re.compile(r"<em>(.*?)</em>")
-    highlight_terms = []
-    for line in es_highlighted_texts:
-        highlight_terms += re.findall(pattern, line)
+def _load_query_builder():
+    """Loads the query builder of search_app, which is not a package of this project."""
+    spec = importlib.util.spec_from_file_location(
+        "search_app_query_builder",
+        os.path.join(settings.SEARCH_APP_DIR, "query_builder.py"),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
-    highlighted_abstract = ""
-    highlighted_snippet = ""
-    for term in doc.split():
-        if re.sub(r"\W", "", term) in highlight_terms:
-            term = f"<em>{term}</em>"
-        term += " "
-        highlighted_abstract += term
-        if len(highlighted_snippet) < 160:
-            highlighted_snippet += term
 
-    return highlighted_abstract[:-1], highlighted_snippet[:-1]
+query_builder = _load_query_builder()
 
 
-def search_cruise(query: str, top_k: int) -> SearchResultWithStatus:
-    """Search internal elasticsearch database."""
-    index_name = "papers"
-    headers = {"Content-type": "application/json"}
+def _source_includes() -> List[str]:
+    """Fields of the documents requested directly from elasticsearch, see CRUISE_SOURCE_INCLUDES."""
+    return settings.CRUISE_SOURCE_INCLUDES or query_builder.SOURCE_INCLUDES
+
+
+class CruiseStreamError(Exception):
+    """A page of the streamed CRUISE results could not be retrieved."""
+
+    def __init__(self, message: str, status_code: int = 502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def article_from_hit(hit: Dict[str, Any]) -> Article:
+    """Builds the Article of an elasticsearch hit. The display fields are computed
+    at index time, documents indexed without them get them computed here."""
+    source = hit["_source"]
+    display = source.get("display") or display_fields(source)
+    authors = [
+        author["name"] for author in source.get("authors") or [] if "name" in author
+    ]
+    return Article(
+        id=hit["_id"],
+        title=source.get("title", ""),
+        url=display["url"],
+        pdf=source.get("pdf"),
+        snippet=display["snippet"],
+        abstract=source.get("abstract") or "",
+        authors=", ".join(authors),
+        publication_date=source.get("year"),
+        venue=display["venue"],
+        keywords_snippet=display["keywords_snippet"],
+        keywords_rest=display["keywords_rest"],
+        CSO_keywords=(source.get("CSO_keywords") or {}).get("union"),
+        # TODO: learn why citation is equal to 0
+        n_citations=display["n_citations"] or "-",
+        n_references=display["n_references"],
+        doi=source.get("doi"),
+    )
+
+
+def _failed(query: str, status: str, status_code: int) -> SearchResultWithStatus:
+    return {
+        "results": [],
+        "status": status,
+        "status_code": status_code,
+        "search_engine": "CRUISE",
+        "search_query": query,
+    }
+
+
+def _post(
+    session_name: str,
+    url: str,
+    data: str,
+    content_type: str,
+    timeout: Optional[float],
+    rate_limit_wait: Optional[float],
+) -> Tuple[Optional[requests.Response], str, int]:
+    """Sends a request to CRUISE once the rate limiter lets it through.
+    Returns the response, or None with the status and status code of the failure."""
     try:
-        res = requests.post(
-            "http://localhost:9880" + "/api/v1/search",
-            data=json.dumps(
-                {"query": query, "es_index": index_name, "es_top_k": top_k}
-            ),
-            headers=headers,
+        acquire("CRUISE", max_wait=rate_limit_wait)
+        res = get_session(session_name).post(
+            url, data=data, headers={"Content-type": content_type}, timeout=timeout
         )
+    except RateLimitExceeded:
+        return None, "RATE_LIMITED", 429
+    except requests.exceptions.Timeout:
+        return None, "ERROR", 504
     except requests.exceptions.ConnectionError:
-        return {
-            "results": [],
-            "status": "ERROR",
-            "status_code": 503,
-            "search_engine": "CRUISE",
-            "search_query": query,
-        }
+        return None, "ERROR", 503
     if res.status_code != 200:
-        return {
-            "results": [],
-            "status": "ERROR",
-            "status_code": res.status_code,
-            "search_engine": "CRUISE",
-            "search_query": query,
-        }
-
-    results = res.json()["results"]
-    candidate_list = []
-    for candidate in results["hits"]["hits"]:
-        doc_text = candidate["_source"].get("abstract")
-        if doc_text and "abstract" in candidate["highlight"]:
-            abstract, snippet = highlighter(
-                doc_text, candidate["highlight"]["abstract"]
-            )
-        else:
-            abstract = candidate["_source"].get("abstract")
-            snippet = candidate["_source"].get("abstract")[:300]
+        return None, "ERROR", res.status_code
+    return res, "OK", 200
 
-        if authors_raw := candidate["_source"].get("authors"):
-            author_details = [
-                author["name"] for author in authors_raw if "name" in author
-            ]
-        else:
-            author_details = []
-
-        citations = len(candidate["_source"].get("n_citations"))
-        if citations == 0:  # TODO: learn why citation is equal to 0
-            citations = "-"
-        references = len(candidate["_source"].get("references"))
-
-        venue_raw = candidate["_source"].get("venue")
-        if venue_raw and venue_raw.get("name_d"):
-            venue = venue_raw.get("name_d")
-        elif venue_raw and venue_raw.get("raw"):
-            venue = venue_raw.get("raw")
-        else:
-            venue = ""
-
-        pdf = candidate["_source"].get("pdf")
-        doi = candidate["_source"].get("doi")
-
-        url_candidates = candidate["_source"].get("url")
-        url = ""
-        if url_candidates:
-            url = url_candidates[0]
-
-        keywords_snippet = {}
-        keywords_rest = {}
-        for index_i, (k, v) in enumerate(
-            sorted(
-                candidate["_source"].get("keywords").items(),
-                key=lambda item: item[1],
-                reverse=True,
-            )
-        ):
-            if index_i < 6:
-                keywords_snippet[k] = v
-            else:
-                keywords_rest[k] = v
-
-        retrieved_art = Article(
-            id=candidate["_id"],
-            title=candidate["_source"].get("title", ""),
-            url=url,
-            pdf=pdf,
-            snippet=snippet,
-            abstract=abstract,
-            authors=", ".join(author_details),
-            publication_date=candidate["_source"].get("year"),
-            venue=venue,
-            keywords_snippet=keywords_snippet,
-            keywords_rest=keywords_rest,
-            CSO_keywords=candidate["_source"].get("CSO_keywords")["union"],
-            n_citations=citations,
-            n_references=references,
-            doi=doi,
+
+def _lazy_articles(hits: List[Dict[str, Any]]) -> List[LazyArticle]:
+    return [
+        LazyArticle(
+            id=hit["_id"],
+            title=hit["_source"].get("title", ""),
+            doi=hit["_source"].get("doi"),
+            raw=hit,
+            build=article_from_hit,
         )
-        candidate_list.append(retrieved_art)
+        for hit in hits
+    ]
+
+
+def search_cruise(
+    query: str,
+    top_k: int,
+    timeout: Optional[float] = None,
+    rate_limit_wait: Optional[float] = None,
+) -> SearchResultWithStatus:
+    """Search internal elasticsearch database, through the search_app API or,
+    with CRUISE_ELASTICSEARCH_URL set, directly.
+    Results are LazyArticles, converted to Articles only when displayed.
+    :param timeout: request timeout in seconds, None waits indefinitely
+    :param rate_limit_wait: maximal time in seconds to wait for the rate limiter,
+        None waits as long as needed, 0 fails fast
+    """
+    index_name = "papers"
+    if settings.CRUISE_ELASTICSEARCH_URL:
+        res, status, status_code = _post(
+            "elasticsearch",
+            f"{settings.CRUISE_ELASTICSEARCH_URL}/{index_name}/_search",
+            json.dumps(
+                query_builder.build_query(query, top_k, source_includes=_source_includes())
+            ),
+            "application/json",
+            timeout,
+            rate_limit_wait,
+        )
+    else:
+        res, status, status_code = _post(
+            "cruise",
+            f"{settings.CRUISE_API_ENDPOINT}/search",
+            json.dumps({"query": query, "es_index": index_name, "es_top_k": top_k}),
+            "application/json",
+            timeout,
+            rate_limit_wait,
+        )
+    if res is None:
+        return _failed(query, status, status_code)
+
+    # search_app wraps the elasticsearch response
+    results = res.json() if settings.CRUISE_ELASTICSEARCH_URL else res.json()["results"]
     return {
-        "results": candidate_list,
+        "results": _lazy_articles(results["hits"]["hits"]),
         "status": "OK",
         "status_code": 200,
         "search_engine": "CRUISE",
@@ -137,23 +169,231 @@ def search_cruise(query: str, top_k: int) -> SearchResultWithStatus:
     }
 
 
-def merge_results(
-    internal_search_results: List[Article],
-    core_search_results: List[Article],
-    semantic_scholar_results: List[Article],
-) -> List[Article]:
-    output_results_dict = {
-        item.title.lower().strip(): item for item in semantic_scholar_results
-    }
-    for _item in core_search_results:
-        if _item.title.lower() not in output_results_dict.keys():
-            semantic_scholar_results.append(_item)
+def search_cruise_batch(
+    searches: List[Dict[str, Any]],
+    timeout: Optional[float] = None,
+    rate_limit_wait: Optional[float] = None,
+) -> List[SearchResultWithStatus]:
+    """Runs several CRUISE searches in one round trip, with the _msearch request of elasticsearch.
+    Searches are dicts with the "query", "top_k" and optional "filters" keys
+    (see build_filters of the query builder).
+    Returns the result of each search, in the order of the searches. When the request
+    fails, all the searches fail; a search rejected by elasticsearch fails alone.
+    Searches with top_k >= CRUISE_STREAM_MIN_TOP_K are streamed, see search_cruise_stream().
+    """
+    if not searches:
+        return []
+    if any(search["top_k"] >= settings.CRUISE_STREAM_MIN_TOP_K for search in searches):
+        # searches with many results are streamed page by page, the others are batched
+        batched = iter(
+            search_cruise_batch(
+                [s for s in searches if s["top_k"] < settings.CRUISE_STREAM_MIN_TOP_K],
+                timeout=timeout,
+                rate_limit_wait=rate_limit_wait,
+            )
+        )
+        return [
+            search_cruise_stream(
+                search["query"],
+                search["top_k"],
+                filters=search.get("filters"),
+                timeout=timeout,
+                rate_limit_wait=rate_limit_wait,
+            )
+            if search["top_k"] >= settings.CRUISE_STREAM_MIN_TOP_K
+            else next(batched)
+            for search in searches
+        ]
+    index_name = "papers"
+    es_searches = [
+        {"query": search["query"], "es_top_k": search["top_k"], "filters": search.get("filters")}
+        for search in searches
+    ]
+    if settings.CRUISE_ELASTICSEARCH_URL:
+        body, _ = query_builder.build_msearch(
+            index_name, es_searches, source_includes=_source_includes()
+        )
+        res, status, status_code = _post(
+            "elasticsearch",
+            f"{settings.CRUISE_ELASTICSEARCH_URL}/_msearch",
+            body,
+            "application/x-ndjson",
+            timeout,
+            rate_limit_wait,
+        )
+    else:
+        res, status, status_code = _post(
+            "cruise",
+            f"{settings.CRUISE_API_ENDPOINT}/msearch",
+            json.dumps({"es_index": index_name, "searches": es_searches}),
+            "application/json",
+            timeout,
+            rate_limit_wait,
+        )
+    if res is None:
+        return [_failed(search["query"], status, status_code) for search in searches]
+
+    results = res.json() if settings.CRUISE_ELASTICSEARCH_URL else res.json()["results"]
+    search_results = []
+    for search, response in zip(searches, results["responses"]):
+        if "error" in response:
+            search_results.append(_failed(search["query"], "ERROR", response.get("status", 500)))
+            continue
+        search_results.append(
+            {
+                "results": _lazy_articles(response["hits"]["hits"]),
+                "status": "OK",
+                "status_code": 200,
+                "search_engine": "CRUISE",
+                "search_query": search["query"],
+            }
+        )
+    return search_results
+
 
-    output_results_dict = {
-        item.title.lower().strip(): item for item in semantic_scholar_results
+def search_cruise_stream(
+    query: str,
+    top_k: int,
+    filters: Optional[Dict[str, Any]] = None,
+    timeout: Optional[float] = None,
+    rate_limit_wait: Optional[float] = None,
+) -> SearchResultWithStatus:
+    """Search with many results (thousands), retrieved page by page with a point in time
+    and search_after of elasticsearch, so top_k is not limited by the result window.
+    The results are a generator of LazyArticles, which can be consumed once. Nothing is
+    requested before they are consumed, and only the page being consumed is kept in memory.
+    The status is not known in advance: when a page fails, the results end early, the
+    status of the returned dict is changed to the failure and the failure is recorded
+    by the circuit breaker of CRUISE. Check the status after consuming the results.
+    """
+    result = {
+        "results": [],
+        "status": "OK",
+        "status_code": 200,
+        "search_engine": "CRUISE",
+        "search_query": query,
     }
-    for _item in internal_search_results:
-        if _item.title.lower() not in output_results_dict.keys():
-            semantic_scholar_results.append(_item)
+    result["results"] = _stream_results(result, top_k, filters, timeout, rate_limit_wait)
+    return result
+
+
+def _stream_results(
+    result: SearchResultWithStatus,
+    top_k: int,
+    filters: Optional[Dict[str, Any]],
+    timeout: Optional[float],
+    rate_limit_wait: Optional[float],
+) -> Iterator[LazyArticle]:
+    query = result["search_query"]
+    try:
+        acquire("CRUISE", max_wait=rate_limit_wait)
+    except RateLimitExceeded:
+        result.update(status="RATE_LIMITED", status_code=429)
+        return
+    start = time.monotonic()
+    try:
+        if settings.CRUISE_ELASTICSEARCH_URL:
+            pages = _elasticsearch_pages("papers", query, top_k, filters, timeout)
+        else:
+            pages = _search_app_pages("papers", query, top_k, filters, timeout)
+        with contextlib.closing(pages):
+            for hits in pages:
+                yield from _lazy_articles(hits)
+    except (CruiseStreamError, requests.exceptions.RequestException) as e:
+        if isinstance(e, CruiseStreamError):
+            status_code = e.status_code
+        elif isinstance(e, requests.exceptions.Timeout):
+            status_code = 504
+        elif isinstance(e, requests.exceptions.ConnectionError):
+            status_code = 503
+        else:
+            status_code = 502
+        result.update(status="ERROR", status_code=status_code)
+        get_circuit_breaker("CRUISE").record(time.monotonic() - start, ok=False)
+        logging.warning(f"CRUISE results of '{query}' end early: {e!r}")
 
-    return semantic_scholar_results
+
+def _search_app_pages(
+    index_name: str,
+    query: str,
+    top_k: int,
+    filters: Optional[Dict[str, Any]],
+    timeout: Optional[float],
+) -> Iterator[List[Dict[str, Any]]]:
+    """Reads the NDJSON pages streamed by the search_stream endpoint of search_app."""
+    res = get_session("cruise").post(
+        f"{settings.CRUISE_API_ENDPOINT}/search_stream",
+        data=json.dumps(
+            {
+                "query": query,
+                "es_index": index_name,
+                "es_top_k": top_k,
+                "filters": filters,
+                "page_size": settings.CRUISE_STREAM_PAGE_SIZE,
+            }
+        ),
+        headers={"Content-type": "application/json"},
+        timeout=timeout,
+        stream=True,
+    )
+    with res:
+        if res.status_code != 200:
+            raise CruiseStreamError(f"search_app answered {res.status_code}", res.status_code)
+        for line in res.iter_lines():
+            if not line:
+                continue
+            page = json.loads(line)
+            if "hits" in page:
+                yield page["hits"]
+            elif "error" in page:
+                raise CruiseStreamError(
+                    f"elasticsearch answered {page['status']}", page["status"]
+                )
+            elif page.get("done"):
+                return
+    raise CruiseStreamError("the stream ended before its last page")
+
+
+def _elasticsearch_pages(
+    index_name: str,
+    query: str,
+    top_k: int,
+    filters: Optional[Dict[str, Any]],
+    timeout: Optional[float],
+) -> Iterator[List[Dict[str, Any]]]:
+    """Retrieves the pages directly from elasticsearch, like the search_stream endpoint."""
+    session = get_session("elasticsearch")
+    url = settings.CRUISE_ELASTICSEARCH_URL
+    res = session.post(
+        f"{url}/{index_name}/_pit",
+        params={"keep_alive": query_builder.PIT_KEEP_ALIVE},
+        timeout=timeout,
+    )
+    if res.status_code != 200:
+        raise CruiseStreamError(f"elasticsearch answered {res.status_code}", res.status_code)
+    cursor = query_builder.DeepSearchCursor(
+        query,
+        top_k,
+        pit_id=res.json()["id"],
+        page_size=settings.CRUISE_STREAM_PAGE_SIZE,
+        source_includes=_source_includes(),
+        filters=filters,
+    )
+    try:
+        while (query_data := cursor.next_query()) is not None:
+            res = session.post(
+                f"{url}/_search",
+                data=json.dumps(query_data),
+                headers={"Content-type": "application/json"},
+                timeout=timeout,
+            )
+            if res.status_code != 200:
+                raise CruiseStreamError(
+                    f"elasticsearch answered {res.status_code}", res.status_code
+                )
+            yield cursor.advance(res.json())
+    finally:
+        try:
+            session.delete(f"{url}/_pit", json={"id": cursor.pit_id}, timeout=timeout)
+        except requests.exceptions.RequestException:
+            pass  # the point in time expires after its keep alive
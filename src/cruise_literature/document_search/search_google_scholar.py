@@ -1,4 +1,5 @@
-from typing import List
+import datetime
+from typing import List, Optional
 
 import fake_useragent
 
@@ -7,6 +8,15 @@ try:
 except fake_useragent.errors.FakeUserAgentError:
     scholarly = None
 
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from document_search.cache import normalize_query
+from document_search.models import ScholarSearchJob
+from document_search.rate_limiter import RateLimitExceeded, acquire
+from document_search.signals import scholar_search_finished
 from document_search.utils import SearchResultWithStatus
 from utils.article import Article
 from utils.article import Author
@@ -44,7 +54,17 @@ def revert_snippet(snippet: str) -> str:
     return new_snippet
 
 
-def search_google_scholar(query: str, top_k: int) -> SearchResultWithStatus:
+# scholarly requests a new page of results for every 10 results
+RESULTS_PER_PAGE = 10
+
+
+def scrape_google_scholar(
+    query: str, top_k: int, rate_limit_wait: Optional[float] = None
+) -> SearchResultWithStatus:
+    """Search Google Scholar with scholarly. Scraping takes from seconds to minutes,
+    so it is run only by the run_scholar_worker command.
+    `rate_limit_wait` is the maximal time in seconds to wait for the rate limiter
+    before each page of results, None waits as long as needed, 0 fails fast."""
     if scholarly is None:
         return {
             "results": [],
@@ -54,6 +74,16 @@ def search_google_scholar(query: str, top_k: int) -> SearchResultWithStatus:
             "search_query": query,
         }
 
+    try:
+        acquire("Google Scholar", max_wait=rate_limit_wait)
+    except RateLimitExceeded:
+        return {
+            "results": [],
+            "status": "RATE_LIMITED",
+            "status_code": 429,
+            "search_engine": "Google Scholar",
+            "search_query": query,
+        }
     pubs = scholarly.search_pubs(query, patents=False)
 
     candidate_list = []
@@ -96,6 +126,12 @@ def search_google_scholar(query: str, top_k: int) -> SearchResultWithStatus:
         )
         candidate_list.append(retrieved_art)
 
+        if (index_i + 1) % RESULTS_PER_PAGE == 0 and index_i < top_k:
+            try:
+                acquire("Google Scholar", max_wait=rate_limit_wait)
+            except RateLimitExceeded:
+                break
+
     if candidate_list:
         _status = "OK"
         _status_code = 200
@@ -110,3 +146,117 @@ def search_google_scholar(query: str, top_k: int) -> SearchResultWithStatus:
         "search_engine": "Google Scholar",
         "search_query": query,
     }
+
+
+def search_google_scholar(
+    query: str,
+    top_k: int,
+    timeout: Optional[float] = None,
+    rate_limit_wait: Optional[float] = None,
+) -> SearchResultWithStatus:
+    """Returns Google Scholar results stored by the scholar worker.
+    If there are no (fresh enough) results for the query, a search job is queued and
+    the PENDING status is returned right away. The results are available to the next
+    call once the worker finishes the job. A failed search is reported as ERROR until
+    it is retried, after GOOGLE_SCHOLAR_RETRY_AFTER seconds.
+    `timeout` and `rate_limit_wait` are unused, Google Scholar is not called here.
+    """
+    job = get_scholar_search_job(query, top_k)
+    if job.status == ScholarSearchJob.Status.DONE:
+        return {
+            "results": [Article(**paper) for paper in job.results[:top_k]],
+            "status": "OK",
+            "status_code": 200,
+            "search_engine": "Google Scholar",
+            "search_query": query,
+        }
+    if job.status == ScholarSearchJob.Status.FAILED:
+        return {
+            "results": [],
+            "status": "ERROR",
+            "status_code": 503,
+            "search_engine": "Google Scholar",
+            "search_query": query,
+        }
+    return {
+        "results": [],
+        "status": "PENDING",
+        "status_code": 202,
+        "search_engine": "Google Scholar",
+        "search_query": query,
+    }
+
+
+def get_scholar_search_job(query: str, top_k: int) -> ScholarSearchJob:
+    """Returns the search job of the query. A new job is queued when there is none,
+    when the stored results are expired or shorter than top_k, or when the last
+    attempt failed more than GOOGLE_SCHOLAR_RETRY_AFTER seconds ago."""
+    now = timezone.now()
+    job, created = ScholarSearchJob.objects.get_or_create(
+        query=normalize_query(query), defaults={"top_k": top_k, "queued_at": now}
+    )
+    if created:
+        return job
+
+    expired = job.status == ScholarSearchJob.Status.DONE and (
+        job.finished_at < now - datetime.timedelta(seconds=settings.GOOGLE_SCHOLAR_RESULT_TTL)
+        or job.top_k < top_k
+    )
+    retry = job.status == ScholarSearchJob.Status.FAILED and job.finished_at < now - (
+        datetime.timedelta(seconds=settings.GOOGLE_SCHOLAR_RETRY_AFTER)
+    )
+    if expired or retry:
+        # only one of concurrent requests re-queues the job
+        ScholarSearchJob.objects.filter(pk=job.pk, status=job.status).update(
+            status=ScholarSearchJob.Status.PENDING,
+            top_k=max(job.top_k, top_k),
+            queued_at=now,
+        )
+        job.refresh_from_db()
+    return job
+
+
+def claim_scholar_search_job() -> Optional[ScholarSearchJob]:
+    """Marks the oldest pending job as running and returns it, None if there is no job.
+    Rows locked by other workers are skipped, so each job is run by one worker.
+    Jobs running longer than GOOGLE_SCHOLAR_JOB_TIMEOUT (e.g. of a killed worker)
+    are claimed again."""
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=settings.GOOGLE_SCHOLAR_JOB_TIMEOUT)
+    with transaction.atomic():
+        job = (
+            ScholarSearchJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=ScholarSearchJob.Status.PENDING)
+                | Q(status=ScholarSearchJob.Status.RUNNING, started_at__lt=stale)
+            )
+            .order_by("queued_at")
+            .first()
+        )
+        if job is not None:
+            job.status = ScholarSearchJob.Status.RUNNING
+            job.started_at = now
+            job.save(update_fields=["status", "started_at", "updated_at"])
+    return job
+
+
+def run_scholar_search_job(job: ScholarSearchJob) -> ScholarSearchJob:
+    """Scrapes Google Scholar for the job, stores the results and notifies
+    the receivers of the scholar_search_finished signal."""
+    try:
+        result = scrape_google_scholar(job.query, job.top_k)
+    except Exception as e:
+        result = {"results": [], "status": "ERROR", "status_code": 500}
+        job.error = repr(e)
+
+    if result["status"] == "OK":
+        job.status = ScholarSearchJob.Status.DONE
+        job.results = [article.to_dict() for article in result["results"]]
+        job.error = ""
+    else:
+        job.status = ScholarSearchJob.Status.FAILED
+        job.error = job.error or f"{result['status']} {result['status_code']}"
+    job.finished_at = timezone.now()
+    job.save()
+    scholar_search_finished.send(sender=ScholarSearchJob, job=job)
+    return job
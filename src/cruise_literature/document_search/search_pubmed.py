@@ -1,71 +1,109 @@
+import io
+from typing import Dict, Iterator, List, Optional
+
+import requests
 from Bio import Entrez, Medline
+from django.conf import settings
+
 from cruise_literature.settings import ENTREZ_EMAIL
+from document_search.cache import TieredCache
+from document_search.rate_limiter import RateLimitExceeded, acquire
 from document_search.utils import SearchResultWithStatus
 from utils.article import Article
 from utils.article import Author
+from utils.http import get_session
+
+_record_cache: Optional[TieredCache] = None
+
 
-Entrez.email = ENTREZ_EMAIL
+def get_pubmed_record_cache() -> TieredCache:
+    """Returns the cache of parsed PubMed records keyed by PMID."""
+    global _record_cache
+    if _record_cache is None:
+        _record_cache = TieredCache(
+            prefix="pubmed_record",
+            ttl=settings.PUBMED_RECORD_CACHE_TTL,
+            max_local_entries=settings.PUBMED_RECORD_CACHE_LOCAL_MAX_ENTRIES,
+            cache_alias=settings.RECORD_CACHE_ALIAS,
+        )
+    return _record_cache
 
 
-def search_pubmed(query: str, top_k: int) -> SearchResultWithStatus:
+def search_pubmed(
+    query: str,
+    top_k: int,
+    timeout: Optional[float] = None,
+    rate_limit_wait: Optional[float] = None,
+) -> SearchResultWithStatus:
     """
     Search PubMed for a given query and return a list of articles.
+    Records already in the PMID record cache are not fetched again. The missing
+    ones are fetched in batches of PUBMED_EFETCH_BATCH_SIZE. For top_k above
+    PUBMED_HISTORY_THRESHOLD, the batches are fetched from the Entrez history
+    server (WebEnv) instead of sending the PMIDs with every request.
+    The E-utilities are requested with the pooled HTTP session (not with Entrez,
+    which opens a new connection per request and has no timeout), Entrez only parses the responses.
     :param query: a search query
     :param top_k: number of results to return
+    :param timeout: timeout in seconds of each E-utilities request, None waits indefinitely
+    :param rate_limit_wait: maximal time in seconds to wait for the rate limiter
+        before each Entrez request, None waits as long as needed, 0 fails fast
     :return:
     """
+    use_history = top_k > settings.PUBMED_HISTORY_THRESHOLD
     try:
-        handle = Entrez.esearch(db="pubmed", term=query, retmax=top_k)
-        records = Entrez.read(handle)
-        id_list = records["IdList"]
-        handle.close()
-
-        handle = Entrez.efetch(
-            db="pubmed", id=id_list, rettype="medline", retmode="text"
+        acquire("PubMed", max_wait=rate_limit_wait)
+        response = _eutils(
+            "esearch",
+            {
+                "db": "pubmed",
+                "term": query,
+                "retmax": top_k,
+                "usehistory": "y" if use_history else "n",
+            },
+            timeout,
         )
-        candidate_list = []
-        for record in Medline.parse(handle):
-            authors = []
-            for author in record.get("FAU", []):
-                display_name = author
-                first_name = author.split(",")[0]
-
-                authors.append(Author(display_name=display_name, first_name=first_name))
-
-            doi = next(
-                (
-                    _potential_id[:-4].strip()
-                    for _potential_id in record.get("LID", [""]).split("]")
-                    if _potential_id.strip().startswith("10.")
-                ),
-                None,
-            )
-            retrieved_art = Article(
-                id=record["PMID"],
-                semantic_scholar_id=None,
-                core_id=None,
-                doi=doi,
-                title=record["TI"],
-                url=f"https://pubmed.ncbi.nlm.nih.gov/{record['PMID']}/",
-                pdf=None,
-                snippet=record["AB"][:300],
-                abstract=record["AB"],
-                authors="; ".join([a.display_name for a in authors]),
-                publication_date=record["MHDA"][:4],  # get full date
-                venue=record["JT"],
-                keywords_snippet=record.get("OT", []),
-                keywords_rest=None,
-                CSO_keywords=None,
-                n_citations=None,
-                n_references=None,
+        search_result = Entrez.read(io.BytesIO(response.content))
+        id_list = list(search_result["IdList"])
+
+        record_cache = get_pubmed_record_cache()
+        keys = {pmid: record_cache.make_key(pmid) for pmid in id_list}
+        cached = record_cache.get_many(list(keys.values()))
+        articles: Dict[str, Article] = {
+            pmid: cached[key] for pmid, key in keys.items() if key in cached
+        }
+        missing = [pmid for pmid in id_list if pmid not in articles]
+
+        if use_history:
+            fetched = _fetch_from_history(
+                missing,
+                id_list,
+                search_result["WebEnv"],
+                search_result["QueryKey"],
+                timeout,
+                rate_limit_wait,
             )
-            candidate_list.append(retrieved_art)
+        else:
+            fetched = _fetch_by_ids(missing, timeout, rate_limit_wait)
+        fetched_articles = {article.pmid: article for article in fetched}
+        record_cache.set_many(
+            {
+                record_cache.make_key(pmid): article
+                for pmid, article in fetched_articles.items()
+            }
+        )
+        articles.update(fetched_articles)
 
+        candidate_list = [articles[pmid] for pmid in id_list if pmid in articles]
         _status = "OK"
         _status_code = 200
-    except IOError:
+    except RateLimitExceeded:
+        _status = "RATE_LIMITED"
+        _status_code = 429
+        candidate_list = []
+    except requests.exceptions.RequestException as e:
         _status = "ERROR"
-        _status_code = 500
+        _status_code = 504 if isinstance(e, requests.exceptions.Timeout) else 503
         candidate_list = []
 
     return {
@@ -75,3 +113,115 @@ def search_pubmed(query: str, top_k: int) -> SearchResultWithStatus:
         "search_engine": "PubMed",
         "search_query": query,
     }
+
+
+def _eutils(
+    utility: str, params: Dict, timeout: Optional[float]
+) -> requests.Response:
+    """Requests an E-utility (esearch, efetch) at ENTREZ_API_ENDPOINT.
+    POST is used, so long PMID lists do not exceed the URL length limit."""
+    response = get_session("pubmed").post(
+        f"{settings.ENTREZ_API_ENDPOINT}/{utility}.fcgi",
+        data={**params, "tool": "cruise_literature", "email": ENTREZ_EMAIL},
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    return response
+
+
+def _fetch_by_ids(
+    pmids: List[str], timeout: Optional[float], rate_limit_wait: Optional[float]
+) -> Iterator[Article]:
+    batch_size = settings.PUBMED_EFETCH_BATCH_SIZE
+    for start in range(0, len(pmids), batch_size):
+        acquire("PubMed", max_wait=rate_limit_wait)
+        response = _eutils(
+            "efetch",
+            {
+                "db": "pubmed",
+                "id": ",".join(pmids[start : start + batch_size]),
+                "rettype": "medline",
+                "retmode": "text",
+            },
+            timeout,
+        )
+        yield from _parse_records(io.StringIO(response.text))
+
+
+def _fetch_from_history(
+    pmids: List[str],
+    id_list: List[str],
+    web_env: str,
+    query_key: str,
+    timeout: Optional[float],
+    rate_limit_wait: Optional[float],
+) -> Iterator[Article]:
+    """Fetches only the batches of the search result which contain missing PMIDs."""
+    batch_size = settings.PUBMED_EFETCH_BATCH_SIZE
+    positions = {pmid: position for position, pmid in enumerate(id_list)}
+    starts = sorted({positions[pmid] // batch_size * batch_size for pmid in pmids})
+    for start in starts:
+        acquire("PubMed", max_wait=rate_limit_wait)
+        response = _eutils(
+            "efetch",
+            {
+                "db": "pubmed",
+                "webenv": web_env,
+                "query_key": query_key,
+                "retstart": start,
+                "retmax": batch_size,
+                "rettype": "medline",
+                "retmode": "text",
+            },
+            timeout,
+        )
+        yield from _parse_records(io.StringIO(response.text))
+
+
+def _parse_records(handle) -> Iterator[Article]:
+    """Converts MEDLINE records to articles one by one, as they are read from the response."""
+    try:
+        for record in Medline.parse(handle):
+            if "PMID" in record:
+                yield _to_article(record)
+    finally:
+        handle.close()
+
+
+def _to_article(record: Dict) -> Article:
+    authors = []
+    for author in record.get("FAU", []):
+        display_name = author
+        first_name = author.split(",")[0]
+
+        authors.append(Author(display_name=display_name, first_name=first_name))
+
+    doi = next(
+        (
+            _potential_id[:-4].strip()
+            for _potential_id in record.get("LID", "").split("]")
+            if _potential_id.strip().startswith("10.")
+        ),
+        None,
+    )
+    abstract = record.get("AB", "")
+    return Article(
+        id=record["PMID"],
+        semantic_scholar_id=None,
+        core_id=None,
+        pmid=record["PMID"],
+        doi=doi,
+        title=record.get("TI", ""),
+        url=f"https://pubmed.ncbi.nlm.nih.gov/{record['PMID']}/",
+        pdf=None,
+        snippet=abstract[:300],
+        abstract=abstract,
+        authors="; ".join([a.display_name for a in authors]),
+        publication_date=record.get("MHDA", "")[:4],  # get full date
+        venue=record.get("JT", ""),
+        keywords_snippet=record.get("OT", []),
+        keywords_rest=None,
+        CSO_keywords=None,
+        n_citations=None,
+        n_references=None,
+    )
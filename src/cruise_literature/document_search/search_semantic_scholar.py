@@ -1,14 +1,54 @@
-from typing import List, Dict, Tuple, Union
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
+
 import requests
+from django.conf import settings
 
+from document_search.cache import TieredCache
+from document_search.rate_limiter import RateLimitExceeded, acquire, map_measuring_waits
 from document_search.utils import SearchResultWithStatus
 from utils.article import Article, Author
-
-API_ENDPOINT = "https://api.semanticscholar.org/graph/v1/paper/search?query="
+from utils.http import get_session
 
 FIELDS = "externalIds,url,title,abstract,venue,year,referenceCount,citationCount,influentialCitationCount,isOpenAccess,\
 fieldsOfStudy,s2FieldsOfStudy,publicationTypes,publicationDate,journal,authors"
 
+# limits of the search and the paper batch endpoints
+PAGE_SIZE = 100
+MAX_RESULTS = 1000
+BATCH_SIZE = 500
+
+_executor: Optional[ThreadPoolExecutor] = None
+_paper_cache: Optional[TieredCache] = None
+_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Small pool for the page and batch requests of a single search. It is separate
+    from the search fan-out executor, which runs search_semantic_scholar itself."""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.SEMANTIC_SCHOLAR_MAX_CONCURRENT_REQUESTS,
+                thread_name_prefix="semantic_scholar",
+            )
+    return _executor
+
+
+def get_paper_cache() -> TieredCache:
+    """Returns the cache of Semantic Scholar papers keyed by paperId."""
+    global _paper_cache
+    if _paper_cache is None:
+        _paper_cache = TieredCache(
+            prefix="semantic_scholar_paper",
+            ttl=settings.SEMANTIC_SCHOLAR_PAPER_CACHE_TTL,
+            max_local_entries=settings.SEMANTIC_SCHOLAR_PAPER_CACHE_LOCAL_MAX_ENTRIES,
+            cache_alias=settings.RECORD_CACHE_ALIAS,
+        )
+    return _paper_cache
+
 
 def _get_authors(authors_list: List[Dict[str, str]]) -> List[Author]:
     return [
@@ -20,57 +60,209 @@ def _get_authors(authors_list: List[Dict[str, str]]) -> List[Author]:
     ]
 
 
-def search_semantic_scholar(query: str, top_k: int) -> SearchResultWithStatus:
-    response = requests.get(
-        f"{API_ENDPOINT}{'+'.join(query.split())}&limit={top_k}&fields={FIELDS}"
-    )
+def search_semantic_scholar(
+    query: str,
+    top_k: int,
+    timeout: Optional[float] = None,
+    rate_limit_wait: Optional[float] = None,
+) -> SearchResultWithStatus:
+    """Search Semantic Scholar. Results above PAGE_SIZE are requested as concurrent
+    offset pages (at most MAX_RESULTS in total). Every request takes a token of
+    the Semantic Scholar rate limiter.
 
-    candidate_list = []
-    if response.status_code == 200:
-        search_results = response.json()["data"] if response.json()["total"] > 0 else []
-        for index_i, candidate in enumerate(search_results):
-            try:
-                snippet = candidate.get("abstract")[:300]
-                abstract = candidate.get("abstract")
-            except TypeError:
-                snippet = ""
-                abstract = ""
-
-            if candidate.get("externalIds").get("ArXiv"):
-                pdf = f"https://arxiv.org/pdf/{candidate.get('externalIds').get('ArXiv')}.pdf"
-            else:
-                pdf = None
-
-            doi = candidate.get("externalIds").get("DOI") or None
-            authors = _get_authors(candidate.get("authors"))
-            authors = ", ".join([a.display_name for a in authors])
-            year = date[:4] if (date := candidate["publicationDate"]) else "   "
-            retrieved_art = Article(
-                id=candidate["paperId"],
-                semantic_scholar_id=candidate["paperId"],
-                core_id=None,
-                doi=doi,
-                title=candidate.get("title", ""),
-                url=candidate["url"],
-                pdf=pdf,
-                snippet=snippet,
-                abstract=abstract,
-                authors=authors,
-                publication_date=year,
-                venue=candidate["venue"],
-                keywords_snippet=None,
-                keywords_rest=None,
-                CSO_keywords=None,
-                n_citations=candidate.get("citationCount"),
-                n_references=candidate.get("referenceCount"),
+    For top_k of at least SEMANTIC_SCHOLAR_TWO_PHASE_MIN_TOP_K, the pages contain only
+    paper ids and the details are requested in bulk, only for papers which are not
+    in the paper cache.
+    :param timeout: request timeout in seconds, None waits indefinitely
+    :param rate_limit_wait: maximal time in seconds to wait for the rate limiter,
+        None waits as long as needed, 0 fails fast
+    """
+    two_phase = top_k >= settings.SEMANTIC_SCHOLAR_TWO_PHASE_MIN_TOP_K
+    try:
+        candidates, status_code = _search_pages(
+            query,
+            min(top_k, MAX_RESULTS),
+            fields="paperId" if two_phase else FIELDS,
+            timeout=timeout,
+            rate_limit_wait=rate_limit_wait,
+        )
+        if two_phase:
+            candidate_list, details_status_code = _get_papers(
+                [candidate["paperId"] for candidate in candidates],
+                timeout=timeout,
+                rate_limit_wait=rate_limit_wait,
             )
-            candidate_list.append(retrieved_art)
+            if status_code == 200:
+                status_code = details_status_code
+        else:
+            candidate_list = [_get_article(candidate) for candidate in candidates]
+            _cache_articles(candidate_list)
+    except RateLimitExceeded:
+        return {
+            "results": [],
+            "status": "RATE_LIMITED",
+            "status_code": 429,
+            "search_engine": "Semantic Scholar",
+            "search_query": query,
+        }
+    except requests.exceptions.RequestException as e:
+        return {
+            "results": [],
+            "status": "ERROR",
+            "status_code": 504 if isinstance(e, requests.exceptions.Timeout) else 503,
+            "search_engine": "Semantic Scholar",
+            "search_query": query,
+        }
 
-    _status = "OK" if response.status_code == 200 else "ERROR"
+    # pages which failed are missing, so partial results are returned with the error status
+    _status = "OK" if status_code == 200 else "ERROR"
     return {
         "results": candidate_list,
         "status": _status,
-        "status_code": response.status_code,
+        "status_code": status_code,
         "search_engine": "Semantic Scholar",
         "search_query": query,
     }
+
+
+def _search_page(
+    query: str,
+    offset: int,
+    limit: int,
+    fields: str,
+    timeout: Optional[float],
+    rate_limit_wait: Optional[float],
+) -> requests.Response:
+    acquire("Semantic Scholar", max_wait=rate_limit_wait)
+    return get_session("semantic_scholar").get(
+        f"{settings.SEMANTIC_SCHOLAR_API_ENDPOINT}/paper/search",
+        params={"query": query, "offset": offset, "limit": limit, "fields": fields},
+        timeout=timeout,
+    )
+
+
+def _search_pages(
+    query: str,
+    top_k: int,
+    fields: str,
+    timeout: Optional[float],
+    rate_limit_wait: Optional[float],
+) -> Tuple[List[Dict], int]:
+    """Requests the first page, and when the total number of results is larger,
+    the remaining pages concurrently.
+
+    :return: candidates in the ranking order and the status code of the first failed page (or 200)
+    """
+    response = _search_page(
+        query, 0, min(top_k, PAGE_SIZE), fields, timeout, rate_limit_wait
+    )
+    if response.status_code != 200:
+        return [], response.status_code
+    first_page = response.json()
+    candidates = first_page.get("data", []) if first_page["total"] > 0 else []
+
+    n_results = min(top_k, first_page["total"])
+    offsets = range(PAGE_SIZE, n_results, PAGE_SIZE)
+    # waits for tokens of the concurrent pages are not latencies of Semantic Scholar
+    responses = map_measuring_waits(
+        get_executor(),
+        lambda offset: _search_page(
+            query,
+            offset,
+            min(PAGE_SIZE, n_results - offset),
+            fields,
+            timeout,
+            rate_limit_wait,
+        ),
+        offsets,
+    )
+    status_code = 200
+    for response in responses:
+        if response.status_code != 200:
+            if status_code == 200:
+                status_code = response.status_code
+            continue
+        candidates.extend(response.json().get("data", []))
+    return candidates, status_code
+
+
+def _get_papers(
+    paper_ids: List[str], timeout: Optional[float], rate_limit_wait: Optional[float]
+) -> Tuple[List[Article], int]:
+    """Returns the papers in the order of paper_ids. Papers found in the paper cache
+    are not requested again, the rest is requested in batches of BATCH_SIZE."""
+    paper_cache = get_paper_cache()
+    keys = {paper_id: paper_cache.make_key(paper_id) for paper_id in paper_ids}
+    cached = paper_cache.get_many(list(keys.values()))
+    articles = {
+        paper_id: cached[key] for paper_id, key in keys.items() if key in cached
+    }
+    missing = [paper_id for paper_id in paper_ids if paper_id not in articles]
+
+    def _get_batch(batch: List[str]) -> requests.Response:
+        acquire("Semantic Scholar", max_wait=rate_limit_wait)
+        return get_session("semantic_scholar").post(
+            f"{settings.SEMANTIC_SCHOLAR_API_ENDPOINT}/paper/batch",
+            params={"fields": FIELDS},
+            json={"ids": batch},
+            timeout=timeout,
+        )
+
+    status_code = 200
+    fetched = []
+    batches = [missing[i : i + BATCH_SIZE] for i in range(0, len(missing), BATCH_SIZE)]
+    for response in map_measuring_waits(get_executor(), _get_batch, batches):
+        if response.status_code != 200:
+            if status_code == 200:
+                status_code = response.status_code
+            continue
+        # papers which are not found are returned as null
+        fetched.extend(_get_article(paper) for paper in response.json() if paper)
+    _cache_articles(fetched)
+    articles.update((article.semantic_scholar_id, article) for article in fetched)
+    return [articles[paper_id] for paper_id in paper_ids if paper_id in articles], status_code
+
+
+def _cache_articles(articles: List[Article]):
+    paper_cache = get_paper_cache()
+    paper_cache.set_many(
+        {paper_cache.make_key(article.semantic_scholar_id): article for article in articles}
+    )
+
+
+def _get_article(candidate: Dict) -> Article:
+    try:
+        snippet = candidate.get("abstract")[:300]
+        abstract = candidate.get("abstract")
+    except TypeError:
+        snippet = ""
+        abstract = ""
+
+    if candidate.get("externalIds").get("ArXiv"):
+        pdf = f"https://arxiv.org/pdf/{candidate.get('externalIds').get('ArXiv')}.pdf"
+    else:
+        pdf = None
+
+    doi = candidate.get("externalIds").get("DOI") or None
+    authors = _get_authors(candidate.get("authors"))
+    authors = ", ".join([a.display_name for a in authors])
+    year = date[:4] if (date := candidate["publicationDate"]) else "   "
+    return Article(
+        id=candidate["paperId"],
+        semantic_scholar_id=candidate["paperId"],
+        core_id=None,
+        doi=doi,
+        title=candidate.get("title", ""),
+        url=candidate["url"],
+        pdf=pdf,
+        snippet=snippet,
+        abstract=abstract,
+        authors=authors,
+        publication_date=year,
+        venue=candidate["venue"],
+        keywords_snippet=None,
+        keywords_rest=None,
+        CSO_keywords=None,
+        n_citations=candidate.get("citationCount"),
+        n_references=candidate.get("referenceCount"),
+    )
@@ -1,35 +1,161 @@
-from typing import Optional
+import os
+from typing import Dict, List, Optional
+
+import requests
+from django.conf import settings
 
-import wikipedia
-from requests import ConnectionError
 from utils.article import WikipediaArticle
+from utils.http import get_session
+
+from .cache import TieredCache, normalize_query, MISS
+from .wikipedia_index import WikipediaIndex
+
+# a cached value for queries without a matching page, None means a cache miss
+NO_MATCH = "NO_MATCH"
+
+_wikipedia_cache: Optional[TieredCache] = None
+_wikipedia_index: Optional[WikipediaIndex] = None
+
+
+def get_wikipedia_index() -> Optional[WikipediaIndex]:
+    """Returns the offline title index, None if it was not built."""
+    global _wikipedia_index
+    if not os.path.exists(settings.WIKIPEDIA_INDEX_PATH):
+        return None
+    if _wikipedia_index is None:
+        _wikipedia_index = WikipediaIndex(settings.WIKIPEDIA_INDEX_PATH)
+    return _wikipedia_index
 
 
-def search_wikipedia(query: str, top_k: int = 1) -> Optional[WikipediaArticle]:
+def get_wikipedia_cache() -> TieredCache:
+    global _wikipedia_cache
+    if _wikipedia_cache is None:
+        _wikipedia_cache = TieredCache(
+            prefix="wikipedia",
+            ttl=settings.WIKIPEDIA_CACHE_TTL,
+            max_local_entries=settings.SEARCH_CACHE_LOCAL_MAX_ENTRIES,
+            cache_alias=settings.SEARCH_CACHE_ALIAS,
+        )
+    return _wikipedia_cache
+
+
+def search_wikipedia(
+    query: str, top_k: int = 1, timeout: Optional[float] = None
+) -> Optional[WikipediaArticle]:
     """If there exist a wikipedia page with the title equal to the query it returns
-    dictionary with the content of wikipedia page."""
-    wikipedia.set_lang("en")
-    result = None
+    the WikipediaArticle with the lead section of the page.
+
+    When the title is a disambiguation page, its options are looked up in a single
+    batched request and the first regular page is returned. Options which are
+    disambiguation pages themselves are followed up to WIKIPEDIA_MAX_DISAMBIGUATION_DEPTH.
+    Both matches and misses are cached per normalized query, failed requests are not.
+
+    When the offline title index exists, the query is resolved against it
+    the same way, without any request to Wikipedia.
+    """
+    if wikipedia_index := get_wikipedia_index():
+        return wikipedia_index.lookup(
+            query,
+            max_depth=settings.WIKIPEDIA_MAX_DISAMBIGUATION_DEPTH,
+            max_options=settings.WIKIPEDIA_MAX_DISAMBIGUATION_OPTIONS,
+        )
+
+    cache = get_wikipedia_cache()
+    key = cache.make_key(normalize_query(query))
+    cached, state = cache.get(key)
+    if state != MISS:
+        return None if cached == NO_MATCH else cached
 
     try:
-        page_object = wikipedia.page(query, auto_suggest=False)
-        result = WikipediaArticle(
-            id=page_object.pageid,
-            title=page_object.title,
-            url=page_object.url,
-            snippet=f"{page_object.content[:300]}...",
-            content=page_object.content,
+        result = _find_article([query], depth=0, timeout=timeout)
+    except (requests.exceptions.RequestException, KeyError, ValueError):
+        return None
+
+    cache.set(key, result or NO_MATCH)
+    return result
+
+
+def _find_article(
+    titles: List[str], depth: int, timeout: Optional[float]
+) -> Optional[WikipediaArticle]:
+    """Returns the first of the titles which is a regular page, titles are resolved
+    in one request. Only the first disambiguation page is followed, so the number of
+    requests is bounded by 1 + 2 * WIKIPEDIA_MAX_DISAMBIGUATION_DEPTH."""
+    pages = _get_pages(titles, timeout=timeout)
+    disambiguation_title = None
+    for title in titles:
+        page = pages.get(title)
+        if page is None or page.get("missing") or page.get("invalid"):
+            continue
+        if "disambiguation" in page.get("pageprops", {}):
+            disambiguation_title = disambiguation_title or page["title"]
+            continue
+        return WikipediaArticle(
+            id=page["pageid"],
+            title=page["title"],
+            url=page["fullurl"],
+            snippet=f"{page.get('extract', '')[:300]}...",
+            content=page.get("extract", ""),
+            ambiguous=depth == 0,
         )
-    except wikipedia.PageError:
-        result = None
-    except KeyError:
-        result = None
-    except ConnectionError:
-        result = None
-    except wikipedia.DisambiguationError as e:
-        for option in e.options:
-            result = search_wikipedia(option)
-            if result:
-                return result
 
+    if disambiguation_title and depth < settings.WIKIPEDIA_MAX_DISAMBIGUATION_DEPTH:
+        options = _get_links(disambiguation_title, timeout=timeout)
+        if options:
+            return _find_article(options, depth=depth + 1, timeout=timeout)
+    return None
+
+
+def _get_pages(titles: List[str], timeout: Optional[float]) -> Dict[str, Dict]:
+    """Looks up all the titles in one MediaWiki API request.
+    Returns pages keyed by the requested titles, redirects are followed."""
+    response = get_session("wikipedia").get(
+        settings.WIKIPEDIA_API_ENDPOINT,
+        params={
+            "action": "query",
+            "format": "json",
+            "formatversion": 2,
+            "titles": "|".join(titles),
+            "redirects": 1,
+            "prop": "info|pageprops|extracts",
+            "inprop": "url",
+            "ppprop": "disambiguation",
+            "exintro": 1,
+            "explaintext": 1,
+            "exlimit": "max",
+        },
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    data = response.json()["query"]
+
+    normalized = {item["from"]: item["to"] for item in data.get("normalized", [])}
+    redirects = {item["from"]: item["to"] for item in data.get("redirects", [])}
+    pages = {page["title"]: page for page in data.get("pages", [])}
+    result = {}
+    for title in titles:
+        resolved = normalized.get(title, title)
+        resolved = redirects.get(resolved, resolved)
+        if resolved in pages:
+            result[title] = pages[resolved]
     return result
+
+
+def _get_links(title: str, timeout: Optional[float]) -> List[str]:
+    """Returns at most WIKIPEDIA_MAX_DISAMBIGUATION_OPTIONS articles linked from a disambiguation page."""
+    response = get_session("wikipedia").get(
+        settings.WIKIPEDIA_API_ENDPOINT,
+        params={
+            "action": "query",
+            "format": "json",
+            "formatversion": 2,
+            "titles": title,
+            "prop": "links",
+            "plnamespace": 0,
+            "pllimit": settings.WIKIPEDIA_MAX_DISAMBIGUATION_OPTIONS,
+        },
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    pages = response.json()["query"].get("pages", [])
+    return [link["title"] for page in pages for link in page.get("links", [])]
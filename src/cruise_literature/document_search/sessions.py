@@ -0,0 +1,86 @@
+import secrets
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from django.conf import settings
+
+from utils.article import WikipediaArticle
+from .cache import TieredCache, MISS
+from .utils import Articles, SearchResultWithStatus
+
+
+@dataclass
+class SearchSession:
+    """Merged and deduplicated results of a single search, stored server side
+    so that following pages and sorting toggles do not query the search engines again."""
+
+    id: str
+    search_query: str
+    results: Articles
+    search_time: float
+    engine_statuses: List[SearchResultWithStatus] = field(default_factory=list)
+    matched_wiki_page: Optional[WikipediaArticle] = None
+    created_at: float = field(default_factory=time.time)
+
+    @property
+    def pending_engines(self) -> List[str]:
+        """Engines retrieving the results in the background, see search_google_scholar."""
+        return [
+            status["search_engine"]
+            for status in self.engine_statuses
+            if status["status"] == "PENDING"
+        ]
+
+
+_session_store: Optional[TieredCache] = None
+
+
+def _get_store() -> TieredCache:
+    global _session_store
+    if _session_store is None:
+        _session_store = TieredCache(
+            prefix="search_session",
+            ttl=settings.SEARCH_SESSION_TTL,
+            max_local_entries=settings.SEARCH_SESSION_MAX_ENTRIES,
+            cache_alias=settings.SEARCH_CACHE_ALIAS,
+        )
+    return _session_store
+
+
+def create_search_session(
+    search_query: str,
+    results: Articles,
+    search_time: float,
+    engine_statuses: List[SearchResultWithStatus],
+    matched_wiki_page: Optional[WikipediaArticle] = None,
+) -> SearchSession:
+    """Stores the search results and returns the session with a short id to be used in URLs.
+    Per-engine result lists are dropped from the statuses, as the merged list already contains them."""
+    session = SearchSession(
+        id=secrets.token_urlsafe(6),
+        search_query=search_query,
+        results=results,
+        search_time=search_time,
+        engine_statuses=[
+            {key: value for key, value in status.items() if key != "results"}
+            for status in engine_statuses
+        ],
+        matched_wiki_page=matched_wiki_page,
+    )
+    save_search_session(session)
+    return session
+
+
+def save_search_session(session: SearchSession):
+    store = _get_store()
+    store.set(store.make_key(session.id), session)
+
+
+def get_search_session(session_id: str) -> Optional[SearchSession]:
+    """Returns the stored search session or None if it does not exist or already expired."""
+    store = _get_store()
+    session, state = store.get(store.make_key(session_id))
+    if state == MISS:
+        return None
+    return session
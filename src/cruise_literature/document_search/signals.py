@@ -0,0 +1,18 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from .models import SearchEngine
+
+# sent by the scholar worker with the finished (DONE or FAILED) ScholarSearchJob as `job`
+scholar_search_finished = Signal()
+
+
+@receiver(post_save, sender=SearchEngine)
+@receiver(post_delete, sender=SearchEngine)
+def invalidate_search_engine_registry(sender, **kwargs):
+    """Drops search engines cached by the registry, so changes made in the admin
+    panel (or fixtures) are picked up by the next search."""
+    # the registry imports the search engine modules, which send signals of this module
+    from .registry import search_engine_registry
+
+    search_engine_registry.invalidate()
@@ -1 +1,1104 @@
-# Create your tests here.
+import dataclasses
+import datetime
+import json
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import requests
+from django.core.cache import cache, caches
+from django.template.loader import render_to_string
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from .cache import TieredCache, SearchResultCache, normalize_query, FRESH, STALE, MISS
+from .circuit_breaker import CircuitBreaker, OPEN, HALF_OPEN, CLOSED
+from .engine_logger import EngineLogger
+from .fan_out import fan_out
+from .highlight import QueryHighlighter
+from .metrics import SERIES_KEY, Metric, MetricsRegistry, histogram_quantile, render_metrics
+from .models import ScholarSearchJob, SearchEngine
+from .query_log import aggregate_query_log, iter_query_log, log_files
+from .rate_limiter import RateLimitExceeded, TokenBucket, map_measuring_waits, measure_waits
+from .registry import (
+    SearchEngineAdapter,
+    SearchEngineRegistry,
+    failed_search,
+    strip_boolean_operators,
+)
+from .search_google_scholar import (
+    claim_scholar_search_job,
+    run_scholar_search_job,
+    search_google_scholar,
+)
+from .search_cruise import query_builder, search_cruise, search_cruise_batch, search_cruise_stream
+from .search_pubmed import search_pubmed
+from .search_semantic_scholar import search_semantic_scholar
+from .search_wikipedia import search_wikipedia
+from .sessions import create_search_session, get_search_session
+from .utils import merge_results, sort_results
+from .wikipedia_index import WikipediaIndex, build_index
+from utils.article import Article, LazyArticle
+from utils.display_fields import display_fields
+from utils.http import JitterRetry, get_session, pool_stats
+
+
+class FanOutTests(SimpleTestCase):
+    def test_fan_out_returns_partial_results_after_deadline(self):
+        def slow():
+            time.sleep(1)
+            return "slow"
+
+        def fast():
+            return "fast"
+
+        start = time.monotonic()
+        results = {
+            name: (result, exception)
+            for name, result, exception in fan_out(
+                {"slow": slow, "fast": fast},
+                timeouts={"slow": 0.2},
+                total_budget=5.0,
+            )
+        }
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(results["fast"], ("fast", None))
+        self.assertIsNone(results["slow"][0])
+        self.assertIsInstance(results["slow"][1], TimeoutError)
+
+    def test_fan_out_reports_exceptions(self):
+        def failing():
+            raise ValueError("engine failure")
+
+        name, result, exception = next(
+            fan_out({"failing": failing}, timeouts={}, total_budget=1.0)
+        )
+        self.assertEqual(name, "failing")
+        self.assertIsNone(result)
+        self.assertIsInstance(exception, ValueError)
+
+
+class SearchCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.cache = TieredCache(prefix="test", ttl=60, stale_ttl=60, max_local_entries=2)
+
+    def test_normalize_query(self):
+        self.assertEqual(
+            normalize_query("  Machine   LEARNING AND  Biology "),
+            "machine learning AND biology",
+        )
+
+    def test_local_tier_is_size_bounded(self):
+        for key in ["a", "b", "c"]:
+            self.cache.set(key, key)
+        self.assertEqual(list(self.cache._local), ["b", "c"])
+        # evicted entry is still available from the shared tier
+        self.assertEqual(self.cache.get("a"), ("a", FRESH))
+
+    def test_stale_and_expired_entries(self):
+        self.cache.set("key", "value")
+        with mock.patch("document_search.cache.time.time", return_value=time.time() + 90):
+            self.assertEqual(self.cache.get("key"), ("value", STALE))
+        with mock.patch("document_search.cache.time.time", return_value=time.time() + 150):
+            self.assertEqual(self.cache.get("key"), (None, MISS))
+
+    def test_search_result_cache_counts_hits_and_misses(self):
+        search_method = mock.Mock(
+            return_value={"results": [], "status": "OK", "search_engine": "test"}
+        )
+        search_result_cache = SearchResultCache(self.cache)
+        first = search_result_cache.search("test", search_method, "Query", 10)
+        second = search_result_cache.search("test", search_method, " query ", 10)
+
+        search_method.assert_called_once_with("Query", 10)
+        self.assertEqual(first["cache"], MISS)
+        self.assertEqual(second["cache"], FRESH)
+        self.assertEqual(search_result_cache.stats()["hit"], 1)
+        self.assertEqual(search_result_cache.stats()["miss"], 1)
+
+
+class SearchSessionTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.articles = [
+            Article(
+                id=str(i),
+                title=f"title {i}",
+                url="",
+                pdf="",
+                snippet="",
+                abstract="",
+                authors="",
+                publication_date=year,
+                n_citations=citations,
+            )
+            for i, (year, citations) in enumerate([("2001", 5), ("   ", "-"), (2020, 1)])
+        ]
+
+    def test_session_roundtrip(self):
+        session = create_search_session(
+            search_query="query",
+            results=self.articles,
+            search_time=0.5,
+            engine_statuses=[{"results": self.articles, "status": "OK"}],
+        )
+        stored = get_search_session(session.id)
+        self.assertEqual(stored.results, self.articles)
+        self.assertEqual(stored.engine_statuses, [{"status": "OK"}])
+        self.assertIsNone(get_search_session("unknown"))
+
+    def test_sort_results(self):
+        self.assertEqual(
+            [a.id for a in sort_results(self.articles, "year")], ["2", "0", "1"]
+        )
+        self.assertEqual(
+            [a.id for a in sort_results(self.articles, "citations")], ["0", "2", "1"]
+        )
+        self.assertIs(sort_results(self.articles, "relevance"), self.articles)
+
+
+def _article(_id: str, title: str) -> Article:
+    return Article(
+        id=_id, title=title, url="", pdf="", snippet="", abstract="", authors=""
+    )
+
+
+class SearchEngineRegistryTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+        def _search(engine_name, titles):
+            def _search_method(query, top_k, timeout=None, rate_limit_wait=None):
+                return {
+                    "results": [_article(f"{engine_name}{i}", t) for i, t in enumerate(titles)],
+                    "status": "OK",
+                    "status_code": 200,
+                    "search_engine": engine_name,
+                    "search_query": query,
+                }
+
+            return _search_method
+
+        self.registry = SearchEngineRegistry(
+            {
+                "first": SearchEngineAdapter(
+                    name="first", search_method=_search("first", ["A", "B"]), max_top_k=10
+                ),
+                "second": SearchEngineAdapter(
+                    name="second",
+                    search_method=_search("second", ["b ", "C"]),
+                    max_top_k=10,
+                    merge_priority=0,
+                ),
+            }
+        )
+        self.engines = [
+            SearchEngine(id=1, name="First", search_method="first"),
+            SearchEngine(id=2, name="Second", search_method="second"),
+        ]
+
+    def test_search_any_subset_of_engines(self):
+        merged, statuses = self.registry.search(self.engines, "query", 10, use_cache=False)
+        self.assertEqual([a.id for a in merged], ["second0", "first0", "second1"])
+        self.assertEqual(len(statuses), 2)
+        self.assertTrue(all(status["latency"] >= 0 for status in statuses))
+
+        merged, statuses = self.registry.search(self.engines[:1], "query", 10, use_cache=False)
+        self.assertEqual([a.id for a in merged], ["first0", "first1"])
+
+    def test_engines_are_loaded_once(self):
+        with mock.patch.object(SearchEngine.objects, "order_by", return_value=self.engines) as query:
+            self.assertEqual(self.registry.get_engine(2), self.engines[1])
+            self.assertEqual(len(self.registry.get_engines()), 2)
+            query.assert_called_once()
+            self.registry.invalidate()
+            self.registry.get_engines()
+            self.assertEqual(query.call_count, 2)
+
+    def test_boolean_operators_are_stripped_for_engines_without_support(self):
+        self.assertEqual(
+            strip_boolean_operators('covid AND (vaccine OR mRNA) NOT children'),
+            "covid vaccine mRNA",
+        )
+        self.assertEqual(strip_boolean_operators('covid NOT "long covid"'), "covid")
+
+        search_method = mock.Mock(
+            side_effect=lambda query, top_k, **kwargs: failed_search("test", query, "OK", 200)
+        )
+        adapter = SearchEngineAdapter(name="test", search_method=search_method, max_top_k=10)
+        result = adapter.search("covid AND vaccine", 10)
+        self.assertEqual(search_method.call_args.args[0], "covid vaccine")
+        self.assertEqual(result["search_query"], "covid AND vaccine")
+
+        adapter = dataclasses.replace(adapter, supports_boolean_queries=True)
+        adapter.search("covid AND vaccine", 10)
+        self.assertEqual(search_method.call_args.args[0], "covid AND vaccine")
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.circuit_breaker = CircuitBreaker(
+            name="test",
+            max_timeout=10.0,
+            min_timeout=0.5,
+            window=3,
+            min_calls=3,
+            failure_threshold=2,
+            cool_down=30,
+        )
+
+    def test_timeout_follows_p95_latency(self):
+        self.assertEqual(self.circuit_breaker.timeout(), 10.0)
+        for latency in [1.0, 1.0, 2.0]:
+            self.circuit_breaker.record(latency, ok=True)
+        self.assertEqual(self.circuit_breaker.timeout(), 4.0)
+        for _ in range(3):
+            self.circuit_breaker.record(0.01, ok=True)
+        self.assertEqual(self.circuit_breaker.timeout(), 0.5)
+
+    def test_expected_latency_is_the_initial_timeout(self):
+        self.assertEqual(self.circuit_breaker.timeout(1.5), 3.0)
+        self.assertEqual(self.circuit_breaker.timeout(0.1), 0.5)
+        for latency in [1.0, 1.0, 2.0]:
+            self.circuit_breaker.record(latency, ok=True)
+        self.assertEqual(self.circuit_breaker.timeout(0.1), 4.0)
+
+    def test_circuit_opens_and_closes(self):
+        self.circuit_breaker.record(1.0, ok=False)
+        self.assertEqual(self.circuit_breaker.state(), CLOSED)
+        self.circuit_breaker.record(1.0, ok=False)
+        self.assertEqual(self.circuit_breaker.state(), OPEN)
+
+        with mock.patch(
+            "document_search.circuit_breaker.time.time", return_value=time.time() + 60
+        ):
+            self.assertEqual(self.circuit_breaker.state(), HALF_OPEN)
+            self.circuit_breaker.record(1.0, ok=True)
+        self.assertEqual(self.circuit_breaker.state(), CLOSED)
+
+    def test_open_circuit_skips_engine(self):
+        search_method = mock.Mock()
+        adapter = SearchEngineAdapter(name="test", search_method=search_method, max_top_k=10)
+        with mock.patch(
+            "document_search.registry.get_circuit_breaker", return_value=self.circuit_breaker
+        ):
+            self.circuit_breaker.record(1.0, ok=False)
+            self.circuit_breaker.record(1.0, ok=False)
+            result = adapter.search("query", 10)
+        search_method.assert_not_called()
+        self.assertEqual(result["status"], "CIRCUIT_OPEN")
+
+    def test_batch_search_falls_back_to_single_searches(self):
+        search_method = mock.Mock(
+            side_effect=lambda query, top_k, **kwargs: {
+                "status": "OK",
+                "status_code": 200,
+                "search_query": query,
+            }
+        )
+        adapter = SearchEngineAdapter(name="test", search_method=search_method, max_top_k=10)
+        with mock.patch(
+            "document_search.registry.get_circuit_breaker", return_value=self.circuit_breaker
+        ):
+            results = adapter.search_batch(
+                [{"query": "a", "top_k": 20}, {"query": "b", "top_k": 5}]
+            )
+        self.assertEqual([r["search_query"] for r in results], ["a", "b"])
+        self.assertEqual([c.args[1] for c in search_method.call_args_list], [10, 5])
+
+
+class MergeResultsTests(SimpleTestCase):
+    def test_duplicates_are_matched_on_any_key(self):
+        first = [_article("1", "Deep Learning."), _article("2", "Other")]
+        first[1].doi = "10.1/ABC"
+        second = [_article("3", "deep  learning"), _article("4", "Renamed"), _article("5", "New")]
+        second[1].doi = "10.1/abc"
+        second[2].pmid = "123"
+        third = [_article("6", "Unrelated title")]
+        third[0].pmid = "123"
+
+        merged = merge_results([first, second, third], fuse_ranking=False)
+        self.assertEqual([a.id for a in merged], ["1", "2", "5"])
+
+    def test_missing_fields_are_filled_without_modifying_inputs(self):
+        first = _article("1", "Title")
+        second = _article("2", "Title")
+        second.abstract = "An abstract"
+        second.n_citations = 10
+        second.doi = "10.1/abc"
+
+        merged = merge_results([[first], [second]])
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged[0].id, "1")
+        self.assertEqual(merged[0].abstract, "An abstract")
+        self.assertEqual(merged[0].n_citations, 10)
+        self.assertEqual(first.abstract, "")
+        self.assertIsNone(first.n_citations)
+
+    def test_reciprocal_rank_fusion(self):
+        first = [_article("1", "A"), _article("2", "B")]
+        second = [_article("3", "b"), _article("4", "C")]
+        merged = merge_results([first, second])
+        self.assertEqual([a.id for a in merged], ["2", "1", "4"])
+
+    def test_merge_is_fast(self):
+        results = [
+            [_article(f"{e}_{i}", f"title {(i * (e + 1)) % 700}") for i in range(500)]
+            for e in range(5)
+        ]
+        start = time.monotonic()
+        merged = merge_results(results)
+        self.assertLess((time.monotonic() - start) / 2500, 0.001)
+        self.assertEqual(len(merged), len({a.title for r in results for a in r}))
+
+
+class ArticleTests(SimpleTestCase):
+    def test_articles_are_slotted(self):
+        article = _article("1", "Title")
+        self.assertFalse(hasattr(article, "__dict__"))
+        with self.assertRaises(AttributeError):
+            article.unknown_field = 1
+
+    def test_to_dict_is_shallow(self):
+        article = _article("1", "Title")
+        article.urls = ["https://example.org"]
+        paper = article.to_dict()
+        self.assertEqual(paper, dataclasses.asdict(article))
+        self.assertIs(paper["urls"], article.urls)
+
+    def test_pickled_articles_without_slots_are_loaded(self):
+        article = _article("1", "Title")
+        restored = Article.__new__(Article)
+        restored.__setstate__(dataclasses.asdict(article))
+        self.assertEqual(restored, article)
+        self.assertEqual(pickle.loads(pickle.dumps(article)), article)
+
+
+class QueryHighlighterTests(SimpleTestCase):
+    def test_highlight_with_stemming(self):
+        highlighter = QueryHighlighter("Learning to rank")
+        self.assertEqual(
+            highlighter.highlight("Learned ranking <b>models</b> learn to RANK."),
+            "<em>Learned</em> <em>ranking</em> &lt;b&gt;models&lt;/b&gt; "
+            "<em>learn</em> to <em>RANK</em>.",
+        )
+
+    def test_highlight_case_sensitive_without_stemming(self):
+        highlighter = QueryHighlighter("BERT model", case_sensitive=True, stemming=False)
+        self.assertEqual(
+            highlighter.highlight("BERT models and bert model"),
+            "<em>BERT</em> models and bert <em>model</em>",
+        )
+
+    def test_highlight_article_returns_copy(self):
+        article = _article("1", "title")
+        article.abstract = "search engines"
+        article.snippet = "search"
+        highlighted = QueryHighlighter("search").highlight_article(article)
+        self.assertEqual(highlighted.abstract, "<em>search</em> engines")
+        self.assertEqual(highlighted.snippet, "<em>search</em>")
+        self.assertEqual(article.abstract, "search engines")
+
+    def test_markup_of_highlights_does_not_count_for_the_abstract_toggle(self):
+        article = _article("1", "title")
+        article.abstract = "search " * 70  # 490 characters
+        highlighted = QueryHighlighter("search").highlight_article(article)
+        self.assertGreater(len(highlighted.abstract), 500)
+        card = render_to_string("document_search/_card.html", {"search_result": highlighted})
+        self.assertNotIn("Show full", card)
+
+        highlighted.abstract += " engines" * 5
+        card = render_to_string("document_search/_card.html", {"search_result": highlighted})
+        self.assertIn("Show full", card)
+
+
+class HTTPSessionTests(SimpleTestCase):
+    def test_session_is_shared_per_service(self):
+        self.assertIs(get_session("test_service"), get_session("test_service"))
+        self.assertIsNot(get_session("test_service"), get_session("other_service"))
+        self.assertEqual(pool_stats()["test_service"]["in_flight"], 0)
+
+    def test_post_is_not_retried_on_read_errors(self):
+        retry = JitterRetry(total=2, backoff_factor=0.1, jitter=0.5)
+        self.assertFalse(retry._is_method_retryable("POST"))
+        self.assertTrue(retry._is_method_retryable("GET"))
+
+    def test_backoff_has_jitter(self):
+        retry = JitterRetry(total=5, backoff_factor=1.0, jitter=0.5)
+        for _ in range(3):
+            retry = retry.increment(method="GET", url="/")
+        self.assertEqual(retry.jitter, 0.5)
+        backoff = retry.get_backoff_time()
+        self.assertGreaterEqual(backoff, 4.0)
+        self.assertLessEqual(backoff, 4.5)
+
+
+def _wiki_response(pages):
+    response = mock.Mock(status_code=200)
+    response.json.return_value = {"query": {"pages": pages}}
+    return response
+
+
+class SearchWikipediaTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.session = mock.Mock()
+        patcher = mock.patch(
+            "document_search.search_wikipedia.get_session", return_value=self.session
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_disambiguation_options_are_resolved_in_one_request(self):
+        self.session.get.side_effect = [
+            _wiki_response(
+                [{"title": "Mercury", "pageid": 1, "pageprops": {"disambiguation": ""}}]
+            ),
+            _wiki_response(
+                [{"title": "Mercury", "links": [{"title": "Mercury (element)"}, {"title": "Mercury (planet)"}]}]
+            ),
+            _wiki_response(
+                [
+                    {"title": "Mercury (element)", "missing": True},
+                    {"title": "Mercury (planet)", "pageid": 3, "fullurl": "url", "extract": "Planet"},
+                ]
+            ),
+        ]
+        article = search_wikipedia("Mercury")
+        self.assertEqual(article.title, "Mercury (planet)")
+        self.assertFalse(article.ambiguous)
+        self.assertEqual(
+            self.session.get.call_args.kwargs["params"]["titles"],
+            "Mercury (element)|Mercury (planet)",
+        )
+
+    def test_misses_are_cached(self):
+        self.session.get.return_value = _wiki_response([{"title": "Xyz", "missing": True}])
+        self.assertIsNone(search_wikipedia("xyz"))
+        self.assertIsNone(search_wikipedia("XYZ "))
+        self.assertEqual(self.session.get.call_count, 1)
+
+
+WIKIPEDIA_DUMP = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">
+  <page><title>Mercury</title><ns>0</ns><id>1</id>
+    <revision><id>11</id><text>'''Mercury''' may refer to:
+* [[Mercury (element)]], a chemical element
+* [[Mercury (planet)|Mercury]], the planet
+{{disambiguation}}</text></revision></page>
+  <page><title>Mercury (element)</title><ns>0</ns><id>2</id>
+    <redirect title="Quicksilver" /><revision><id>12</id><text>#REDIRECT [[Quicksilver]]</text></revision></page>
+  <page><title>Mercury (planet)</title><ns>0</ns><id>3</id>
+    <revision><id>13</id><text>{{Infobox planet|name={{nowrap|Mercury}}}}
+'''Mercury''' is the [[planet]] closest to the [[Sun]].&lt;ref&gt;NASA&lt;/ref&gt;
+== Orbit ==
+Long section.</text></revision></page>
+  <page><title>Talk:Mercury</title><ns>1</ns><id>4</id>
+    <revision><id>14</id><text>Discussion</text></revision></page>
+</mediawiki>"""
+
+
+class WikipediaIndexTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        dump_path = os.path.join(directory.name, "dump.xml")
+        with open(dump_path, "w") as dump:
+            dump.write(WIKIPEDIA_DUMP)
+        self.index_path = os.path.join(directory.name, "index.sqlite3")
+        self.n_titles = build_index(dump_path, self.index_path)
+
+    def test_only_articles_are_indexed(self):
+        self.assertEqual(self.n_titles, 3)
+
+    def test_lookup_uses_lead_section(self):
+        article = WikipediaIndex(self.index_path).lookup("mercury  (planet)")
+        self.assertEqual(article.title, "Mercury (planet)")
+        self.assertEqual(article.content, "Mercury is the planet closest to the Sun.")
+        self.assertEqual(article.url, "https://en.wikipedia.org/wiki/Mercury_%28planet%29")
+        self.assertTrue(article.ambiguous)
+
+    def test_disambiguation_skips_broken_redirects(self):
+        article = WikipediaIndex(self.index_path).lookup("Mercury")
+        self.assertEqual(article.id, 3)
+        self.assertFalse(article.ambiguous)
+        self.assertIsNone(WikipediaIndex(self.index_path).lookup("Mercury", max_depth=0))
+
+
+def _medline(pmids):
+    return "\n".join(f"PMID- {pmid}\nTI  - Title {pmid}\nAB  - Abstract {pmid}\n" for pmid in pmids)
+
+
+def _esearch(pmids):
+    ids = "".join(f"<Id>{pmid}</Id>" for pmid in pmids)
+    return (
+        '<?xml version="1.0" encoding="UTF-8" ?>\n'
+        '<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" '
+        '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">\n'
+        f"<eSearchResult><Count>{len(pmids)}</Count><RetMax>{len(pmids)}</RetMax>"
+        "<RetStart>0</RetStart><QueryKey>1</QueryKey><WebEnv>env</WebEnv>"
+        f"<IdList>{ids}</IdList></eSearchResult>"
+    ).encode()
+
+
+@override_settings(PUBMED_EFETCH_BATCH_SIZE=2, PUBMED_HISTORY_THRESHOLD=4, RATE_LIMITS={})
+class SearchPubMedTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        caches["records"].clear()
+        self.session = mock.Mock()
+        mock.patch("document_search.search_pubmed.get_session", return_value=self.session).start()
+        mock.patch("document_search.search_pubmed._record_cache", None).start()
+        self.addCleanup(mock.patch.stopall)
+        self.session.post.side_effect = self._eutils
+        self.pmids = []
+
+    def _eutils(self, url, data, timeout):
+        if url.endswith("/esearch.fcgi"):
+            return mock.Mock(content=_esearch(self.pmids))
+        pmids = data["id"].split(",") if "id" in data else ["5", "6"]
+        return mock.Mock(text=_medline(pmids))
+
+    def _efetch_calls(self):
+        return [c for c in self.session.post.call_args_list if c.args[0].endswith("/efetch.fcgi")]
+
+    def _search(self, pmids, top_k=4):
+        self.pmids = pmids
+        return search_pubmed("query", top_k)
+
+    def test_only_missing_records_are_fetched_in_batches(self):
+        result = self._search(["1", "2", "3"])
+        self.assertEqual([a.pmid for a in result["results"]], ["1", "2", "3"])
+        self.assertEqual([c.kwargs["data"]["id"] for c in self._efetch_calls()], ["1,2", "3"])
+
+        self.session.post.reset_mock()
+        result = self._search(["3", "4"])
+        self.assertEqual([a.title for a in result["results"]], ["Title 3", "Title 4"])
+        self.assertEqual([c.kwargs["data"]["id"] for c in self._efetch_calls()], ["4"])
+
+    def test_history_server_is_used_for_large_top_k(self):
+        self._search(["3", "4"])
+        self.session.post.reset_mock()
+        result = self._search(["3", "4", "5", "6"], top_k=10)
+        self.assertEqual(len(result["results"]), 4)
+        (efetch,) = self._efetch_calls()
+        self.assertEqual(efetch.kwargs["data"]["retstart"], 2)
+        self.assertEqual(efetch.kwargs["data"]["webenv"], "env")
+
+    def test_request_errors_are_reported(self):
+        self.session.post.side_effect = requests.exceptions.ReadTimeout()
+        result = self._search(["1"])
+        self.assertEqual((result["status"], result["status_code"]), ("ERROR", 504))
+
+
+def _s2_paper(paper_id):
+    return {
+        "paperId": paper_id,
+        "externalIds": {},
+        "title": f"Title {paper_id}",
+        "abstract": None,
+        "authors": [],
+        "publicationDate": "2020-01-01",
+        "url": "url",
+        "venue": "venue",
+    }
+
+
+@override_settings(RATE_LIMITS={})
+class SearchSemanticScholarTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        caches["records"].clear()
+        self.session = mock.Mock()
+        mock.patch(
+            "document_search.search_semantic_scholar.get_session", return_value=self.session
+        ).start()
+        mock.patch("document_search.search_semantic_scholar._paper_cache", None).start()
+        self.addCleanup(mock.patch.stopall)
+        self.session.get.side_effect = self._search_page
+        self.session.post.side_effect = lambda url, params, json, timeout: mock.Mock(
+            status_code=200, json=lambda: [_s2_paper(i) for i in json["ids"]]
+        )
+
+    @staticmethod
+    def _search_page(url, params, timeout):
+        offset, limit = params["offset"], params["limit"]
+        if params["fields"] == "paperId":
+            data = [{"paperId": str(i)} for i in range(offset, offset + limit)]
+        else:
+            data = [_s2_paper(str(i)) for i in range(offset, offset + limit)]
+        return mock.Mock(status_code=200, json=lambda: {"total": 250, "data": data})
+
+    def test_pages_are_requested_up_to_total(self):
+        result = search_semantic_scholar("query", top_k=500)
+        self.assertEqual([a.id for a in result["results"]], [str(i) for i in range(250)])
+        self.assertEqual(
+            [c.kwargs["params"]["offset"] for c in self.session.get.call_args_list],
+            [0, 100, 200],
+        )
+        self.assertEqual(self.session.get.call_args.kwargs["params"]["limit"], 50)
+
+    def test_details_of_cached_papers_are_not_requested(self):
+        search_semantic_scholar("query", top_k=50)
+        self.session.post.assert_not_called()
+
+        result = search_semantic_scholar("query", top_k=150)
+        self.assertEqual(len(result["results"]), 150)
+        self.assertEqual(
+            self.session.post.call_args.kwargs["json"]["ids"], [str(i) for i in range(50, 150)]
+        )
+
+
+def _cruise_hit(_id: str, title: str, with_display: bool = True) -> dict:
+    source = {
+        "title": title,
+        "abstract": "Deep learning for screening. " * 20,
+        "authors": [{"name": "A. Author"}, {"org": "no name"}],
+        "year": 2020,
+        "doi": f"10.1/{_id}",
+        "CSO_keywords": {"union": ["deep learning"]},
+        "keywords": {f"k{i}": i / 10 for i in range(9)},
+        "references": ["1", "2", "3"],
+        "venue": {"raw": "Venue"},
+        "url": ["https://example.org/1", "https://example.org/2"],
+    }
+    if with_display:
+        source["display"] = display_fields(source)
+        del source["keywords"], source["references"], source["venue"], source["url"]
+    return {"_id": _id, "_source": source}
+
+
+def _es_bool_matches(bool_query: dict, document: dict) -> bool:
+    """Matching of a bool query with multi_match and range clauses, as elasticsearch does it:
+    without must and filter clauses, one should clause is required by default."""
+
+    def _matches(clause):
+        if "multi_match" in clause:
+            words = set(clause["multi_match"]["query"].lower().split())
+            fields = clause["multi_match"]["fields"]
+            text = " ".join(str(document.get(field, "")) for field in fields)
+            return bool(words & set(text.lower().split()))
+        ((field, bounds),) = clause["range"].items()
+        value = document[field]
+        return bounds.get("gte", value) <= value <= bounds.get("lte", value)
+
+    required = bool_query.get("must", []) + bool_query.get("filter", [])
+    default_should = 0 if required else 1
+    return all(_matches(clause) for clause in required) and sum(
+        _matches(clause) for clause in bool_query.get("should", [])
+    ) >= bool_query.get("minimum_should_match", default_should)
+
+
+class SearchCruiseTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.session = mock.Mock()
+        mock.patch(
+            "document_search.search_cruise.get_session", return_value=self.session
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _search(self, hits):
+        self.session.post.return_value = mock.Mock(
+            status_code=200, json=lambda: {"results": {"hits": {"hits": hits}}}
+        )
+        return search_cruise("deep learning", top_k=len(hits))
+
+    def test_display_fields_are_precomputed_or_computed(self):
+        precomputed, computed = self._search(
+            [_cruise_hit("1", "First"), _cruise_hit("2", "Second", with_display=False)]
+        )["results"]
+        for article in (precomputed, computed):
+            self.assertEqual(
+                list(article.keywords_snippet), ["k8", "k7", "k6", "k5", "k4", "k3"]
+            )
+            self.assertEqual(list(article.keywords_rest), ["k0", "k1", "k2"])
+            self.assertEqual(article.n_references, 3)
+            self.assertEqual(article.n_citations, "-")
+            self.assertEqual(article.venue, "Venue")
+            self.assertEqual(article.url, "https://example.org/1")
+            self.assertEqual(len(article.snippet), 300)
+            self.assertEqual(article.authors, "A. Author")
+
+    def test_results_are_materialized_only_when_displayed(self):
+        results = self._search([_cruise_hit(str(i), f"Title {i}") for i in range(50)])[
+            "results"
+        ]
+        merged = merge_results([results, [_article("other", "title 3")]])
+        self.assertTrue(all(isinstance(a, LazyArticle) for a in merged[1:]))
+        self.assertIsInstance(merged[0], Article)  # merged with its duplicate
+
+        page = [QueryHighlighter("learning").highlight_article(a) for a in merged[:19]]
+        self.assertIn("<em>learning</em>", page[1].abstract)
+        # the 18 other results of the page and the duplicate
+        self.assertEqual(sum(a._article is not None for a in results), 19)
+        self.assertEqual(pickle.loads(pickle.dumps(results[0])).title, "Title 0")
+        self.assertEqual(results[-1].to_dict()["doi"], "10.1/49")
+
+    @override_settings(CRUISE_ELASTICSEARCH_URL="http://es:9200")
+    def test_direct_elasticsearch_backend(self):
+        hits = [_cruise_hit("1", "First"), _cruise_hit("2", "Second")]
+        self.session.post.return_value = mock.Mock(
+            status_code=200, json=lambda: {"hits": {"hits": hits}}
+        )
+        result = search_cruise("deep learning", top_k=2)
+
+        self.assertEqual(result["status"], "OK")
+        self.assertEqual([a.title for a in result["results"]], ["First", "Second"])
+        self.assertEqual(self.session.post.call_args.args[0], "http://es:9200/papers/_search")
+        query = json.loads(self.session.post.call_args.kwargs["data"])
+        self.assertEqual(query["size"], 2)
+        self.assertIn("display", query["_source"]["includes"])
+
+    def test_batch_search_in_one_request(self):
+        self.session.post.return_value = mock.Mock(
+            status_code=200,
+            json=lambda: {
+                "results": {
+                    "responses": [
+                        {"hits": {"hits": [_cruise_hit("1", "First")]}, "status": 200},
+                        {"error": {"type": "search_phase_execution_exception"}, "status": 400},
+                    ]
+                }
+            },
+        )
+        first, second = search_cruise_batch(
+            [
+                {"query": "deep learning", "top_k": 5, "filters": {"year": {"gte": 2015}}},
+                {"query": "screening", "top_k": 10},
+            ]
+        )
+
+        self.session.post.assert_called_once()
+        self.assertTrue(self.session.post.call_args.args[0].endswith("/msearch"))
+        searches = json.loads(self.session.post.call_args.kwargs["data"])["searches"]
+        self.assertEqual([search["es_top_k"] for search in searches], [5, 10])
+        self.assertEqual((first["status"], first["search_query"]), ("OK", "deep learning"))
+        self.assertEqual([a.title for a in first["results"]], ["First"])
+        self.assertEqual((second["status"], second["status_code"]), ("ERROR", 400))
+
+    @override_settings(CRUISE_ELASTICSEARCH_URL="http://es:9200")
+    def test_batch_search_direct_elasticsearch_backend(self):
+        self.session.post.side_effect = requests.exceptions.Timeout
+        results = search_cruise_batch(
+            [
+                {"query": "a", "top_k": 5, "filters": {"year": {"gte": 2015}}},
+                {"query": "b", "top_k": 5},
+            ]
+        )
+
+        self.assertEqual([result["status_code"] for result in results], [504, 504])
+        self.assertEqual(self.session.post.call_args.args[0], "http://es:9200/_msearch")
+        lines = self.session.post.call_args.kwargs["data"].splitlines()
+        self.assertEqual([json.loads(line) for line in lines[::2]], [{"index": "papers"}] * 2)
+        self.assertEqual(
+            json.loads(lines[1])["query"]["bool"]["filter"], [{"range": {"year": {"gte": 2015}}}]
+        )
+        self.assertNotIn("filter", json.loads(lines[3])["query"]["bool"])
+
+    def test_filtered_query_requires_the_query_text(self):
+        bool_query = query_builder.build_query(
+            "deep learning", 10, filters={"year": {"gte": 2015}}
+        )["query"]["bool"]
+        documents = {
+            "match": {"title": "Deep learning for screening", "year": 2020},
+            "other topic": {"title": "Cooking recipes", "year": 2020},
+            "too old": {"title": "Deep learning for screening", "year": 2010},
+        }
+        self.assertEqual(
+            [name for name, document in documents.items() if _es_bool_matches(bool_query, document)],
+            ["match"],
+        )
+
+    @override_settings(CRUISE_STREAM_MIN_TOP_K=100)
+    def test_large_searches_are_streamed_lazily(self):
+        pages = [
+            {"hits": [_cruise_hit(str(i), f"Title {i}") for i in range(start, start + 3)]}
+            for start in (0, 3)
+        ]
+        lines = [json.dumps(page).encode() for page in pages + [{"done": True, "total": 6}]]
+        self.session.post.return_value = mock.MagicMock(
+            status_code=200, iter_lines=lambda: iter(lines)
+        )
+        (result,) = search_cruise_batch([{"query": "deep learning", "top_k": 500}])
+        self.session.post.assert_not_called()
+
+        self.assertEqual([a.title for a in result["results"]], [f"Title {i}" for i in range(6)])
+        self.assertTrue(self.session.post.call_args.args[0].endswith("/search_stream"))
+        self.assertTrue(self.session.post.call_args.kwargs["stream"])
+
+    @override_settings(CRUISE_ELASTICSEARCH_URL="http://es:9200", CRUISE_STREAM_PAGE_SIZE=2)
+    def test_stream_pages_with_point_in_time(self):
+        hits = [{**_cruise_hit(str(i), f"Title {i}"), "sort": [1.0, i]} for i in range(3)]
+        self.session.post.side_effect = [
+            mock.Mock(status_code=200, json=lambda: {"id": "pit-1"}),
+            mock.Mock(
+                status_code=200, json=lambda: {"pit_id": "pit-2", "hits": {"hits": hits[:2]}}
+            ),
+            mock.Mock(status_code=500),
+        ]
+        result = search_cruise_stream("deep learning", 5)
+        with self.assertLogs(level="WARNING"):
+            titles = [a.title for a in result["results"]]
+
+        self.assertEqual(titles, ["Title 0", "Title 1"])
+        self.assertEqual((result["status"], result["status_code"]), ("ERROR", 500))
+        first_page, second_page = [
+            json.loads(call.kwargs["data"]) for call in self.session.post.call_args_list[1:]
+        ]
+        self.assertEqual((first_page["size"], first_page["pit"]["id"]), (2, "pit-1"))
+        self.assertNotIn("search_after", first_page)
+        self.assertEqual(second_page["pit"]["id"], "pit-2")
+        self.assertEqual(second_page["search_after"], [1.0, 1])
+        self.session.delete.assert_called_once_with(
+            "http://es:9200/_pit", json={"id": "pit-2"}, timeout=None
+        )
+
+
+    @override_settings(
+        CRUISE_ELASTICSEARCH_URL="http://es:9200",
+        CRUISE_SOURCE_INCLUDES=["*"],
+        CRUISE_STREAM_MIN_TOP_K=100,
+    )
+    def test_source_includes_of_direct_elasticsearch_backend(self):
+        self.session.post.return_value = mock.Mock(
+            status_code=200, json=lambda: {"id": "pit-1", "hits": {"hits": []}, "responses": []}
+        )
+        search_cruise("deep learning", top_k=2)
+        search_cruise_batch([{"query": "deep learning", "top_k": 2}])
+        list(search_cruise_stream("deep learning", 500)["results"])
+
+        search, msearch, _, stream_page = [
+            call.kwargs.get("data") for call in self.session.post.call_args_list
+        ]
+        queries = [json.loads(search), json.loads(msearch.splitlines()[1]), json.loads(stream_page)]
+        self.assertEqual([query["_source"] for query in queries], [{"includes": ["*"]}] * 3)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_burst_then_fail_fast(self):
+        bucket = TokenBucket("test", rate=1.0, capacity=2)
+        self.assertEqual(bucket.acquire(max_wait=0), 0.0)
+        self.assertEqual(bucket.acquire(max_wait=0), 0.0)
+        with self.assertRaises(RateLimitExceeded) as error:
+            bucket.acquire(max_wait=0)
+        self.assertAlmostEqual(error.exception.wait, 1.0, places=1)
+        self.assertEqual(bucket.stats()["rejected"], 1)
+
+    def test_state_is_shared_between_instances(self):
+        TokenBucket("test", rate=20.0).acquire()
+        with mock.patch("document_search.rate_limiter.time.sleep") as sleep:
+            wait = TokenBucket("test", rate=20.0).acquire()
+        self.assertGreater(wait, 0.0)
+        sleep.assert_called_once_with(wait)
+
+    def test_lock_taken_over_after_expiry_is_not_released(self):
+        bucket = TokenBucket("test", rate=1.0)
+        lock_key = f"{bucket.key}:lock"
+        with bucket._locked():
+            # the lock expired and another worker took it
+            cache.set(lock_key, "other")
+        self.assertEqual(cache.get(lock_key), "other")
+
+    def test_wait_is_not_counted_as_engine_latency(self):
+        bucket = TokenBucket("test", rate=10.0)
+        bucket.acquire()
+
+        def _search_method(query, top_k, timeout=None, rate_limit_wait=None):
+            bucket.acquire()
+            return failed_search("test", query, "OK", 200)
+
+        circuit_breaker = mock.Mock(**{"is_open.return_value": False, "timeout.return_value": 1.0})
+        adapter = SearchEngineAdapter(name="test", search_method=_search_method, max_top_k=10)
+        with mock.patch(
+            "document_search.registry.get_circuit_breaker", return_value=circuit_breaker
+        ):
+            adapter.search("query", 10)
+        latency = circuit_breaker.record.call_args.args[0]
+        self.assertLess(latency, 0.05)
+        self.assertGreater(bucket.stats()["total_wait"], 0.05)
+
+    def test_waits_of_pool_tasks_are_measured(self):
+        bucket = TokenBucket("test", rate=20.0)
+        with ThreadPoolExecutor(max_workers=3) as executor, measure_waits() as waits:
+            results = map_measuring_waits(executor, lambda i: (bucket.acquire(), i)[1], range(3))
+        self.assertEqual(results, [0, 1, 2])
+        # the tasks wait concurrently, the third token delays the caller by 2 / 20 seconds
+        self.assertEqual(len(waits), 1)
+        self.assertAlmostEqual(waits[0], 0.1, delta=0.02)
+
+
+class ScholarSearchJobTests(TestCase):
+    def _scrape(self, query, top_k):
+        return {
+            "results": [_article(f"scholar{i}", f"Title {i}") for i in range(top_k)],
+            "status": "OK",
+            "status_code": 200,
+        }
+
+    def test_results_are_served_once_the_worker_finished(self):
+        self.assertEqual(search_google_scholar("Deep  Learning", 5)["status"], "PENDING")
+        self.assertEqual(search_google_scholar("deep learning", 5)["status_code"], 202)
+        self.assertEqual(ScholarSearchJob.objects.count(), 1)
+
+        job = claim_scholar_search_job()
+        self.assertEqual(job.status, ScholarSearchJob.Status.RUNNING)
+        self.assertIsNone(claim_scholar_search_job())
+        with mock.patch(
+            "document_search.search_google_scholar.scrape_google_scholar", self._scrape
+        ):
+            run_scholar_search_job(job)
+
+        result = search_google_scholar("deep learning", 3)
+        self.assertEqual(result["status"], "OK")
+        self.assertEqual([a.id for a in result["results"]], ["scholar0", "scholar1", "scholar2"])
+
+    def test_larger_top_k_queues_the_job_again(self):
+        search_google_scholar("query", 5)
+        with mock.patch(
+            "document_search.search_google_scholar.scrape_google_scholar", self._scrape
+        ):
+            run_scholar_search_job(claim_scholar_search_job())
+
+        self.assertEqual(search_google_scholar("query", 10)["status"], "PENDING")
+        self.assertEqual(claim_scholar_search_job().top_k, 10)
+
+    def test_failed_job_is_an_error_until_retried(self):
+        search_google_scholar("query", 5)
+        with mock.patch(
+            "document_search.search_google_scholar.scrape_google_scholar",
+            side_effect=RuntimeError("blocked"),
+        ):
+            run_scholar_search_job(claim_scholar_search_job())
+
+        result = search_google_scholar("query", 5)
+        self.assertEqual((result["status"], result["status_code"]), ("ERROR", 503))
+        self.assertIsNone(claim_scholar_search_job())
+
+        ScholarSearchJob.objects.update(
+            finished_at=timezone.now() - datetime.timedelta(hours=1)
+        )
+        self.assertEqual(search_google_scholar("query", 5)["status"], "PENDING")
+
+
+class QueryLogTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "user_queries.log")
+
+    def _log(self, engine_logger, query, engine_statuses=None, page=1):
+        engine_logger.log_query(
+            search_query=query,
+            query_type="other",
+            search_time=0.2,
+            matched_wiki_page=None,
+            engine_statuses=engine_statuses,
+            n_results=3,
+            page=page,
+        )
+
+    def test_records_are_aggregated_across_rotated_logs(self):
+        engine_logger = EngineLogger(self.path, max_bytes=400, backup_count=5)
+        statuses = [
+            {
+                "results": [_article(str(i), "A") for i in range(2)],
+                "status": "OK",
+                "status_code": 200,
+                "search_engine": "CORE",
+                "search_query": "query",
+                "latency": 0.3,
+                "cache": "MISS",
+            },
+            {
+                "results": [_article(str(i), "B") for i in range(2)],
+                "status": "TIMEOUT",
+                "status_code": 504,
+                "search_engine": "PubMed",
+                "search_query": "query",
+                "latency": 3.0,
+            },
+        ]
+        self._log(engine_logger, "query", statuses)
+        self._log(engine_logger, "query", page=2)
+        self._log(engine_logger, "another query", statuses[:1])
+        engine_logger.close()
+        with open(self.path, "a") as log_file:
+            log_file.write("2020-01-01 00:00:00,000\tother\t0.1000\tlegacy\t\tNone\n")
+
+        paths = log_files(self.path)
+        self.assertGreater(len(paths), 1)
+        records = list(iter_query_log(paths))
+        self.assertEqual([r["query"] for r in records], ["query", "query", "another query"])
+        self.assertEqual(records[0]["dedup_ratio"], 0.25)
+        self.assertTrue(records[1]["from_session"])
+
+        (day,) = aggregate_query_log(records).values()
+        self.assertEqual((day["requests"], day["searches"]), (3, 2))
+        self.assertEqual(day["engines"]["CORE"]["cache"], {"MISS": 2})
+        self.assertEqual(day["engines"]["CORE"]["latency"]["p50"], 0.5)
+        self.assertEqual(day["engines"]["PubMed"]["statuses"], {"TIMEOUT": 1})
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_histogram_quantile_interpolates_within_bucket(self):
+        self.assertEqual(histogram_quantile(0.5, (1.0, 2.0), [0, 4, 0]), 1.5)
+        self.assertEqual(histogram_quantile(0.99, (1.0, 2.0), [1, 0, 1]), 2.0)
+        self.assertIsNone(histogram_quantile(0.5, (1.0, 2.0), [0, 0, 0]))
+
+    def test_metrics_are_aggregated_across_registries(self):
+        # every worker has its own registry, the values are added in the shared cache
+        workers = [MetricsRegistry(flush_interval=60) for _ in range(2)]
+        for registry in workers:
+            latency = registry.register(Metric("latency_seconds", "Latency.", buckets=(0.1, 1.0)))
+            requests = registry.register(Metric("requests_total", "Requests."))
+            latency.observe(0.5, engine="CORE")
+            requests.inc(engine="CORE", status="TIMEOUT", code="504")
+        workers[0].flush()
+
+        text = render_metrics(workers[1])
+        self.assertIn('latency_seconds_bucket{engine="CORE",le="1.0"} 2', text)
+        self.assertIn('latency_seconds_count{engine="CORE"} 2', text)
+        self.assertIn('latency_seconds_quantile{engine="CORE",quantile="0.5"} 0.5500', text)
+        self.assertIn('requests_total{code="504",engine="CORE",status="TIMEOUT"} 2', text)
+
+    def test_evicted_series_are_registered_again(self):
+        registry = MetricsRegistry(flush_interval=60)
+        requests = registry.register(Metric("requests_total", "Requests."))
+        requests.inc(engine="CORE")
+        registry.flush()
+        cache.delete(SERIES_KEY)
+
+        requests.inc(engine="CRUISE")
+        self.assertEqual(
+            registry.values(),
+            {"requests_total\x1fengine=CORE": 1, "requests_total\x1fengine=CRUISE": 1},
+        )
+
+    def test_cache_failures_do_not_break_requests(self):
+        registry = MetricsRegistry(flush_interval=0)
+        requests = registry.register(Metric("requests_total", "Requests."))
+        with mock.patch.object(cache, "incr", side_effect=ValueError):
+            requests.inc(engine="CORE")
+        with mock.patch.object(cache, "add", side_effect=ConnectionError), self.assertLogs(
+            level="ERROR"
+        ):
+            requests.inc(engine="CORE")
+        self.assertEqual(registry.values(), {"requests_total\x1fengine=CORE": 1})
+
+    @override_settings(METRICS_ALLOWED_IPS=["10.0.0.1"])
+    def test_metrics_endpoint_is_restricted(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        response = self.client.get("/metrics", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE search_engine_latency_seconds histogram", response.content.decode())
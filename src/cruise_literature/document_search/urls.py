@@ -4,4 +4,5 @@ from . import views
 
 urlpatterns = [
     path("search", views.search_results, name="search_results"),
+    path("metrics", views.metrics, name="metrics"),
 ]
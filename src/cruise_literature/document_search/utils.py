@@ -1,14 +1,23 @@
-from typing import List, Union, Dict
+import copy
+import re
+from dataclasses import fields
+from typing import List, Union, Dict, Optional, Tuple
 
+import numpy as np
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 
-from utils.article import Article
+from utils.article import Article, LazyArticle
 
-Articles = List[Article]
+Articles = List[Union[Article, LazyArticle]]
 SearchResultWithStatus = Dict[str, Union[Articles, int, str]]
 
 
-def paginate_results(search_result: list, page: int, results_per_page: int = 19):
+RESULTS_PER_PAGE = 19
+
+
+def paginate_results(
+    search_result: list, page: int, results_per_page: int = RESULTS_PER_PAGE
+):
     paginator = Paginator(search_result, results_per_page)
     try:
         search_result_list = paginator.page(page)
@@ -20,23 +29,122 @@ def paginate_results(search_result: list, page: int, results_per_page: int = 19)
     return search_result_list, paginator
 
 
+SORT_OPTIONS = ("relevance", "year", "citations")
+
+
+def _numeric(value) -> int:
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return -1
+
+
+def sort_results(search_result: Articles, sort: str) -> Articles:
+    """Returns a new list of results ordered by the sort option.
+    'relevance' keeps the order in which results were merged,
+    other options materialize lazy articles."""
+    if sort == "year":
+        return sorted(
+            search_result, key=lambda a: _numeric(str(a.publication_date)[:4]), reverse=True
+        )
+    if sort == "citations":
+        return sorted(search_result, key=lambda a: _numeric(a.n_citations), reverse=True)
+    return search_result
+
+
+DEDUP_ID_FIELDS = ("semantic_scholar_id", "core_id", "pmid", "arxiv_id")
+MERGED_FIELDS = [f.name for f in fields(Article) if f.name != "id"]
+_NON_WORD = re.compile(r"\W+")
+
+
+def normalize_title(title: Optional[str]) -> str:
+    """Lowercases the title and replaces punctuation and whitespace runs with single spaces."""
+    return _NON_WORD.sub(" ", title.casefold()).strip() if title else ""
+
+
+def _dedup_keys(article: Article) -> List[Tuple[str, str]]:
+    keys = []
+    if article.doi:
+        keys.append(("doi", article.doi.strip().lower()))
+    if title := normalize_title(article.title):
+        keys.append(("title", title))
+    for field in DEDUP_ID_FIELDS:
+        if value := getattr(article, field):
+            keys.append((field, str(value)))
+    return keys
+
+
+def _is_missing(value) -> bool:
+    if isinstance(value, str):
+        return not value.strip()
+    return value is None or value == [] or value == {}
+
+
+def _merge_duplicates(duplicates: Articles) -> Article:
+    """Returns a copy of the first article with missing fields filled in from
+    its duplicates, starting with the duplicate with the most fields set.
+    Lazy articles in the group are materialized."""
+    merged = copy.copy(duplicates[0].materialize())
+    missing = [field for field in MERGED_FIELDS if _is_missing(getattr(merged, field))]
+    donors = sorted(
+        duplicates[1:],
+        key=lambda a: sum(not _is_missing(getattr(a, f)) for f in MERGED_FIELDS),
+        reverse=True,
+    )
+    for field in missing:
+        for donor in donors:
+            if not _is_missing(value := getattr(donor, field)):
+                setattr(merged, field, value)
+                break
+    return merged
+
+
 def merge_results(
-    internal_search_results: List[Article],
-    core_search_results: List[Article],
-    semantic_scholar_results: List[Article],
-) -> List[Article]:
-    output_results_dict = {
-        item.title.lower().strip(): item for item in semantic_scholar_results
-    }
-    for _item in core_search_results:
-        if _item.title.lower() not in output_results_dict.keys():
-            semantic_scholar_results.append(_item)
-
-    output_results_dict = {
-        item.title.lower().strip(): item for item in semantic_scholar_results
-    }
-    for _item in internal_search_results:
-        if _item.title.lower() not in output_results_dict.keys():
-            semantic_scholar_results.append(_item)
-
-    return semantic_scholar_results
+    results: List[Articles], fuse_ranking: bool = True, rrf_k: int = 60
+) -> Articles:
+    """Merges result lists of any number of search engines in a single pass.
+
+    Duplicates are found with a hash index over DOI, normalized title and
+    engine specific IDs (Semantic Scholar, CORE, PubMed, arXiv), so results
+    without duplicates can stay LazyArticles. Missing fields of the first
+    occurrence are filled in from its duplicates.
+
+    With fuse_ranking, merged articles are ordered by reciprocal rank fusion:
+    score = sum over engines of 1 / (rrf_k + rank), ties keep the order of the input lists.
+    Otherwise, articles keep the order of their first occurrence, so the merged
+    list of already merged results with new results only appends to it.
+    Input lists can be shared with the search result cache, so they are never modified.
+
+    :param results: list of result lists, ordered by engine priority
+    :param fuse_ranking: if True, order the results with reciprocal rank fusion
+    :param rrf_k: reciprocal rank fusion constant
+    :return: deduplicated list of articles
+    """
+    key_index: Dict[Tuple[str, str], int] = {}
+    groups: List[Articles] = []
+    ranks = []  # (group, engine, rank) triplets
+    for engine_i, engine_results in enumerate(results):
+        for rank, article in enumerate(engine_results, start=1):
+            keys = _dedup_keys(article)
+            group_i = next((key_index[k] for k in keys if k in key_index), None)
+            if group_i is None:
+                group_i = len(groups)
+                groups.append([article])
+            else:
+                groups[group_i].append(article)
+            for key in keys:
+                key_index.setdefault(key, group_i)
+            ranks.append((group_i, engine_i, rank))
+
+    merged_results = [
+        group[0] if len(group) == 1 else _merge_duplicates(group) for group in groups
+    ]
+    if not fuse_ranking or not ranks:
+        return merged_results
+
+    group_ids, engine_ids, engine_ranks = np.array(ranks, dtype=np.int64).T
+    best_ranks = np.full((len(groups), len(results)), np.inf)
+    np.minimum.at(best_ranks, (group_ids, engine_ids), engine_ranks)
+    scores = (1.0 / (rrf_k + best_ranks)).sum(axis=1)
+    order = np.argsort(-scores, kind="stable")
+    return [merged_results[i] for i in order]
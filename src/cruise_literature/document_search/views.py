@@ -1,25 +1,56 @@
 import concurrent.futures
 import time
+from typing import List, Optional, Tuple
+from urllib.parse import urlencode
 
-from django.db.models import QuerySet
-
-from django.http import HttpResponseRedirect
+from django.conf import settings
+from django.http import (
+    HttpResponse,
+    HttpResponseForbidden,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from django.shortcuts import render
 from django.template.defaulttags import register
+from django.template.loader import render_to_string
 
 from .engine_logger import EngineLogger, get_query_type, get_wiki_logger
-from .search_core import search_core
-from .search_cruise import search_cruise
-from .search_google_scholar import search_google_scholar
-from .search_semantic_scholar import search_semantic_scholar
-from .search_pubmed import search_pubmed
+from .fan_out import get_executor, get_engine_timeout
+from .highlight import QueryHighlighter
+from .metrics import (
+    engine_requests,
+    pagination_latency,
+    record_engine_call,
+    render_metrics,
+)
 from .search_wikipedia import search_wikipedia
-from .utils import paginate_results, merge_results, Articles
+from .registry import search_engine_registry
+from .sessions import (
+    SearchSession,
+    create_search_session,
+    get_search_session,
+    save_search_session,
+)
+from .utils import (
+    paginate_results,
+    merge_results,
+    sort_results,
+    Articles,
+    SearchResultWithStatus,
+    SORT_OPTIONS,
+    RESULTS_PER_PAGE,
+)
 from .models import SearchEngine
+from utils.article import WikipediaArticle
 
 
 engine_logger = EngineLogger()
 
+STREAM_MARKER = "<!-- search results stream -->"
+
+# number of results requested from each search engine
+SEARCH_TOP_K = 50
+
 
 @register.filter
 def get_item(dictionary, key):
@@ -40,7 +71,12 @@ def keywords_threshold(keyword_score):
 
 def search_results(request):
     """
-    Search results page
+    Search results page.
+    The first request of a query runs the search and stores the merged results
+    in a search session. Following pages and sorting changes carry the session id
+    (`sid` GET param) and are served from the stored results.
+    With SEARCH_STREAM_RESULTS setting (or `stream=1` GET param) the first page
+    is streamed while the search engines answer.
     """
     if request.method != "GET":
         return
@@ -52,38 +88,78 @@ def search_results(request):
 
     s_time = time.time()
 
-    top_k = 50
-
-    search_engines = SearchEngine.objects.filter(is_available_for_search=True).all()
-    with concurrent.futures.ThreadPoolExecutor(
-        max_workers=len(search_engines)
-    ) as executor:
-        search_result: Articles = parallel_search(
-            search_engines, executor, search_query, top_k
+    search_session = None
+    # statuses of the engines queried by this request, None if served from a session
+    engine_statuses = None
+    if session_id := request.GET.get("sid"):
+        search_session = get_search_session(session_id)
+        if search_session is not None and search_session.pending_engines:
+            merge_pending_results(search_session, SEARCH_TOP_K)
+    if search_session is None or search_session.search_query != search_query:
+        if settings.SEARCH_STREAM_RESULTS or request.GET.get("stream") == "1":
+            return StreamingHttpResponse(
+                stream_search_results(request, search_query, query_type),
+                headers={"X-Accel-Buffering": "no"},
+            )
+        wiki_future = submit_search_wikipedia(search_query)
+        search_engines = search_engine_registry.get_engines(for_search=True)
+        search_result, engine_statuses = parallel_search(
+            search_engines, search_query, SEARCH_TOP_K
         )
 
-    matched_wiki_page = search_wikipedia(query=search_query)
-    search_time = time.time() - s_time
+        matched_wiki_page = get_wikipedia_result(wiki_future)
+        search_session = create_search_session(
+            search_query=search_query,
+            results=search_result,
+            search_time=time.time() - s_time,
+            engine_statuses=engine_statuses,
+            matched_wiki_page=matched_wiki_page,
+        )
 
+    p_time = time.monotonic()
+    sort = request.GET.get("sort", "relevance")
+    if sort not in SORT_OPTIONS:
+        sort = "relevance"
     search_result_list, paginator = paginate_results(
-        search_result=search_result, page=request.GET.get("page", 1)
+        search_result=sort_results(search_session.results, sort),
+        page=request.GET.get("page", 1),
     )
+    highlighter = get_highlighter(search_query)
+    search_result_list.object_list = [
+        highlighter.highlight_article(article)
+        for article in search_result_list.object_list
+    ]
+    pagination_latency.observe(time.monotonic() - p_time)
 
     engine_logger.log_query(
         search_query=search_query,
         query_type=query_type,
-        search_time=search_time,
-        matched_wiki_page=get_wiki_logger(matched_wiki_page),
+        search_time=time.time() - s_time,
+        matched_wiki_page=get_wiki_logger(search_session.matched_wiki_page),
+        engine_statuses=engine_statuses,
+        n_results=len(search_session.results),
+        page=search_result_list.number,
     )
 
     context = {
         "search_result_list": search_result_list,
-        "matched_wiki_page": matched_wiki_page,
-        "unique_searches": len(search_result),
-        "search_time": f"{search_time:.2f}",
+        "matched_wiki_page": search_session.matched_wiki_page,
+        "unique_searches": len(search_session.results),
+        "search_time": f"{search_session.search_time:.2f}",
         "search_query": search_query,
         "search_type": "",
         "paginator": paginator,
+        "timed_out_engines": [
+            status["search_engine"]
+            for status in search_session.engine_statuses
+            if status["status"] == "TIMEOUT"
+        ],
+        "pending_engines": search_session.pending_engines,
+        "sort": sort,
+        "sort_options": SORT_OPTIONS,
+        "session_query": urlencode(
+            {"search_query": search_query, "sid": search_session.id}
+        ),
     }
     return render(
         request=request,
@@ -92,41 +168,182 @@ def search_results(request):
     )
 
 
+def metrics(request):
+    """Search metrics of all workers in the Prometheus text format,
+    available only to the hosts in METRICS_ALLOWED_IPS."""
+    if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(
+        render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def get_highlighter(search_query: str) -> QueryHighlighter:
+    return QueryHighlighter(
+        search_query,
+        case_sensitive=settings.SEARCH_HIGHLIGHT_CASE_SENSITIVE,
+        stemming=settings.SEARCH_HIGHLIGHT_STEMMING,
+    )
+
+
+def merge_pending_results(search_session: SearchSession, top_k: int):
+    """Merges results of the engines which answered PENDING into the session,
+    once the results are available (e.g. when the scholar worker finished the search)."""
+    updated = False
+    for index, status in enumerate(search_session.engine_statuses):
+        if status["status"] != "PENDING":
+            continue
+        adapter = search_engine_registry.get_adapter_by_name(status["search_engine"])
+        if adapter is None:
+            continue
+        result = adapter.search(
+            search_session.search_query,
+            top_k,
+            rate_limit_wait=settings.RATE_LIMIT_MAX_WAIT,
+        )
+        if result["status"] == "PENDING":
+            continue
+        search_session.results = merge_results(
+            [search_session.results, result["results"]]
+        )
+        search_session.engine_statuses[index] = {
+            key: value for key, value in result.items() if key != "results"
+        }
+        updated = True
+    if updated:
+        save_search_session(search_session)
+
+
+def submit_search_wikipedia(search_query: str) -> concurrent.futures.Future:
+    """Starts the Wikipedia lookup on the search executor, so it runs together with the search engines."""
+    return get_executor().submit(_timed_search_wikipedia, search_query)
+
+
+def _timed_search_wikipedia(search_query: str) -> Optional[WikipediaArticle]:
+    start = time.monotonic()
+    matched_wiki_page = search_wikipedia(
+        search_query, timeout=get_engine_timeout("Wikipedia")
+    )
+    record_engine_call(
+        "Wikipedia",
+        time.monotonic() - start,
+        "OK" if matched_wiki_page else "NO_MATCH",
+        200,
+    )
+    return matched_wiki_page
+
+
+def get_wikipedia_result(
+    wiki_future: concurrent.futures.Future,
+) -> Optional[WikipediaArticle]:
+    """Waits for the Wikipedia lookup, at most for the Wikipedia timeout."""
+    try:
+        return wiki_future.result(timeout=get_engine_timeout("Wikipedia"))
+    except concurrent.futures.TimeoutError:
+        engine_requests.inc(engine="Wikipedia", status="TIMEOUT", code="504")
+        return None
+
+
+def stream_search_results(request, search_query: str, query_type: str):
+    """Generates the search results page in chunks.
+    The page shell is sent immediately. Result cards of every search engine are
+    sent as soon as the engine answers, deduplicated against all the results which
+    arrived earlier, until the first page is filled. When all engines answered, the
+    results are stored in a search session, so the following pages are served by
+    search_results from the session.
+    """
+    s_time = time.time()
+    page_head, page_tail = render_to_string(
+        "document_search/plain_search_stream.html",
+        {"search_query": search_query},
+        request=request,
+    ).split(STREAM_MARKER)
+    yield page_head
+
+    highlighter = get_highlighter(search_query)
+    wiki_future = submit_search_wikipedia(search_query)
+    wiki_rendered = False
+    search_engines = search_engine_registry.get_engines(for_search=True)
+    search_result: Articles = []
+    engine_statuses = []
+    for _, result in search_engine_registry.iter_search(
+        search_engines, search_query, top_k=SEARCH_TOP_K
+    ):
+        engine_statuses.append(result)
+        n_shown = min(len(search_result), RESULTS_PER_PAGE)
+        search_result = merge_results(
+            [search_result, result["results"]], fuse_ranking=False
+        )
+        render_wiki = wiki_future.done() and not wiki_rendered
+        wiki_rendered |= render_wiki
+        yield render_to_string(
+            "document_search/_search_stream_update.html",
+            {
+                "search_result_list": [
+                    highlighter.highlight_article(article)
+                    for article in search_result[n_shown:RESULTS_PER_PAGE]
+                ],
+                "matched_wiki_page": wiki_future.result() if render_wiki else None,
+                "status_message": f"{len(engine_statuses)} of {len(search_engines)} "
+                f"search engines answered, {len(search_result)} unique results so far...",
+            },
+            request=request,
+        )
+
+    matched_wiki_page = get_wikipedia_result(wiki_future)
+    search_time = time.time() - s_time
+    search_session = create_search_session(
+        search_query=search_query,
+        results=search_result,
+        search_time=search_time,
+        engine_statuses=engine_statuses,
+        matched_wiki_page=matched_wiki_page,
+    )
+    search_result_list, _ = paginate_results(search_result=search_result, page=1)
+    yield render_to_string(
+        "document_search/_search_stream_update.html",
+        {
+            "search_result_list": [],
+            "matched_wiki_page": None if wiki_rendered else matched_wiki_page,
+            "status_message": f"Returned {len(search_result)} unique search results "
+            f"({search_time:.2f} seconds)",
+        },
+        request=request,
+    )
+    yield render_to_string(
+        "document_search/_pagination.html",
+        {
+            "search_result_list": search_result_list,
+            "sort": "relevance",
+            "session_query": urlencode(
+                {"search_query": search_query, "sid": search_session.id}
+            ),
+        },
+        request=request,
+    )
+    engine_logger.log_query(
+        search_query=search_query,
+        query_type=query_type,
+        search_time=search_time,
+        matched_wiki_page=get_wiki_logger(matched_wiki_page),
+        engine_statuses=engine_statuses,
+        n_results=len(search_result),
+    )
+    yield page_tail
+
+
 def parallel_search(
-    search_engines: QuerySet[SearchEngine],
-    executor: concurrent.futures.ThreadPoolExecutor,
+    search_engines: List[SearchEngine],
     search_query: str,
     top_k: int,
-) -> Articles:
+) -> Tuple[Articles, List[SearchResultWithStatus]]:
     """Search in parallel search engines and return the merged results.
+    Engines which do not answer before their deadline are skipped, and only
+    the results which arrived in time are merged. Responses are served from
+    the search result cache when available.
     :param search_engines: list of search engines
-    :param executor: a concurrent.futures.ThreadPoolExecutor object
     :param search_query: a search query
     :param top_k: number of results to return from each search engine
-    :return: a list of search results (articles)
+    :return: a list of search results (articles) and a list of per-engine statuses
     """
-    results = [
-        executor.submit(
-            eval(search_engine.search_method.split(".")[-1]), search_query, top_k
-        )
-        for search_engine in search_engines
-    ]
-    results = [future.result() for future in concurrent.futures.as_completed(results)]
-
-    internal_results = [
-        result["results"] for result in results if result["search_engine"] == "CRUISE"
-    ][0]
-    core_results = [
-        result["results"] for result in results if result["search_engine"] == "CORE"
-    ][0]
-    semantic_scholar_results = [
-        result["results"]
-        for result in results
-        if result["search_engine"] == "Semantic Scholar"
-    ][0]
-
-    return merge_results(
-        internal_search_results=internal_results,
-        core_search_results=core_results,
-        semantic_scholar_results=semantic_scholar_results,
-    )
+    return search_engine_registry.search(search_engines, search_query, top_k)
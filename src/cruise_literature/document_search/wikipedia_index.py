@@ -0,0 +1,218 @@
+import bz2
+import os
+import re
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from utils.article import WikipediaArticle
+
+PAGE = "page"
+REDIRECT = "redirect"
+DISAMBIGUATION = "disambiguation"
+
+WIKIPEDIA_URL = "https://en.wikipedia.org/wiki/"
+MAX_LEAD_LENGTH = 2000
+MAX_REDIRECTS = 3
+
+_DISAMBIGUATION_TEMPLATE = re.compile(
+    r"\{\{\s*(disambiguation|disambig|dab|hndis|geodis|surname|given name)\s*[|}]",
+    re.IGNORECASE,
+)
+_OPTION_LINK = re.compile(r"^\*+[^\[\n]*\[\[([^\]|#]+)", re.MULTILINE)
+_TEMPLATE = re.compile(r"\{\{[^{}]*\}\}")
+_TABLE = re.compile(r"\{\|.*?\|\}", re.DOTALL)
+_REF = re.compile(r"<ref[^>/]*/>|<ref[^>]*>.*?</ref>", re.DOTALL | re.IGNORECASE)
+_COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+_FILE_LINK = re.compile(
+    r"\[\[(?:File|Image|Category):[^\[\]]*(?:\[\[[^\]]*\]\][^\[\]]*)*\]\]", re.IGNORECASE
+)
+_LINK = re.compile(r"\[\[(?:[^\]|]*\|)?([^\]]*)\]\]")
+_EXTERNAL_LINK = re.compile(r"\[https?://[^\s\]]*\s?([^\]]*)\]")
+_TAG = re.compile(r"<[^>]+>")
+_EMPHASIS = re.compile(r"'{2,}")
+_SPACES = re.compile(r"[ \t]+")
+
+
+def title_key(title: str) -> str:
+    """Titles are matched ignoring the case and underscores, as the query is typed by users."""
+    return " ".join(title.replace("_", " ").split()).casefold()
+
+
+def lead_section(wikitext: str) -> str:
+    """Returns the plain text of the section before the first heading.
+    Only the markup commonly used in lead sections is stripped."""
+    lead = wikitext.split("\n==", 1)[0]
+    lead = _COMMENT.sub("", lead)
+    lead = _REF.sub("", lead)
+    while True:
+        stripped = _TEMPLATE.sub("", lead)
+        if stripped == lead:
+            break
+        lead = stripped
+    lead = _TABLE.sub("", lead)
+    lead = _FILE_LINK.sub("", lead)
+    lead = _LINK.sub(r"\1", lead)
+    lead = _EXTERNAL_LINK.sub(r"\1", lead)
+    lead = _TAG.sub("", lead)
+    lead = _EMPHASIS.sub("", lead)
+    lines = (_SPACES.sub(" ", line).strip() for line in lead.splitlines())
+    return "\n".join(line for line in lines if line)[:MAX_LEAD_LENGTH]
+
+
+def iter_dump_pages(dump: IO[bytes]) -> Iterator[Tuple[str, str, str, str]]:
+    """Streams (title, page id, redirect target, wikitext) of article pages from
+    a pages-articles XML dump. Parsed pages are dropped from the tree right away,
+    so the memory use does not grow with the size of the dump."""
+    title = page_id = redirect = text = namespace = None
+    root = None
+    for event, element in ET.iterparse(dump, events=("start", "end")):
+        if root is None:
+            root = element
+        if event == "start":
+            continue
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "title":
+            title = element.text
+        elif tag == "ns":
+            namespace = element.text
+        elif tag == "id" and page_id is None:
+            page_id = element.text
+        elif tag == "redirect":
+            redirect = element.get("title")
+        elif tag == "text":
+            text = element.text or ""
+        elif tag == "page":
+            if namespace == "0" and title:
+                yield title, page_id, redirect, text or ""
+            title = page_id = redirect = text = namespace = None
+            root.clear()
+
+
+def parse_page(title: str, page_id: str, redirect: Optional[str], text: str) -> Tuple:
+    """Returns a row of the titles table for a page of the dump."""
+    if redirect:
+        return title_key(title), title, page_id, REDIRECT, redirect, None
+    if _DISAMBIGUATION_TEMPLATE.search(text):
+        options = [link.strip() for link in _OPTION_LINK.findall(text)]
+        return title_key(title), title, page_id, DISAMBIGUATION, "\n".join(options), None
+    return title_key(title), title, page_id, PAGE, None, lead_section(text)
+
+
+def build_index(dump_path: str, index_path: str, batch_size: int = 10000) -> int:
+    """Builds the title index from a (optionally bz2 compressed) pages-articles dump.
+
+    The index is written to a temporary file, which replaces the existing index
+    only when it is complete, so the running workers are never left without one.
+
+    :return: number of indexed titles
+    """
+    tmp_path = f"{index_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute(
+        "CREATE TABLE titles (key TEXT PRIMARY KEY, title TEXT, page_id INTEGER, "
+        "kind TEXT, target TEXT, lead TEXT) WITHOUT ROWID"
+    )
+    open_dump = bz2.open if dump_path.endswith(".bz2") else open
+    n_titles = 0
+    with open_dump(dump_path, "rb") as dump:
+        batch = []
+        for page in iter_dump_pages(dump):
+            batch.append(parse_page(*page))
+            if len(batch) >= batch_size:
+                n_titles += _insert(connection, batch)
+                batch = []
+        n_titles += _insert(connection, batch)
+    connection.commit()
+    connection.close()
+
+    os.replace(tmp_path, index_path)
+    return n_titles
+
+
+def _insert(connection: sqlite3.Connection, rows: List[Tuple]) -> int:
+    # titles differing only in case share a key, the first page of the dump wins
+    cursor = connection.executemany(
+        "INSERT OR IGNORE INTO titles VALUES (?, ?, ?, ?, ?, ?)", rows
+    )
+    return cursor.rowcount
+
+
+class WikipediaIndex:
+    """Read-only access to the title index built by the build_wikipedia_index command.
+    Every thread uses its own SQLite connection, which is reopened when the index
+    file is replaced by a rebuild."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        modified = os.stat(self.path).st_mtime_ns
+        if getattr(self._local, "modified", None) != modified:
+            if getattr(self._local, "connection", None) is not None:
+                self._local.connection.close()
+            self._local.connection = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True
+            )
+            self._local.modified = modified
+        return self._local.connection
+
+    def _get_rows(self, titles: List[str]) -> Dict[str, Tuple]:
+        keys = [title_key(title) for title in titles]
+        rows = self.connection.execute(
+            "SELECT key, title, page_id, kind, target, lead FROM titles "
+            f"WHERE key IN ({', '.join('?' * len(keys))})",
+            keys,
+        ).fetchall()
+        return {row[0]: row for row in rows}
+
+    def _resolve_redirects(self, titles: List[str]) -> List[Optional[Tuple]]:
+        rows = self._get_rows(titles)
+        resolved = [rows.get(title_key(title)) for title in titles]
+        for _ in range(MAX_REDIRECTS):
+            targets = [row[4] for row in resolved if row and row[3] == REDIRECT]
+            if not targets:
+                break
+            target_rows = self._get_rows(targets)
+            resolved = [
+                target_rows.get(title_key(row[4])) if row and row[3] == REDIRECT else row
+                for row in resolved
+            ]
+        return resolved
+
+    def lookup(
+        self, query: str, max_depth: int = 1, max_options: int = 20
+    ) -> Optional[WikipediaArticle]:
+        """Returns the article with the title equal to the query, following redirects
+        and, up to max_depth levels, the first max_options options of disambiguation pages."""
+        titles = [query]
+        for depth in range(max_depth + 1):
+            disambiguation = None
+            for row in self._resolve_redirects(titles):
+                if row is None or row[3] == REDIRECT:
+                    continue
+                if row[3] == DISAMBIGUATION:
+                    disambiguation = disambiguation or row
+                    continue
+                _, title, page_id, _, _, lead = row
+                return WikipediaArticle(
+                    id=page_id,
+                    title=title,
+                    url=WIKIPEDIA_URL + quote(title.replace(" ", "_")),
+                    snippet=f"{lead[:300]}...",
+                    content=lead,
+                    ambiguous=depth == 0,
+                )
+            if disambiguation is None or not disambiguation[4]:
+                return None
+            titles = disambiguation[4].split("\n")[:max_options]
+        return None
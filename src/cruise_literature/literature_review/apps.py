@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class LiteratureReviewConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "literature_review"
+
+    def ready(self):
+        from . import signals  # noqa: F401
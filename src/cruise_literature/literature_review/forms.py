@@ -1,5 +1,4 @@
 import copy
-from dataclasses import asdict
 import datetime
 from typing import Dict, Any, List
 
@@ -8,16 +7,13 @@ from django import forms
 from organisations.models import Organisation
 from .models import LiteratureReview, LiteratureReviewMember
 from document_search.models import SearchEngine
+from document_search.registry import search_engine_registry
+from utils.article import Article
 from django.contrib.postgres.forms import (
     SimpleArrayField,
     ValidationError,
     prefix_validation_error,
 )
-from document_search.search_semantic_scholar import search_semantic_scholar
-from document_search.search_core import search_core
-from document_search.search_google_scholar import search_google_scholar
-from document_search.search_cruise import search_cruise
-from document_search.search_pubmed import search_pubmed
 from users.models import KnowledgeArea
 
 
@@ -139,6 +135,48 @@ def deduplicate(
     return deduplicated
 
 
+def add_search_results(
+    papers: Dict[str, Dict[str, Any]],
+    search_results: List[Article],
+    search_engine_name: str,
+    query: str,
+    added_by: str,
+    added_at: str,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Adds search results to the papers of a literature review, with the search origin
+    and empty screening fields. Papers are keyed by their id, papers already present
+    only get the new search origin. Run deduplicate() afterwards.
+
+    :param papers: papers of the review, updated in place
+    :param search_results: articles returned by the search engine
+    :return: the updated papers
+    """
+    for paper in search_results:
+        # shallow copy, nested values are shared with the article (merge_papers() copies before merging)
+        paper = paper.to_dict()
+
+        paper["search_origin"] = [
+            {
+                "search_engine": search_engine_name,
+                "query": query,
+                "added_at": added_at,
+                "added_by": added_by,
+                "origin": "search",
+                "id": paper["id"],
+            }
+        ]
+        if paper["id"] in papers:
+            # keep screening of the paper found earlier, only record the new origin
+            papers[paper["id"]]["search_origin"] += paper["search_origin"]
+            continue
+        paper["decision"] = None
+        paper["outcome"] = None
+        paper["screened"] = False
+        papers[paper["id"]] = paper
+    return papers
+
+
 def create_criteria(
     inclusion_criteria: List[str],
     exclusion_criteria: List[str],
@@ -217,9 +255,10 @@ class NewLiteratureReviewForm(forms.ModelForm):
 
     search_engines = forms.MultipleChoiceField(
         label=r"""Select in which search engines you want to search for the papers""",
-        choices=lambda: SearchEngine.objects.filter(is_available_for_review=True).values_list(
-            "id", "name"
-        ),
+        choices=lambda: [
+            (engine.id, engine.name)
+            for engine in search_engine_registry.get_engines(for_review=True)
+        ],
         initial=lambda: list(
             SearchEngine.objects.filter(
                 name__in=["CRUISE", "SemanticScholar", "CORE"]
@@ -232,16 +271,17 @@ class NewLiteratureReviewForm(forms.ModelForm):
             }
         ),
         help_text="""By default, it uses the internal CRUISE database, SemanticScholar and CORE.
-        Selecting Google Scholar will drastically increase the search time.
+        Google Scholar results are collected in the background and added to the review when they are ready.
         PubMed is the only search engine which supports Boolean operators in search queries.""",
     )
     top_k = forms.IntegerField(
         initial=25,
-        max_value=500,
+        max_value=5000,
         min_value=10,
         label="Number of records retrieved per search query",
         widget=forms.NumberInput(attrs={"class": "input"}),
-        help_text="The maximal value is 500.",
+        help_text="""The maximal value is 5000.
+        Search engines with a lower limit (e.g. 100 for CORE) return fewer records.""",
     )
 
     review_type = forms.ChoiceField(
@@ -299,6 +339,8 @@ class NewLiteratureReviewForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         self.user = kwargs.pop("user", None)
+        # statuses of the searches which failed in save(), their results are missing or incomplete
+        self.failed_searches: List[Dict[str, Any]] = []
         super(NewLiteratureReviewForm, self).__init__(*args, **kwargs)
 
     def save(self, commit=True):
@@ -310,33 +352,51 @@ class NewLiteratureReviewForm(forms.ModelForm):
         results: Dict[str, Dict[str, Any]] = {}
 
         search_time_now = str(datetime.datetime.now())
-        for query in queries:
-            # TODO: add more search engines
-            for search_engine_name in search_engines:
-                search_engine = SearchEngine.objects.filter(
-                    id=int(search_engine_name)
-                ).first()
-                search_method = eval(search_engine.search_method.split(".")[-1])
-
-                for paper in search_method(query=query, top_k=top_k)["results"]:
-                    paper = asdict(paper)
-
-                    paper["search_origin"] = [
+        search_engines = [
+            search_engine_registry.get_engine(int(search_engine_id))
+            for search_engine_id in search_engines
+        ]
+        # engines with a batch search answer all the queries in one request
+        engine_results = [
+            search_engine_registry.get_adapter(search_engine).search_batch(
+                [{"query": query, "top_k": top_k} for query in queries]
+            )
+            for search_engine in search_engines
+        ]
+        pending_searches = []
+        for query_i, query in enumerate(queries):
+            for search_engine, search_results in zip(search_engines, engine_results):
+                adapter = search_engine_registry.get_adapter(search_engine)
+                search_result = search_results[query_i]
+                if search_result["status"] == "PENDING":
+                    # retrieved in the background, added to papers by add_pending_search_results
+                    pending_searches.append(
                         {
+                            "engine": adapter.name,
                             "search_engine": search_engine.name,
                             "query": query,
+                            # the finished job is matched by the query the engine received
+                            "engine_query": adapter.engine_query(query),
+                            "top_k": top_k,
                             "added_at": search_time_now,
                             "added_by": self.user.username,
-                            "origin": "search",
-                            "id": paper["id"],
                         }
-                    ]
-                    paper["decision"] = None
-                    paper["outcome"] = None
-                    paper["screened"] = False
-                    results[paper["id"]] = paper
+                    )
+                    continue
+                add_search_results(
+                    results,
+                    search_result["results"],
+                    search_engine_name=search_engine.name,
+                    query=query,
+                    added_by=self.user.username,
+                    added_at=search_time_now,
+                )
+                # streamed results (see search_cruise_stream) fail while they are consumed
+                if search_result["status"] != "OK":
+                    self.failed_searches.append(search_result)
         results = deduplicate(results=results)
         instance.papers = results
+        instance.pending_searches = pending_searches
         instance.ready_for_screening = False
         instance.search_updated_at = search_time_now
         instance.papers_updated_at = search_time_now
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("literature_review", "0007_literaturereview_review_type"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="literaturereview",
+            name="pending_searches",
+            field=models.JSONField(
+                blank=True,
+                default=list,
+                help_text="Searches running in the background, their results are added to papers when they finish.",
+            ),
+        ),
+    ]
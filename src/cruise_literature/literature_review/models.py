@@ -122,6 +122,11 @@ class LiteratureReview(models.Model):
     papers = models.JSONField(
         null=True, help_text="All papers in the literature review."
     )
+    pending_searches = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="Searches running in the background, their results are added to papers when they finish.",
+    )
 
     def __init__(self, *args, **kwargs):
         super(LiteratureReview, self).__init__(*args, **kwargs)
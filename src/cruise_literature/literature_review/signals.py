@@ -0,0 +1,53 @@
+import logging
+
+from django.db import transaction
+from django.dispatch import receiver
+
+from document_search.cache import normalize_query
+from document_search.models import ScholarSearchJob
+from document_search.signals import scholar_search_finished
+from utils.article import Article
+from .forms import add_search_results, deduplicate
+from .models import LiteratureReview
+
+
+@receiver(scholar_search_finished)
+def add_pending_search_results(sender, job: ScholarSearchJob, **kwargs):
+    """Adds results of a finished Google Scholar search to the papers of all
+    literature reviews waiting for it. When the search failed, the review
+    stops waiting and keeps the results of the other search engines."""
+    reviews = LiteratureReview.objects.filter(
+        pending_searches__contains=[{"engine": "Google Scholar"}]
+    ).values_list("id", flat=True)
+    for review_id in reviews:
+        with transaction.atomic():
+            review = LiteratureReview.objects.select_for_update().get(pk=review_id)
+            finished = [
+                search
+                for search in review.pending_searches
+                if search["engine"] == "Google Scholar"
+                and normalize_query(search.get("engine_query", search["query"])) == job.query
+            ]
+            if not finished:
+                continue
+
+            papers = review.papers or {}
+            for search in finished:
+                if job.status != ScholarSearchJob.Status.DONE:
+                    logging.warning(
+                        f"Google Scholar search '{search['query']}' of review {review_id} failed: {job.error}"
+                    )
+                    continue
+                add_search_results(
+                    papers,
+                    [Article(**paper) for paper in job.results[: search["top_k"]]],
+                    search_engine_name=search["search_engine"],
+                    query=search["query"],
+                    added_by=search["added_by"],
+                    added_at=search["added_at"],
+                )
+            review.papers = deduplicate(results=papers)
+            review.pending_searches = [
+                search for search in review.pending_searches if search not in finished
+            ]
+            review.save()
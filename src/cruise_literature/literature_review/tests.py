@@ -1,11 +1,15 @@
 import json
 from datetime import datetime
+from unittest import mock
 
+from django.core.cache import cache
 from django.test import TestCase, Client
 from django.urls import reverse
 
 
-from document_search.models import SearchEngine
+from document_search.models import ScholarSearchJob, SearchEngine
+from document_search.signals import scholar_search_finished
+from .forms import NewLiteratureReviewForm
 from .models import LiteratureReview, LiteratureReviewMember
 from .views import (
     create_new_review,
@@ -16,6 +20,7 @@ from .views import (
     add_seed_studies,
 )
 from users.models import User
+from utils.article import Article
 from utils.process_pdf import parse_doc_grobid
 
 _fake_paper = {
@@ -463,3 +468,162 @@ class ViewTests(TestCase):
         self.assertRedirects(
             response, "/accounts/login/?next=/literature_review/1/add_seed_studies"
         )
+
+
+class PendingSearchResultsTests(TestCase):
+    fixtures = [
+        "search_engines.json",
+    ]
+
+    def test_finished_scholar_search_is_added_to_waiting_reviews(self):
+        review = LiteratureReview.objects.create(
+            title="Review",
+            project_deadline="2020-01-01",
+            papers={"1": dict(_fake_paper, search_origin=[])},
+            pending_searches=[
+                {
+                    "engine": "Google Scholar",
+                    "search_engine": "GoogleScholar",
+                    "query": "Fake  Query",
+                    "top_k": 1,
+                    "added_at": "2020-01-01",
+                    "added_by": "testuser",
+                }
+            ],
+        )
+        results = [
+            Article(
+                id=f"scholar_{i}",
+                title=f"Scholar paper {i}",
+                url=f"https://www.fake.com/{i}",
+                pdf=None,
+                snippet="",
+                abstract=None,
+                authors="Fake author",
+            )
+            for i in (1, 2)
+        ]
+        job = ScholarSearchJob.objects.create(
+            query="fake query",
+            top_k=2,
+            status=ScholarSearchJob.Status.DONE,
+            results=[article.to_dict() for article in results],
+            queued_at="2020-01-01T00:00:00Z",
+        )
+        scholar_search_finished.send(sender=ScholarSearchJob, job=job)
+
+        review.refresh_from_db()
+        self.assertEqual(review.pending_searches, [])
+        self.assertEqual(set(review.papers), {"1", "scholar_1"})
+        self.assertEqual(
+            review.papers["scholar_1"]["search_origin"][0]["search_engine"], "GoogleScholar"
+        )
+
+    def test_boolean_query_is_matched_by_the_engine_query(self):
+        cache.clear()
+        form = NewLiteratureReviewForm(
+            {
+                "title": "Boolean review",
+                "description": "Test Description",
+                "project_deadline": "2020-01-01",
+                "search_queries": "covid AND (vaccine OR mRNA)",
+                "inclusion_criteria": "test",
+                "exclusion_criteria": "test",
+                "top_k": 10,
+                "search_engines": [SearchEngine.objects.get(name="Google Scholar").id],
+                "annotations_per_paper": 1,
+                "review_type": "AN",
+            },
+            user=User.objects.create_user(username="testuser", email=""),
+        )
+        self.assertTrue(form.is_valid(), form.errors)
+        review = form.save()
+        self.assertEqual(len(review.pending_searches), 1)
+
+        job = ScholarSearchJob.objects.get()
+        self.assertEqual(job.query, "covid vaccine mrna")
+        job.status = ScholarSearchJob.Status.DONE
+        job.results = [
+            Article(
+                id="scholar_1",
+                title="Scholar paper",
+                url="https://www.fake.com/1",
+                pdf=None,
+                snippet="",
+                abstract=None,
+                authors="Fake author",
+            ).to_dict()
+        ]
+        job.save()
+        scholar_search_finished.send(sender=ScholarSearchJob, job=job)
+
+        review.refresh_from_db()
+        self.assertEqual(review.pending_searches, [])
+        self.assertIn("scholar_1", review.papers)
+
+
+class StreamedSearchTests(TestCase):
+    fixtures = [
+        "search_engines.json",
+    ]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", email="")
+        self.session = mock.MagicMock()
+        mock.patch(
+            "document_search.search_cruise.get_session", return_value=self.session
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _save(self, lines):
+        self.session.post.return_value = mock.MagicMock(
+            status_code=200, iter_lines=lambda: iter(json.dumps(line) for line in lines)
+        )
+        form = NewLiteratureReviewForm(
+            {
+                "title": "Exhaustive review",
+                "description": "Test Description",
+                "project_deadline": "2020-01-01",
+                "search_queries": "test",
+                "inclusion_criteria": "test",
+                "exclusion_criteria": "test",
+                "top_k": 2000,
+                "search_engines": [SearchEngine.objects.get(name="CRUISE").id],
+                "annotations_per_paper": 1,
+                "review_type": "AN",
+            },
+            user=self.user,
+        )
+        self.assertTrue(form.is_valid(), form.errors)
+        return form, form.save()
+
+    def _page(self, start, n):
+        return {
+            "hits": [
+                {"_id": str(i), "_source": {"title": f"Paper {i}", "abstract": "Abstract"}}
+                for i in range(start, start + n)
+            ]
+        }
+
+    def test_large_top_k_is_streamed_into_the_review(self):
+        form, review = self._save(
+            [self._page(0, 3), self._page(3, 2), {"done": True, "total": 5}]
+        )
+
+        self.assertTrue(self.session.post.call_args.args[0].endswith("/search_stream"))
+        self.assertEqual(json.loads(self.session.post.call_args.kwargs["data"])["es_top_k"], 2000)
+        self.assertEqual(len(review.papers), 5)
+        self.assertEqual(form.failed_searches, [])
+
+    def test_failed_stream_is_reported(self):
+        with self.assertLogs(level="WARNING"):
+            form, review = self._save(
+                [self._page(0, 3), {"error": "shard failure", "status": 500}]
+            )
+
+        self.assertEqual(len(review.papers), 3)
+        self.assertEqual(
+            [(s["search_engine"], s["status_code"]) for s in form.failed_searches],
+            [("CRUISE", 500)],
+        )
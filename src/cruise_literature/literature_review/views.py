@@ -31,6 +31,12 @@ def create_new_review(request):
             form.save()
             title = form.cleaned_data.get("title")
             messages.success(request, f"New review created: {title}")
+            for search in form.failed_searches:
+                messages.warning(
+                    request,
+                    f"{search['search_engine']} search '{search['search_query']}' failed "
+                    f"({search['status_code']}), its records are missing or incomplete",
+                )
             return redirect(
                 "literature_review:manage_review", review_id=form.instance.id
             )
@@ -1,9 +1,43 @@
-from dataclasses import dataclass
-from typing import Union, Optional, Dict, List
+from dataclasses import dataclass, fields
+from typing import Any, Callable, Union, Optional, Dict, List
 
 
+def slotted(cls):
+    """Recreates a dataclass with __slots__, so its instances have no __dict__.
+    Equivalent of @dataclass(slots=True), which is not available in Python 3.9.
+    Field defaults are kept by the generated __init__, so they are removed from the class."""
+    field_names = tuple(f.name for f in fields(cls))
+    cls_dict = {
+        key: value
+        for key, value in cls.__dict__.items()
+        if key not in field_names and key not in ("__dict__", "__weakref__")
+    }
+    cls_dict["__slots__"] = field_names
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
+class _AsDict:
+    """Shallow serialization of slotted dataclasses."""
+
+    __slots__ = ()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the fields as a dict, without copying their values (unlike dataclasses.asdict),
+        so lists and dicts are shared with the instance."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        # instances pickled before the classes were slotted (e.g. in the shared search caches)
+        # have a dict state, slotted instances have a (None, slots) tuple
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
+@slotted
 @dataclass
-class Article:
+class Article(_AsDict):
     """Class for representing an article."""
 
     id: str
@@ -29,9 +63,76 @@ class Article:
     pmid: Optional[str] = None
     arxiv_id: Optional[str] = None
 
+    def materialize(self) -> "Article":
+        return self
+
+
+class LazyArticle:
+    """Search result kept in the raw form returned by a search engine.
 
-@dataclass()
-class WikipediaArticle:
+    Only the fields used to deduplicate results (see document_search.utils.merge_results)
+    are set when the result is created. The Article is built from the raw result by
+    `build` on the first access of any other field, e.g. when the result is shown on
+    a page, so results which are never displayed are never converted.
+    `build` must be a module level function, so that lazy articles can be pickled.
+    """
+
+    __slots__ = (
+        "id",
+        "title",
+        "doi",
+        "semantic_scholar_id",
+        "core_id",
+        "pmid",
+        "arxiv_id",
+        "_raw",
+        "_build",
+        "_article",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        title: str,
+        raw: Any,
+        build: Callable[[Any], Article],
+        doi: Optional[str] = None,
+        semantic_scholar_id: Optional[str] = None,
+        core_id: Optional[str] = None,
+        pmid: Optional[str] = None,
+        arxiv_id: Optional[str] = None,
+    ):
+        self.id = id
+        self.title = title
+        self.doi = doi
+        self.semantic_scholar_id = semantic_scholar_id
+        self.core_id = core_id
+        self.pmid = pmid
+        self.arxiv_id = arxiv_id
+        self._raw = raw
+        self._build = build
+        self._article: Optional[Article] = None
+
+    def materialize(self) -> Article:
+        """Returns the Article built from the raw result, building it on the first call."""
+        if self._article is None:
+            self._article = self._build(self._raw)
+            self._raw = None
+        return self._article
+
+    def __getattr__(self, name: str):
+        # called only for attributes which are not slots, i.e. the other fields of Article
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.materialize(), name)
+
+    def __repr__(self) -> str:
+        return f"LazyArticle(id={self.id!r}, title={self.title!r})"
+
+
+@slotted
+@dataclass
+class WikipediaArticle(_AsDict):
     """Class for representing Wikipedia article."""
 
     id: str
@@ -43,8 +144,9 @@ class WikipediaArticle:
     keywords: Optional[List[str]] = None
 
 
-@dataclass()
-class Author:
+@slotted
+@dataclass
+class Author(_AsDict):
     """Class for representing an author."""
 
     display_name: str
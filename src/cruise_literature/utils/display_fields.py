@@ -0,0 +1,56 @@
+"""Fields of AMiner papers shown on the search results page.
+
+They are computed once when the papers are indexed (see scripts/data/filter_AMiner.py
+and scripts/add_docs.py) and stored in the `display` object of the indexed document,
+so the search returns them instead of the full references and keyword lists.
+"""
+import heapq
+from operator import itemgetter
+from typing import Any, Dict
+
+SNIPPET_LENGTH = 300
+TOP_KEYWORDS = 6
+
+
+def display_fields(paper: Dict[str, Any]) -> Dict[str, Any]:
+    """Computes the display fields of an AMiner paper:
+    snippet, top keywords by score (keywords_snippet) and the other keywords in their
+    original order (keywords_rest), reference and citation counts, venue name and first URL.
+
+    :param paper: AMiner paper as written by filter_AMiner.py
+    """
+    keywords = paper.get("keywords") or {}
+    if isinstance(keywords, list):  # not scored yet
+        keywords = dict.fromkeys(keywords, 0.0)
+    keywords_snippet = dict(
+        heapq.nlargest(TOP_KEYWORDS, keywords.items(), key=itemgetter(1))
+    )
+    keywords_rest = {
+        keyword: score
+        for keyword, score in keywords.items()
+        if keyword not in keywords_snippet
+    }
+
+    n_citations = paper.get("n_citations") or paper.get("n_citation") or 0
+    if isinstance(n_citations, list):
+        n_citations = len(n_citations)
+
+    venue = paper.get("venue")
+    if isinstance(venue, dict):
+        venue = venue.get("name_d") or venue.get("raw") or ""
+    elif not isinstance(venue, str):
+        venue = ""
+
+    urls = paper.get("url")
+    if isinstance(urls, str):
+        urls = [urls]
+
+    return {
+        "snippet": (paper.get("abstract") or "")[:SNIPPET_LENGTH],
+        "keywords_snippet": keywords_snippet,
+        "keywords_rest": keywords_rest,
+        "n_references": len(paper.get("references") or []),
+        "n_citations": int(n_citations),
+        "venue": venue,
+        "url": urls[0] if urls else "",
+    }
@@ -0,0 +1,112 @@
+import random
+import threading
+from typing import Dict
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class JitterRetry(Retry):
+    """Exponential backoff retry policy with random jitter added to every wait,
+    so that retries of concurrent requests do not hit the upstream at the same time."""
+
+    def __init__(self, *args, jitter: float = 0.0, **kwargs):
+        self.jitter = jitter
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.jitter = self.jitter
+        return retry
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return backoff
+        return backoff + random.uniform(0, self.jitter)
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter counting requests in flight, so that pool saturation can be monitored.
+    When more requests are in flight than pool_maxsize, the extra connections are
+    opened and then discarded instead of being kept alive."""
+
+    def __init__(self, pool_maxsize: int, **kwargs):
+        self.pool_maxsize = pool_maxsize
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.saturated_requests = 0
+        super().__init__(pool_maxsize=pool_maxsize, **kwargs)
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            if self.in_flight > self.pool_maxsize:
+                self.saturated_requests += 1
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "pool_maxsize": self.pool_maxsize,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "requests": self.requests,
+                "saturated_requests": self.saturated_requests,
+            }
+
+
+_sessions: Dict[str, requests.Session] = {}
+_adapters: Dict[str, PooledHTTPAdapter] = {}
+_lock = threading.Lock()
+
+
+def get_session(name: str) -> requests.Session:
+    """Returns a process-wide keep-alive session for an upstream service.
+
+    Connections are pooled per host, the pool size is taken from
+    HTTP_POOL_MAXSIZE[name] (or HTTP_POOL_MAXSIZE["default"]). Connection errors
+    are retried for all requests, read errors and RETRY_STATUSES only for
+    idempotent methods (so e.g. POST is never sent twice).
+    """
+    if name not in _sessions:
+        with _lock:
+            if name not in _sessions:
+                adapter = PooledHTTPAdapter(
+                    pool_maxsize=settings.HTTP_POOL_MAXSIZE.get(
+                        name, settings.HTTP_POOL_MAXSIZE["default"]
+                    ),
+                    pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                    max_retries=JitterRetry(
+                        total=settings.HTTP_MAX_RETRIES,
+                        backoff_factor=settings.HTTP_BACKOFF_FACTOR,
+                        jitter=settings.HTTP_BACKOFF_JITTER,
+                        status_forcelist=RETRY_STATUSES,
+                        respect_retry_after_header=False,
+                        raise_on_status=False,
+                    ),
+                )
+                session = requests.Session()
+                session.headers["Accept-Encoding"] = "gzip, deflate"
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _adapters[name] = adapter
+                _sessions[name] = session
+    return _sessions[name]
+
+
+def pool_stats() -> Dict[str, Dict[str, int]]:
+    """Returns connection pool metrics of every session created in this process."""
+    return {name: adapter.stats() for name, adapter in _adapters.items()}